@@ -3,21 +3,54 @@ package com.carui.accessibility
 import android.accessibilityservice.AccessibilityService
 import android.content.Intent
 import android.graphics.Rect
+import android.os.Build
+import android.os.Handler
+import android.os.Looper
 import android.util.Log
 import android.view.accessibility.AccessibilityEvent
 import android.view.accessibility.AccessibilityNodeInfo
 import com.google.gson.Gson
+import com.google.gson.stream.JsonWriter
 import fi.iki.elonen.NanoHTTPD
 import java.io.IOException
+import java.io.OutputStreamWriter
+import java.io.PipedInputStream
+import java.io.PipedOutputStream
+import kotlin.concurrent.thread
 
 class CarUIAccessibilityService : AccessibilityService() {
 
     private var httpServer: UIHttpServer? = null
     private val gson = Gson()
 
+    // UI 变化版本：每个 display 一个单调递增的版本号（取自全局序号，跨 display 可比较）
+    private val versionLock = Object()
+    private val displayVersions = HashMap<Int, Long>()
+    private var versionSeq = 0L
+
+    // 事件合并：COALESCE_MS 内的多个事件只推进一次版本
+    private val mainHandler = Handler(Looper.getMainLooper())
+    private val pendingDisplays = HashSet<Int>()
+    private var flushScheduled = false
+    private val flushPending = Runnable { flushPendingDisplays() }
+
+    // windowId -> displayId，事件里只有 windowId
+    private val windowDisplays = HashMap<Int, Int>()
+
+    // 按窗口缓存的UI树，按事件增量刷新
+    private val treeCache = UITreeCache()
+
     companion object {
         private const val TAG = "CarUIAccessibility"
         private const val HTTP_PORT = 8765
+        private const val COALESCE_MS = 100L
+        private const val DEFAULT_POLL_TIMEOUT_MS = 25_000L
+        private const val MAX_POLL_TIMEOUT_MS = 60_000L
+        private const val STREAM_BUFFER_BYTES = 64 * 1024
+        private const val DEFAULT_FIND_LIMIT = 50
+        private const val MAX_FIND_LIMIT = 1000
+        // 找不到窗口所属 display 时，视为所有 display 都变了
+        private const val ALL_DISPLAYS = -1
         var instance: CarUIAccessibilityService? = null
     }
 
@@ -31,7 +64,97 @@ class CarUIAccessibilityService : AccessibilityService() {
     }
 
     override fun onAccessibilityEvent(event: AccessibilityEvent?) {
-        // 不需要主动监听事件，只在HTTP请求时获取UI树
+        // 只记录哪个 display 变了，不在事件里取 UI 树；UI 树仍然按 HTTP 请求获取
+        event ?: return
+        treeCache.onEvent(event)
+        when (event.eventType) {
+            AccessibilityEvent.TYPE_WINDOW_CONTENT_CHANGED,
+            AccessibilityEvent.TYPE_WINDOW_STATE_CHANGED -> markChanged(displayOfWindow(event.windowId))
+            AccessibilityEvent.TYPE_WINDOWS_CHANGED -> {
+                // 窗口增删/移动：窗口 -> display 映射也要重建
+                windowDisplays.clear()
+                markChanged(ALL_DISPLAYS)
+            }
+        }
+    }
+
+    private fun allWindows(): List<android.view.accessibility.AccessibilityWindowInfo> {
+        if (Build.VERSION.SDK_INT >= Build.VERSION_CODES.R) {
+            val result = mutableListOf<android.view.accessibility.AccessibilityWindowInfo>()
+            val byDisplay = windowsOnAllDisplays
+            for (i in 0 until byDisplay.size()) {
+                result.addAll(byDisplay.valueAt(i))
+            }
+            return result
+        }
+        return windows ?: emptyList()
+    }
+
+    private fun displayOfWindow(windowId: Int): Int {
+        windowDisplays[windowId]?.let { return it }
+        windowDisplays.clear()
+        try {
+            for (window in allWindows()) {
+                val displayId = if (Build.VERSION.SDK_INT >= Build.VERSION_CODES.R) window.displayId else 0
+                windowDisplays[window.id] = displayId
+            }
+        } catch (e: Exception) {
+            Log.w(TAG, "获取窗口列表失败", e)
+        }
+        return windowDisplays[windowId] ?: ALL_DISPLAYS
+    }
+
+    private fun markChanged(displayId: Int) {
+        pendingDisplays.add(displayId)
+        if (!flushScheduled) {
+            flushScheduled = true
+            mainHandler.postDelayed(flushPending, COALESCE_MS)
+        }
+    }
+
+    private fun flushPendingDisplays() {
+        flushScheduled = false
+        if (pendingDisplays.isEmpty()) return
+        synchronized(versionLock) {
+            versionSeq++
+            if (ALL_DISPLAYS in pendingDisplays) {
+                val known = displayVersions.keys + windowDisplays.values + 0
+                for (displayId in known) {
+                    displayVersions[displayId] = versionSeq
+                }
+            }
+            for (displayId in pendingDisplays) {
+                if (displayId != ALL_DISPLAYS) {
+                    displayVersions[displayId] = versionSeq
+                }
+            }
+            versionLock.notifyAll()
+        }
+        pendingDisplays.clear()
+    }
+
+    fun displayVersion(displayId: Int): Long = synchronized(versionLock) { displayVersions[displayId] ?: 0L }
+
+    /**
+     * 长轮询：有 display 的版本大于 since 时立即返回，否则最多等 timeoutMs。
+     * display 非空时只关心该 display。
+     */
+    fun waitForChanges(since: Long, displayId: Int?, timeoutMs: Long): UIEventsResponse {
+        val deadline = System.currentTimeMillis() + timeoutMs
+        synchronized(versionLock) {
+            while (true) {
+                val changed = displayVersions.filter { (d, v) -> v > since && (displayId == null || d == displayId) }
+                val remaining = deadline - System.currentTimeMillis()
+                if (changed.isNotEmpty() || remaining <= 0) {
+                    return UIEventsResponse(
+                        version = versionSeq,
+                        displays = displayVersions.mapKeys { it.key.toString() },
+                        changed = changed.keys.sorted()
+                    )
+                }
+                versionLock.wait(remaining)
+            }
+        }
     }
 
     override fun onInterrupt() {
@@ -41,6 +164,7 @@ class CarUIAccessibilityService : AccessibilityService() {
     override fun onDestroy() {
         super.onDestroy()
         instance = null
+        mainHandler.removeCallbacks(flushPending)
         stopHttpServer()
         Log.d(TAG, "辅助服务已销毁")
     }
@@ -62,14 +186,23 @@ class CarUIAccessibilityService : AccessibilityService() {
     }
 
     /**
-     * 获取当前UI树
+     * 把当前UI树直接写成 JSON（不先构造 UINode 树再整体 toJson）
+     *
+     * windowFilter 非空时只处理匹配的窗口（id 相等或标题包含，忽略大小写），其它窗口不刷新也不输出。
+     *
+     * 字段顺序：version, windows, nodes, success, error。windows 在 nodes 前面，
+     * 客户端边读边转换时可以先算出 display 原点；success 在最后，中途失败时客户端不会当成完整结果。
      */
-    fun getCurrentUITree(displayId: Int = 0): UITreeResponse {
-        val rootNodes = mutableListOf<UINode>()
-        
+    fun writeUITree(displayId: Int, writer: JsonWriter, filter: TreeFilter = TreeFilter(),
+                    windowFilter: String? = null) {
+        // 取树之前读版本：取树期间的变化会推进版本，调用方不会把旧树当成新版本
+        val version = displayVersion(displayId)
+        val targets = mutableListOf<Pair<android.view.accessibility.AccessibilityWindowInfo, WindowInfo>>()
+
         try {
             // 获取所有窗口
-            val windows = windows ?: emptyList()
+            val windows = allWindows()
+            treeCache.retain(windows.map { it.id }.toSet())
             Log.d(TAG, "请求获取Display $displayId 的UI树")
             Log.d(TAG, "系统共有 ${windows.size} 个窗口")
             
@@ -84,88 +217,173 @@ class CarUIAccessibilityService : AccessibilityService() {
                     continue
                 }
                 
+                if (windowFilter != null && !matchesWindow(window, windowFilter)) {
+                    continue
+                }
+
                 Log.d(TAG, "处理窗口: displayId=${window.displayId}, title=${window.title}")
                 
-                val root = window.root
-                if (root != null) {
-                    val windowInfo = WindowInfo(
-                        title = window.title?.toString() ?: "",
-                        type = window.type,
-                        displayId = window.displayId,
-                        bounds = getBoundsRect(window)
-                    )
-                    
-                    val uiNode = traverseNode(root, windowInfo)
-                    rootNodes.add(uiNode)
-                    
+                val windowInfo = WindowInfo(
+                    title = window.title?.toString() ?: "",
+                    type = window.type,
+                    displayId = window.displayId,
+                    bounds = getBoundsRect(window)
+                )
+
+                // 没变过的窗口直接用缓存，变了的只刷新事件指出的子树
+                treeCache.refresh(window)
+                targets.add(window to windowInfo)
+            }
+        } catch (e: Exception) {
+            // IPC 都在输出之前，失败时还没有写任何内容
+            Log.e(TAG, "获取UI树失败", e)
+            writer.beginObject()
+            writer.name("nodes").beginArray().endArray()
+            writer.name("success").value(false)
+            writer.name("error").value(e.message ?: "未知错误")
+            writer.endObject()
+            return
+        }
+
+        writer.beginObject()
+        writer.name("version").value(version)
+        writer.name("windows").beginArray()
+        for ((_, windowInfo) in targets) {
+            writer.writeWindow(windowInfo)
+        }
+        writer.endArray()
+        writer.name("nodes").beginArray()
+        var count = 0
+        for ((window, windowInfo) in targets) {
+            if (treeCache.write(window, windowInfo, writer, filter)) count++
+        }
+        writer.endArray()
+        writer.name("success").value(true)
+        writer.name("error").nullValue()
+        writer.endObject()
+        Log.d(TAG, "成功获取UI树，共 $count 个根节点")
+    }
+
+    /**
+     * 在设备上按选择器找节点，只返回匹配的节点（不带子节点）
+     *
+     * 有 viewId 时用 findAccessibilityNodeInfosByViewId，有文本条件时用 findAccessibilityNodeInfosByText，
+     * 由目标应用进程自己匹配，不用遍历整棵树；只有 className 时在缓存的UI树里找。
+     * 系统接口的结果再按全部条件过滤一遍（ByText 是包含匹配且也匹配 contentDescription）。
+     */
+    fun findNodes(displayId: Int, selector: NodeSelector, windowFilter: String?, limit: Int): FindResponse {
+        val windowInfos = mutableListOf<WindowInfo>()
+        val found = mutableListOf<UINode>()
+        var strategy = "scan"
+        try {
+            for (window in allWindows()) {
+                if (window.displayId != displayId) continue
+                val windowInfo = WindowInfo(
+                    title = window.title?.toString() ?: "",
+                    type = window.type,
+                    displayId = window.displayId,
+                    bounds = getBoundsRect(window)
+                )
+                // 所有窗口的 bounds 都要返回（客户端据此算 display 原点），匹配只在选中的窗口里做
+                windowInfos.add(windowInfo)
+                if (windowFilter != null && !matchesWindow(window, windowFilter)) continue
+                if (found.size >= limit) continue
+
+                if (selector.viewId == null && selector.text == null && selector.textContains == null) {
+                    treeCache.refresh(window)
+                    treeCache.find(window, selector, limit - found.size).forEach {
+                        found.add(it.copy(window = windowInfo))
+                    }
+                    continue
+                }
+
+                val root = window.root ?: continue
+                var candidates: List<AccessibilityNodeInfo> = emptyList()
+                try {
+                    candidates = if (selector.viewId != null) {
+                        strategy = "viewId"
+                        // 只有 name 时按窗口所属应用的包名补全
+                        val viewId = if (':' in selector.viewId) selector.viewId
+                            else "${root.packageName}:id/${selector.viewId.substringAfterLast('/')}"
+                        root.findAccessibilityNodeInfosByViewId(viewId)
+                    } else {
+                        strategy = "text"
+                        root.findAccessibilityNodeInfosByText(selector.text ?: selector.textContains ?: "")
+                    }
+                    for (node in candidates) {
+                        val attrs = readNodeAttrs(node)
+                        if (found.size < limit && selector.matches(attrs)) {
+                            found.add(attrs.copy(window = windowInfo))
+                        }
+                    }
+                } finally {
+                    // 中途抛异常（节点失效等）也要回收
+                    candidates.forEach { it.recycle() }
                     root.recycle()
                 }
             }
-            
-            Log.d(TAG, "成功获取UI树，共 ${rootNodes.size} 个根节点")
-            
         } catch (e: Exception) {
-            Log.e(TAG, "获取UI树失败", e)
-            return UITreeResponse(
-                success = false,
-                error = e.message ?: "未知错误",
-                nodes = emptyList()
-            )
+            Log.e(TAG, "查找节点失败", e)
+            return FindResponse(success = false, error = e.message ?: "未知错误", strategy = strategy,
+                count = 0, windows = windowInfos, nodes = emptyList())
         }
-        
-        return UITreeResponse(
-            success = true,
-            error = null,
-            nodes = rootNodes
+        Log.d(TAG, "查找节点($strategy): ${found.size} 个")
+        return FindResponse(success = true, error = null, strategy = strategy,
+            count = found.size, windows = windowInfos, nodes = found)
+    }
+
+    private fun matchesWindow(window: android.view.accessibility.AccessibilityWindowInfo, query: String): Boolean {
+        return window.id.toString() == query ||
+                (window.title?.toString() ?: "").contains(query, ignoreCase = true)
+    }
+
+    /**
+     * 解析 /api/hierarchy 的过滤参数，参数不合法时抛 IllegalArgumentException
+     */
+    private fun parseTreeFilter(params: Map<String, String>): TreeFilter {
+        val maxDepth = params["maxDepth"]?.let {
+            it.toIntOrNull()?.takeIf { d -> d >= 0 } ?: throw IllegalArgumentException("maxDepth 必须是非负整数: $it")
+        } ?: Int.MAX_VALUE
+        val fields = params["fields"]?.split(",")?.map { it.trim() }?.filter { it.isNotEmpty() }?.toSet()
+        val unknown = fields.orEmpty() - TreeFilter.NODE_FIELDS
+        if (unknown.isNotEmpty()) {
+            throw IllegalArgumentException("未知字段: ${unknown.joinToString(",")}，可选: ${TreeFilter.NODE_FIELDS.joinToString(",")}")
+        }
+        val rootPath = params["root"]?.split("/", ".")?.filter { it.isNotEmpty() }?.map {
+            it.toIntOrNull()?.takeIf { i -> i >= 0 } ?: throw IllegalArgumentException("root 必须是子节点下标路径，如 0/2/1: ${params["root"]}")
+        } ?: emptyList()
+        return TreeFilter(
+            maxDepth = maxDepth,
+            visibleOnly = params["visibleOnly"]?.let { it == "true" || it == "1" } ?: false,
+            fields = fields,
+            rootPath = rootPath
         )
     }
 
     /**
-     * 遍历节点树
+     * 在单独的线程里往管道写 JSON，响应按 chunked 边写边发（客户端接受时 gzip 压缩）
      */
-    private fun traverseNode(
-        node: AccessibilityNodeInfo,
-        windowInfo: WindowInfo,
-        depth: Int = 0
-    ): UINode {
-        val bounds = Rect()
-        node.getBoundsInScreen(bounds)
-        
-        val children = mutableListOf<UINode>()
-        for (i in 0 until node.childCount) {
-            val child = node.getChild(i)
-            if (child != null) {
-                children.add(traverseNode(child, windowInfo, depth + 1))
-                child.recycle()
+    private fun streamJson(write: (JsonWriter) -> Unit): NanoHTTPD.Response {
+        val input = PipedInputStream(STREAM_BUFFER_BYTES)
+        val output = PipedOutputStream(input)
+        thread(name = "ui-json-writer") {
+            try {
+                JsonWriter(OutputStreamWriter(output, Charsets.UTF_8).buffered(STREAM_BUFFER_BYTES)).use(write)
+            } catch (e: IOException) {
+                // 客户端中途断开
+                Log.w(TAG, "输出UI树中断: ${e.message}")
+            } catch (e: Exception) {
+                // 节点已回收、JsonWriter 状态错误等：响应截断，不会带 success:true
+                Log.e(TAG, "输出UI树失败", e)
+            } finally {
+                try {
+                    output.close()
+                } catch (e: IOException) {
+                    // 读端已经关闭
+                }
             }
         }
-        
-        return UINode(
-            className = node.className?.toString() ?: "",
-            packageName = node.packageName?.toString() ?: "",
-            text = node.text?.toString() ?: "",
-            contentDescription = node.contentDescription?.toString() ?: "",
-            resourceId = node.viewIdResourceName ?: "",
-            bounds = BoundsInfo(
-                left = bounds.left,
-                top = bounds.top,
-                right = bounds.right,
-                bottom = bounds.bottom
-            ),
-            clickable = node.isClickable,
-            longClickable = node.isLongClickable,
-            enabled = node.isEnabled,
-            visibleToUser = node.isVisibleToUser,
-            focusable = node.isFocusable,
-            focused = node.isFocused,
-            selected = node.isSelected,
-            checkable = node.isCheckable,
-            checked = node.isChecked,
-            scrollable = node.isScrollable,
-            window = windowInfo,
-            children = children,
-            depth = depth
-        )
+        return NanoHTTPD.newChunkedResponse(NanoHTTPD.Response.Status.OK, "application/json", input)
     }
 
     private fun getBoundsRect(window: android.view.accessibility.AccessibilityWindowInfo): BoundsInfo {
@@ -183,6 +401,9 @@ class CarUIAccessibilityService : AccessibilityService() {
      * 内嵌HTTP服务器
      */
     inner class UIHttpServer(port: Int) : NanoHTTPD(port) {
+        // JSON 响应在客户端带 Accept-Encoding: gzip 时压缩（adb forward 带宽有限）
+        override fun useGzipWhenAccepted(r: Response): Boolean = r.mimeType == "application/json"
+
         override fun serve(session: IHTTPSession): Response {
             val uri = session.uri
             val params = session.parms
@@ -192,14 +413,47 @@ class CarUIAccessibilityService : AccessibilityService() {
             return when (uri) {
                 "/api/hierarchy" -> {
                     val displayId = params["display"]?.toIntOrNull() ?: 0
-                    val uiTree = getCurrentUITree(displayId)
-                    val json = gson.toJson(uiTree)
-                    newFixedLengthResponse(Response.Status.OK, "application/json", json)
+                    try {
+                        val filter = parseTreeFilter(params)
+                        val windowFilter = params["window"]?.takeIf { it.isNotEmpty() }
+                        streamJson { writer -> writeUITree(displayId, writer, filter, windowFilter) }
+                    } catch (e: IllegalArgumentException) {
+                        val error = mapOf("success" to false, "error" to e.message, "nodes" to emptyList<Any>())
+                        newFixedLengthResponse(Response.Status.BAD_REQUEST, "application/json", gson.toJson(error))
+                    }
+                }
+                "/api/find" -> {
+                    val displayId = params["display"]?.toIntOrNull() ?: 0
+                    val selector = NodeSelector(
+                        text = params["text"]?.takeIf { it.isNotEmpty() },
+                        textContains = params["textContains"]?.takeIf { it.isNotEmpty() },
+                        viewId = params["viewId"]?.takeIf { it.isNotEmpty() },
+                        className = params["className"]?.takeIf { it.isNotEmpty() }
+                    )
+                    if (selector.isEmpty()) {
+                        val error = mapOf("success" to false, "error" to "需要 text / textContains / viewId / className 之一")
+                        newFixedLengthResponse(Response.Status.BAD_REQUEST, "application/json", gson.toJson(error))
+                    } else {
+                        val limit = (params["limit"]?.toIntOrNull() ?: DEFAULT_FIND_LIMIT).coerceIn(1, MAX_FIND_LIMIT)
+                        val windowFilter = params["window"]?.takeIf { it.isNotEmpty() }
+                        val result = findNodes(displayId, selector, windowFilter, limit)
+                        newFixedLengthResponse(Response.Status.OK, "application/json", gson.toJson(result))
+                    }
+                }
+                "/api/events" -> {
+                    // UI 变化长轮询：since 为上次拿到的 version
+                    val since = params["since"]?.toLongOrNull() ?: 0L
+                    val displayId = params["display"]?.toIntOrNull()
+                    val timeoutMs = (params["timeout"]?.toLongOrNull() ?: DEFAULT_POLL_TIMEOUT_MS)
+                        .coerceIn(0L, MAX_POLL_TIMEOUT_MS)
+                    val events = waitForChanges(since, displayId, timeoutMs)
+                    newFixedLengthResponse(Response.Status.OK, "application/json", gson.toJson(events))
                 }
                 "/api/status" -> {
                     val status = mapOf(
                         "service" to "running",
-                        "port" to HTTP_PORT
+                        "port" to HTTP_PORT,
+                        "treeCache" to treeCache.stats()
                     )
                     val json = gson.toJson(status)
                     newFixedLengthResponse(Response.Status.OK, "application/json", json)
@@ -213,12 +467,27 @@ class CarUIAccessibilityService : AccessibilityService() {
 }
 
 // 数据类定义
-data class UITreeResponse(
+data class FindResponse(
     val success: Boolean,
     val error: String?,
+    // viewId / text：系统接口匹配；scan：在缓存的UI树里找
+    val strategy: String,
+    val count: Int,
+    // 该 display 上所有窗口（客户端据此把坐标换算到 display 坐标系）
+    val windows: List<WindowInfo>,
+    // 匹配的节点，children 为空
     val nodes: List<UINode>
 )
 
+data class UIEventsResponse(
+    // 当前全局版本，下次轮询作为 since
+    val version: Long,
+    // display -> 最近一次变化时的版本
+    val displays: Map<String, Long>,
+    // 版本大于 since 的 display
+    val changed: List<Int>
+)
+
 data class UINode(
     val className: String,
     val packageName: String,
@@ -254,3 +523,21 @@ data class WindowInfo(
     val displayId: Int,
     val bounds: BoundsInfo
 )
+
+internal fun JsonWriter.writeBounds(bounds: BoundsInfo): JsonWriter {
+    beginObject()
+    name("left").value(bounds.left.toLong())
+    name("top").value(bounds.top.toLong())
+    name("right").value(bounds.right.toLong())
+    name("bottom").value(bounds.bottom.toLong())
+    return endObject()
+}
+
+internal fun JsonWriter.writeWindow(window: WindowInfo): JsonWriter {
+    beginObject()
+    name("title").value(window.title)
+    name("type").value(window.type.toLong())
+    name("displayId").value(window.displayId.toLong())
+    name("bounds").writeBounds(window.bounds)
+    return endObject()
+}
@@ -0,0 +1,465 @@
+package com.carui.accessibility
+
+import android.graphics.Rect
+import android.util.Log
+import android.view.accessibility.AccessibilityEvent
+import android.view.accessibility.AccessibilityNodeInfo
+import android.view.accessibility.AccessibilityWindowInfo
+import com.google.gson.stream.JsonWriter
+
+/**
+ * /api/hierarchy 的输出过滤
+ *
+ * @param maxDepth 相对输出根节点的最大深度（0 只输出根节点）
+ * @param visibleOnly 跳过对用户不可见的节点及其子树
+ * @param fields 输出的节点字段（null 为全部）；children 总是输出，window 只在根节点上输出
+ * @param rootPath 从窗口根节点开始的子节点下标路径，只输出这棵子树
+ */
+data class TreeFilter(
+    val maxDepth: Int = Int.MAX_VALUE,
+    val visibleOnly: Boolean = false,
+    val fields: Set<String>? = null,
+    val rootPath: List<Int> = emptyList()
+) {
+    companion object {
+        val NODE_FIELDS = setOf(
+            "className", "packageName", "text", "contentDescription", "resourceId", "bounds",
+            "clickable", "longClickable", "enabled", "visibleToUser", "focusable", "focused",
+            "selected", "checkable", "checked", "scrollable", "depth"
+        )
+    }
+
+    fun wants(field: String) = fields == null || field in fields
+}
+
+/**
+ * /api/find 的节点选择器（条件之间 AND）
+ *
+ * @param text 文本完全相等
+ * @param textContains 文本包含（忽略大小写，和 findAccessibilityNodeInfosByText 一致）
+ * @param viewId resource-id，完整（pkg:id/name）或只有 name
+ * @param className 完整类名或简单类名
+ */
+data class NodeSelector(
+    val text: String? = null,
+    val textContains: String? = null,
+    val viewId: String? = null,
+    val className: String? = null
+) {
+    fun isEmpty() = text == null && textContains == null && viewId == null && className == null
+
+    fun matches(attrs: UINode): Boolean {
+        if (text != null && attrs.text != text) return false
+        if (textContains != null && !attrs.text.contains(textContains, ignoreCase = true)) return false
+        if (viewId != null && attrs.resourceId != viewId && attrs.resourceId.substringAfterLast('/') != viewId) {
+            return false
+        }
+        if (className != null && attrs.className != className && !attrs.className.endsWith(".$className")) {
+            return false
+        }
+        return true
+    }
+}
+
+/**
+ * 按窗口缓存的UI树
+ *
+ * 每次 getChild() 都是一次 binder IPC，整棵树遍历在复杂界面上要几百毫秒。
+ * 窗口第一次被请求时完整遍历一次，之后只按 TYPE_WINDOW_CONTENT_CHANGED 事件的 source 节点刷新：
+ * - 子树变化（SUBTREE / 未指定类型）：重新遍历该节点的子树
+ * - 其它变化（TEXT / CONTENT_DESCRIPTION / STATE 等）：只刷新该节点自身属性
+ * 取树时把缓存（裁剪后的副本）直接写成 JSON，不再构造一份 UINode 树。
+ *
+ * 事件回调（主线程）只记录脏节点；刷新在 HTTP 请求线程里取树时做，不阻塞主线程。
+ */
+class UITreeCache {
+
+    private class CachedNode(var info: AccessibilityNodeInfo, var parent: CachedNode?) {
+        // 节点自身属性（children / window / depth 在 toUINode 时填）
+        lateinit var attrs: UINode
+        val children = mutableListOf<CachedNode>()
+    }
+
+    private class CachedWindow {
+        var root: CachedNode? = null
+        // AccessibilityNodeInfo 的 equals/hashCode 按窗口 + 节点 id，事件里的 source 可以直接查
+        val index = HashMap<AccessibilityNodeInfo, CachedNode>()
+    }
+
+    // 按 filter 裁剪后的不可变副本：在 treeLock 里拷出来，锁外写 JSON
+    private class NodeSnapshot(val attrs: UINode, val children: List<NodeSnapshot>)
+
+    companion object {
+        private const val TAG = "CarUIAccessibility"
+        // 一个窗口积压的事件超过这个数，不如直接完整遍历
+        private const val MAX_PENDING_EVENTS = 64
+    }
+
+    // 只在取树（请求线程）时访问
+    private val treeLock = Object()
+    private val windows = HashMap<Int, CachedWindow>()
+
+    // 事件线程和请求线程共享，只做记录，持有时间很短
+    private val pendingLock = Object()
+    private val cachedWindowIds = HashSet<Int>()
+    private val dirtyWindows = HashSet<Int>()
+    // windowId -> 积压的 (事件副本, 是否刷新整个子树)。
+    // event.source 可能是一次 binder 调用，不在主线程（事件回调）里取，等取树时在请求线程里解析
+    private val pendingEvents = HashMap<Int, MutableList<Pair<AccessibilityEvent, Boolean>>>()
+
+    private val stats = LinkedHashMap<String, Long>().apply {
+        for (key in listOf("requests", "fullWalks", "subtreeRefreshes", "nodeRefreshes", "removed", "nodesRead")) {
+            put(key, 0L)
+        }
+    }
+
+    private fun count(key: String, n: Long = 1L) {
+        synchronized(stats) { stats[key] = (stats[key] ?: 0L) + n }
+    }
+
+    fun stats(): Map<String, Long> = synchronized(stats) { LinkedHashMap(stats) }
+
+    /**
+     * 记录一个事件影响的节点/窗口（主线程调用，不做 IPC）。没缓存过的窗口不用记，第一次取树时会完整遍历。
+     */
+    fun onEvent(event: AccessibilityEvent) {
+        val windowId = event.windowId
+        synchronized(pendingLock) {
+            if (windowId !in cachedWindowIds) return
+        }
+        when (event.eventType) {
+            AccessibilityEvent.TYPE_WINDOW_CONTENT_CHANGED -> {
+                val types = event.contentChangeTypes
+                val subtree = types == AccessibilityEvent.CONTENT_CHANGE_TYPE_UNDEFINED ||
+                        types and AccessibilityEvent.CONTENT_CHANGE_TYPE_SUBTREE != 0
+                markNode(windowId, event, subtree)
+            }
+            // 滚动后子节点的 bounds 都变了，不一定有 SUBTREE 事件
+            AccessibilityEvent.TYPE_VIEW_SCROLLED -> markNode(windowId, event, true)
+            AccessibilityEvent.TYPE_WINDOW_STATE_CHANGED -> markWindow(windowId)
+        }
+    }
+
+    @Suppress("DEPRECATION")
+    private fun markNode(windowId: Int, event: AccessibilityEvent, subtree: Boolean) {
+        synchronized(pendingLock) {
+            if (windowId in dirtyWindows) return
+            val pending = pendingEvents.getOrPut(windowId) { mutableListOf() }
+            if (pending.size >= MAX_PENDING_EVENTS) {
+                recycleEvents(pendingEvents.remove(windowId))
+                dirtyWindows.add(windowId)
+                return
+            }
+            // 回调返回后系统会回收 event，这里存一份副本（只拷贝字段，不做 IPC）
+            pending.add(AccessibilityEvent.obtain(event) to subtree)
+        }
+    }
+
+    private fun markWindow(windowId: Int) {
+        synchronized(pendingLock) {
+            recycleEvents(pendingEvents.remove(windowId))
+            dirtyWindows.add(windowId)
+        }
+    }
+
+    @Suppress("DEPRECATION")
+    private fun recycleEvents(events: List<Pair<AccessibilityEvent, Boolean>>?) {
+        events?.forEach { it.first.recycle() }
+    }
+
+    /**
+     * 丢掉已经不存在的窗口
+     */
+    fun retain(windowIds: Set<Int>) {
+        synchronized(treeLock) {
+            for (windowId in windows.keys - windowIds) {
+                recycleWindow(windows.remove(windowId))
+            }
+        }
+        synchronized(pendingLock) {
+            cachedWindowIds.retainAll(windowIds)
+            dirtyWindows.retainAll(windowIds)
+            for (windowId in pendingEvents.keys - windowIds) {
+                recycleEvents(pendingEvents.remove(windowId))
+            }
+        }
+    }
+
+    /**
+     * 刷新窗口的UI树（IPC）：没缓存或被标脏时完整遍历，否则只刷新积压的脏节点
+     */
+    fun refresh(window: AccessibilityWindowInfo) {
+        synchronized(treeLock) {
+            count("requests")
+            val windowId = window.id
+            val dirty: Boolean
+            val events: List<Pair<AccessibilityEvent, Boolean>>
+            synchronized(pendingLock) {
+                dirty = windowId !in cachedWindowIds || dirtyWindows.remove(windowId)
+                events = pendingEvents.remove(windowId) ?: emptyList()
+                // 从这里开始的事件都记下来，下次取树时处理
+                cachedWindowIds.add(windowId)
+            }
+
+            val cached = windows[windowId]
+            if (cached == null || dirty) {
+                recycleEvents(events)
+                replaceWindow(windowId, fullWalk(window))
+                return
+            }
+            val pending = resolveSources(events)
+            if (pending == null || !applyPending(cached, pending)) {
+                replaceWindow(windowId, fullWalk(window))
+            }
+        }
+    }
+
+    private fun replaceWindow(windowId: Int, cached: CachedWindow) {
+        recycleWindow(windows.put(windowId, cached))
+    }
+
+    /**
+     * 回收被替换或丢掉的窗口缓存持有的所有节点
+     */
+    private fun recycleWindow(cached: CachedWindow?) {
+        val root = cached?.root ?: return
+        unindex(cached, root)
+    }
+
+    /**
+     * 取出事件副本的 source 节点（IPC），同一个节点的多个事件合并；有事件拿不到 source 时返回 null（改为完整遍历）
+     */
+    @Suppress("DEPRECATION")
+    private fun resolveSources(events: List<Pair<AccessibilityEvent, Boolean>>): Map<AccessibilityNodeInfo, Boolean>? {
+        val sources = LinkedHashMap<AccessibilityNodeInfo, Boolean>()
+        var complete = true
+        for ((event, subtree) in events) {
+            val source = if (complete) event.source else null
+            event.recycle()
+            if (!complete) continue
+            if (source == null) {
+                complete = false
+                continue
+            }
+            val previous = sources[source]
+            if (previous == null) {
+                sources[source] = subtree
+            } else {
+                // 已有相等的 key（同一窗口 + 节点 id）：保留旧 key，新取到的这个用不上
+                sources[source] = subtree || previous
+                source.recycle()
+            }
+        }
+        if (!complete) {
+            sources.keys.forEach { it.recycle() }
+            return null
+        }
+        return sources
+    }
+
+    /**
+     * 把缓存的窗口UI树（按 filter 裁剪）写成一个根节点（不做 IPC）；
+     * 窗口没有缓存、root 路径不存在或根节点被 visibleOnly 过滤掉时什么都不写，返回 false
+     *
+     * writer 背后是有界的管道，客户端读得慢时写会阻塞：只在 treeLock 里拷贝要输出的部分，写 JSON 不持锁
+     */
+    fun write(window: AccessibilityWindowInfo, windowInfo: WindowInfo, writer: JsonWriter,
+              filter: TreeFilter = TreeFilter()): Boolean {
+        val snapshot = snapshot(window, filter) ?: return false
+        writeNode(snapshot, windowInfo, 0, writer, filter)
+        return true
+    }
+
+    private fun snapshot(window: AccessibilityWindowInfo, filter: TreeFilter): NodeSnapshot? {
+        synchronized(treeLock) {
+            var root = windows[window.id]?.root ?: return null
+            for (index in filter.rootPath) {
+                root = root.children.getOrNull(index) ?: return null
+            }
+            if (filter.visibleOnly && !root.attrs.visibleToUser) return null
+            return copyNode(root, 0, filter)
+        }
+    }
+
+    private fun copyNode(node: CachedNode, depth: Int, filter: TreeFilter): NodeSnapshot {
+        val children = if (depth < filter.maxDepth) {
+            node.children
+                .filter { !filter.visibleOnly || it.attrs.visibleToUser }
+                .map { copyNode(it, depth + 1, filter) }
+        } else {
+            emptyList()
+        }
+        return NodeSnapshot(node.attrs, children)
+    }
+
+    private fun fullWalk(window: AccessibilityWindowInfo): CachedWindow {
+        count("fullWalks")
+        val cached = CachedWindow()
+        val root = window.root ?: return cached
+        cached.root = walk(cached, root, null)
+        Log.d(TAG, "完整遍历窗口 ${window.id}: ${cached.index.size} 个节点")
+        return cached
+    }
+
+    /**
+     * 刷新积压的脏节点；缓存里找不到的节点返回 false（改为完整遍历）。pending 里的 source 全部在这里回收
+     */
+    private fun applyPending(cached: CachedWindow, pending: Map<AccessibilityNodeInfo, Boolean>): Boolean {
+        try {
+            return applyPendingNodes(cached, pending)
+        } finally {
+            pending.keys.forEach { it.recycle() }
+        }
+    }
+
+    private fun applyPendingNodes(cached: CachedWindow, pending: Map<AccessibilityNodeInfo, Boolean>): Boolean {
+        // 本次已经重新遍历过的节点，后面的事件不用再刷新
+        val fresh = HashSet<CachedNode>()
+        for ((source, subtree) in pending) {
+            val node = cached.index[source]
+            if (node == null) return false
+            if (node in fresh) continue
+            if (!node.info.refresh()) {
+                // 节点已经没了：从父节点摘掉
+                count("removed")
+                unindex(cached, node)
+                val parent = node.parent ?: return false
+                parent.children.remove(node)
+                continue
+            }
+            count("nodesRead")
+            node.attrs = readNodeAttrs(node.info)
+            if (subtree) {
+                count("subtreeRefreshes")
+                for (child in node.children) {
+                    unindex(cached, child)
+                }
+                node.children.clear()
+                walkChildren(cached, node, fresh)
+            } else {
+                count("nodeRefreshes")
+            }
+        }
+        return true
+    }
+
+    private fun walk(cached: CachedWindow, info: AccessibilityNodeInfo, parent: CachedNode?,
+                     fresh: MutableSet<CachedNode>? = null): CachedNode {
+        count("nodesRead")
+        val node = CachedNode(info, parent)
+        node.attrs = readNodeAttrs(info)
+        cached.index[info] = node
+        fresh?.add(node)
+        walkChildren(cached, node, fresh)
+        return node
+    }
+
+    private fun walkChildren(cached: CachedWindow, node: CachedNode, fresh: MutableSet<CachedNode>?) {
+        // 缓存持有的节点不 recycle，被替换或删除时才回收
+        for (i in 0 until node.info.childCount) {
+            val child = node.info.getChild(i) ?: continue
+            node.children.add(walk(cached, child, node, fresh))
+        }
+    }
+
+    private fun unindex(cached: CachedWindow, node: CachedNode) {
+        val stack = ArrayDeque<CachedNode>()
+        stack.add(node)
+        while (stack.isNotEmpty()) {
+            val current = stack.removeLast()
+            cached.index.remove(current.info)
+            current.info.recycle()
+            stack.addAll(current.children)
+        }
+    }
+
+    /**
+     * 在缓存的窗口UI树里按前序找匹配的节点（不做 IPC，先 refresh）；最多返回 limit 个
+     */
+    fun find(window: AccessibilityWindowInfo, selector: NodeSelector, limit: Int): List<UINode> {
+        val result = mutableListOf<UINode>()
+        synchronized(treeLock) {
+            val root = windows[window.id]?.root ?: return result
+            val stack = ArrayDeque<CachedNode>()
+            stack.add(root)
+            while (stack.isNotEmpty() && result.size < limit) {
+                val node = stack.removeLast()
+                if (selector.matches(node.attrs)) result.add(node.attrs)
+                for (i in node.children.indices.reversed()) {
+                    stack.add(node.children[i])
+                }
+            }
+        }
+        return result
+    }
+
+    /**
+     * 字段和顺序与 UINode 的 Gson 输出一致（maxDepth / visibleOnly 已在拷贝时裁过）；window 只写在根节点上，depth 只在 fields 里点名时才写
+     */
+    private fun writeNode(node: NodeSnapshot, windowInfo: WindowInfo, depth: Int, writer: JsonWriter,
+                          filter: TreeFilter) {
+        val attrs = node.attrs
+        writer.beginObject()
+        if (filter.wants("className")) writer.name("className").value(attrs.className)
+        if (filter.wants("packageName")) writer.name("packageName").value(attrs.packageName)
+        if (filter.wants("text")) writer.name("text").value(attrs.text)
+        if (filter.wants("contentDescription")) writer.name("contentDescription").value(attrs.contentDescription)
+        if (filter.wants("resourceId")) writer.name("resourceId").value(attrs.resourceId)
+        if (filter.wants("bounds")) writer.name("bounds").writeBounds(attrs.bounds)
+        if (filter.wants("clickable")) writer.name("clickable").value(attrs.clickable)
+        if (filter.wants("longClickable")) writer.name("longClickable").value(attrs.longClickable)
+        if (filter.wants("enabled")) writer.name("enabled").value(attrs.enabled)
+        if (filter.wants("visibleToUser")) writer.name("visibleToUser").value(attrs.visibleToUser)
+        if (filter.wants("focusable")) writer.name("focusable").value(attrs.focusable)
+        if (filter.wants("focused")) writer.name("focused").value(attrs.focused)
+        if (filter.wants("selected")) writer.name("selected").value(attrs.selected)
+        if (filter.wants("checkable")) writer.name("checkable").value(attrs.checkable)
+        if (filter.wants("checked")) writer.name("checked").value(attrs.checked)
+        if (filter.wants("scrollable")) writer.name("scrollable").value(attrs.scrollable)
+        if (depth == 0) writer.name("window").writeWindow(windowInfo)
+        writer.name("children").beginArray()
+        for (child in node.children) {
+            writeNode(child, windowInfo, depth + 1, writer, filter)
+        }
+        writer.endArray()
+        if (filter.fields != null && "depth" in filter.fields) writer.name("depth").value(depth.toLong())
+        writer.endObject()
+    }
+}
+
+/**
+ * 读取节点自身属性（children / window / depth 为占位）
+ */
+internal fun readNodeAttrs(node: AccessibilityNodeInfo): UINode {
+    val bounds = Rect()
+    node.getBoundsInScreen(bounds)
+    return UINode(
+        className = node.className?.toString() ?: "",
+        packageName = node.packageName?.toString() ?: "",
+        text = node.text?.toString() ?: "",
+        contentDescription = node.contentDescription?.toString() ?: "",
+        resourceId = node.viewIdResourceName ?: "",
+        bounds = BoundsInfo(
+            left = bounds.left,
+            top = bounds.top,
+            right = bounds.right,
+            bottom = bounds.bottom
+        ),
+        clickable = node.isClickable,
+        longClickable = node.isLongClickable,
+        enabled = node.isEnabled,
+        visibleToUser = node.isVisibleToUser,
+        focusable = node.isFocusable,
+        focused = node.isFocused,
+        selected = node.isSelected,
+        checkable = node.isCheckable,
+        checked = node.isChecked,
+        scrollable = node.isScrollable,
+        window = NO_WINDOW,
+        children = emptyList(),
+        depth = 0
+    )
+}
+
+// 缓存里的节点属性还没挂到窗口上时的占位
+private val NO_WINDOW = WindowInfo(title = "", type = 0, displayId = 0, bounds = BoundsInfo(0, 0, 0, 0))
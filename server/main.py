@@ -1,13 +1,28 @@
 import io
+import json
+import asyncio
+import base64
+import math
+import struct
+import hashlib
+import socket
 import uvicorn
 import os
 import sys
 import subprocess
 import re
-from typing import Optional, List, Dict
-from fastapi import FastAPI, HTTPException
+import threading
+import time
+import xml.etree.ElementTree as ET
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Tuple
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import adbutils
@@ -20,7 +35,38 @@ try:
 except Exception:  # pragma: no cover
     requests = None
 
-app = FastAPI()
+# Optional dependency for frame tile diff (stream falls back to full frames)
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+# Optional fast encoders for format=columnar hierarchy (fallback: stdlib json)
+try:
+    import orjson  # type: ignore
+except Exception:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack  # type: ignore
+except Exception:  # pragma: no cover
+    msgpack = None
+
+# Optional incremental JSON parser for the accessibility UI tree (fallback: parse whole body)
+try:
+    import ijson  # type: ignore
+except Exception:  # pragma: no cover
+    ijson = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 设备上下线跟踪（见 start_device_tracker）
+    start_device_tracker()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -72,24 +118,527 @@ else:
 
 # State
 current_serial: Optional[str] = None
-display_mapping: Dict[str, str] = {}
-display_info_cache: List[Dict] = []
-# hierarchy cache: key=display id, value=last successful xml
-hierarchy_xml_cache: Dict[int, str] = {}
 # SS4设备映射表：记住localhost:5559对应的原始SS4设备类型和原始序列号
 # key: "localhost:5559", value: {"type": "SS4", "original_serial": "da157e15a1f"}
 ss4_localhost_mapping: Dict[str, Dict[str, str]] = {}
 
 
+# --- 日志 ---
+# 按模块分级的结构化日志：记录进内存环形缓冲（/api/logs 查看），只有 >= stdout 级别的才打印到终端。
+# 热路径上只为日志服务的计算要先判断 xxx_log.debug_enabled，关掉时完全不做。
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_DEFAULT_LEVEL = "info"
+LOG_STDOUT_LEVEL = "warning"
+LOG_RING_SIZE = 2000
+
+
+class ModuleLogger:
+    """单个模块的日志入口；级别由 LogHub 统一配置。"""
+
+    def __init__(self, hub: "LogHub", module: str, level: int):
+        self.hub = hub
+        self.module = module
+        self.level = level
+
+    @property
+    def debug_enabled(self) -> bool:
+        return self.level <= LOG_LEVELS["debug"]
+
+    def enabled(self, level: str) -> bool:
+        return self.level <= LOG_LEVELS[level]
+
+    def _log(self, level: str, msg: str, exc_info: bool, fields: Dict):
+        if LOG_LEVELS[level] < self.level:
+            return
+        if exc_info:
+            import traceback
+            fields["traceback"] = traceback.format_exc()
+        self.hub.emit(self.module, level, msg, fields)
+
+    def debug(self, msg: str, exc_info: bool = False, **fields):
+        self._log("debug", msg, exc_info, fields)
+
+    def info(self, msg: str, exc_info: bool = False, **fields):
+        self._log("info", msg, exc_info, fields)
+
+    def warning(self, msg: str, exc_info: bool = False, **fields):
+        self._log("warning", msg, exc_info, fields)
+
+    def error(self, msg: str, exc_info: bool = False, **fields):
+        self._log("error", msg, exc_info, fields)
+
+
+class LogHub:
+    def __init__(self, size: int = LOG_RING_SIZE):
+        self.lock = threading.Lock()
+        self.records: deque = deque(maxlen=size)
+        self.seq = 0
+        self.default_level = LOG_LEVELS[LOG_DEFAULT_LEVEL]
+        self.stdout_level = LOG_LEVELS[LOG_STDOUT_LEVEL]
+        # 模块单独设置的级别（覆盖 default_level）
+        self.module_levels: Dict[str, int] = {}
+        self.loggers: Dict[str, ModuleLogger] = {}
+
+    def logger(self, module: str) -> ModuleLogger:
+        with self.lock:
+            log = self.loggers.get(module)
+            if log is None:
+                log = self.loggers[module] = ModuleLogger(self, module,
+                                                          self.module_levels.get(module, self.default_level))
+            return log
+
+    def emit(self, module: str, level: str, msg: str, fields: Dict):
+        with self.lock:
+            self.seq += 1
+            record = {"seq": self.seq, "ts": round(time.time(), 3), "level": level, "module": module, "msg": msg}
+            if fields:
+                record["fields"] = fields
+            self.records.append(record)
+        if LOG_LEVELS[level] >= self.stdout_level:
+            print(f"[{module}] {msg}")
+            if "traceback" in fields:
+                print(fields["traceback"], end="")
+
+    def query(self, since: int = 0, level: str = "debug", module: Optional[str] = None,
+              limit: int = 200) -> List[Dict]:
+        min_level = LOG_LEVELS[level]
+        with self.lock:
+            records = [r for r in self.records
+                       if r["seq"] > since and LOG_LEVELS[r["level"]] >= min_level
+                       and (module is None or r["module"] == module)]
+        return records[-limit:] if limit > 0 else []
+
+    def configure(self, level: Optional[str] = None, modules: Optional[Dict[str, Optional[str]]] = None,
+                  stdout_level: Optional[str] = None):
+        """modules 里值为 None 表示该模块恢复默认级别。"""
+        with self.lock:
+            if level is not None:
+                self.default_level = LOG_LEVELS[level]
+            if stdout_level is not None:
+                self.stdout_level = LOG_LEVELS[stdout_level]
+            for module, module_level in (modules or {}).items():
+                if module_level is None:
+                    self.module_levels.pop(module, None)
+                else:
+                    self.module_levels[module] = LOG_LEVELS[module_level]
+            for module, log in self.loggers.items():
+                log.level = self.module_levels.get(module, self.default_level)
+
+    def config(self) -> Dict:
+        names = {v: k for k, v in LOG_LEVELS.items()}
+        with self.lock:
+            return {
+                "level": names[self.default_level],
+                "stdout_level": names[self.stdout_level],
+                "modules": {m: names[log.level] for m, log in sorted(self.loggers.items())},
+                "overrides": {m: names[v] for m, v in self.module_levels.items()},
+                "buffered": len(self.records),
+                "capacity": self.records.maxlen,
+                "last_seq": self.seq,
+            }
+
+
+log_hub = LogHub()
+adb_log = log_hub.logger("adb")
+profile_log = log_hub.logger("profile")
+devices_log = log_hub.logger("devices")
+displays_log = log_hub.logger("displays")
+connect_log = log_hub.logger("connect")
+capture_log = log_hub.logger("capture")
+screenshot_log = log_hub.logger("screenshot")
+stream_log = log_hub.logger("stream")
+accessibility_log = log_hub.logger("accessibility")
+hierarchy_log = log_hub.logger("hierarchy")
+prefetch_log = log_hub.logger("prefetch")
+
+
+class LogConfigRequest(BaseModel):
+    level: Optional[str] = None
+    stdout_level: Optional[str] = None
+    # 模块 -> 级别；null 表示恢复默认级别
+    modules: Optional[Dict[str, Optional[str]]] = None
+
+
+@app.get("/api/logs")
+def get_logs(since: int = 0, level: str = "debug", module: Optional[str] = None, limit: int = 200):
+    """环形缓冲里的最近日志（seq 递增，带上次拿到的最大 seq 作为 since 只取新的）。"""
+    if level not in LOG_LEVELS:
+        raise HTTPException(status_code=400, detail=f"Unknown level: {level}")
+    records = log_hub.query(since, level, module, limit)
+    return {"records": records, "last_seq": records[-1]["seq"] if records else since}
+
+
+@app.get("/api/logs/config")
+def get_log_config():
+    return log_hub.config()
+
+
+@app.post("/api/logs/config")
+def set_log_config(req: LogConfigRequest):
+    """调整全局 / 单个模块 / 终端输出的日志级别（debug / info / warning / error）。"""
+    levels = [req.level, req.stdout_level] + list((req.modules or {}).values())
+    for level in levels:
+        if level is not None and level not in LOG_LEVELS:
+            raise HTTPException(status_code=400, detail=f"Unknown level: {level}")
+    log_hub.configure(req.level, req.modules, req.stdout_level)
+    return log_hub.config()
+
+
+# --- ADB 传输层 ---
+# 所有 adb 调用都走这里：直接和 adb server 的 socket 对话，不再每次 fork 一个 adb 客户端进程。
+#   - shell：每台设备维护一个常驻 `exec:sh` 会话池，多条命令复用同一条连接（用结束标记分隔输出）
+#   - exec-out：二进制输出直接 recv_into 预分配的 bytearray，返回 memoryview，不做切片拷贝
+#   - host 命令（forward / connect / root）：用 adb server 协议直接发
+# 每次调用都记录耗时，见 /api/adb/stats。
+ADB_POOL_SIZE = 4
+ADB_EXEC_OUT_BUFSIZE = 256 * 1024
+_ADB_SESSION_MARK = "___CARUI_DONE_"
+
+
+class AdbServiceError(adbutils.AdbError):
+    """设备在线，但 adbd 拒绝了请求的 service。"""
+
+
+class AdbSessionClosed(EOFError):
+    """会话在命令发出之前就已经断开，命令肯定没有执行，可以换新会话重试。"""
+
+
+def _adb_open_service(serial: str, service: str, timeout: Optional[float]) -> adbutils.AdbConnection:
+    """连接 adb server 并切到指定设备的 service（host:transport 一次握手，不额外查询 server 版本）。"""
+    c = adb.make_connection(timeout=timeout)
+    try:
+        c.send_command("host:transport:" + serial)
+        c.check_okay()
+        c.send_command(service)
+        try:
+            c.check_okay()
+        except adbutils.AdbError as e:
+            raise AdbServiceError(f"{service.split(':')[0]}: {e}")
+    except Exception:
+        c.close()
+        raise
+    return c
+
+
+class AdbShellSession:
+    """常驻的 `exec:sh` 会话：同一条连接上串行执行命令。
+
+    exec: 服务没有 pty，输出是原始字节；stdout 和 stderr 分开返回。
+    """
+
+    def __init__(self, serial: str, timeout: float = 10):
+        self.serial = serial
+        self.conn = _adb_open_service(serial, "exec:sh", timeout)
+        self.buf = bytearray()
+        self.seq = 0
+        self.created_at = time.time()
+
+    def _closed_by_peer(self, sock) -> bool:
+        """发命令前看一眼连接是否已被对端关闭（设备重连/adbd 重启后池里的旧会话）。"""
+        try:
+            sock.setblocking(False)
+            try:
+                return sock.recv(1, socket.MSG_PEEK) == b""
+            finally:
+                sock.setblocking(True)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def run(self, cmd: str, timeout: float = 10) -> Tuple[int, bytes, bytes]:
+        """执行一条命令，返回 (exit code, stdout, stderr)。
+
+        会话在发命令前已断开时抛 AdbSessionClosed；命令发出之后的任何错误（含超时）原样抛出。
+        """
+        self.seq += 1
+        mark = f"{_ADB_SESSION_MARK}{self.seq}"
+        # ( ) 子 shell：命令里的 cd/export/exit 不会影响池里的会话；</dev/null 避免命令吃掉会话自己的 stdin。
+        # stdout 经 fd 3 原样输出，stderr 收进变量，等命令结束后放在退出码后面单独输出。
+        script = (
+            f"{{ _carui_err=$( ( {cmd}\n) </dev/null 2>&1 1>&3 ); }} 3>&1; "
+            f"printf '\\n%s %d\\n%s\\n%s\\n' {mark} $? \"$_carui_err\" {mark}E\n"
+        )
+        sock = self.conn.conn
+        if self._closed_by_peer(sock):
+            raise AdbSessionClosed("adb shell session closed")
+        sock.settimeout(timeout)
+        try:
+            sock.sendall(script.encode("utf-8"))
+        except socket.timeout:
+            raise
+        except OSError as e:
+            # 连接在写命令时被重置：命令不完整，shell 不会执行
+            raise AdbSessionClosed(f"adb shell session closed: {e}")
+
+        needle = f"\n{mark} ".encode("utf-8")
+        end_needle = f"\n{mark}E\n".encode("utf-8")
+        buf = self.buf
+        scan_from = 0
+        while True:
+            end = buf.find(end_needle, scan_from)
+            if end != -1:
+                break
+            scan_from = max(0, len(buf) - len(end_needle))
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise EOFError("adb shell session closed")
+            buf += chunk
+        idx = buf.find(needle, 0, end)
+        code_end = buf.find(b"\n", idx + len(needle))
+        stdout = bytes(buf[:idx])
+        code = int(buf[idx + len(needle):code_end].strip() or b"1")
+        stderr = bytes(buf[code_end + 1:end])
+        del buf[:end + len(end_needle)]
+        return code, stdout, stderr
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class AdbTransportPool:
+    """按设备缓存 shell 会话，并记录每次 adb 调用的耗时。"""
+
+    def __init__(self, size: int = ADB_POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle: Dict[str, List[AdbShellSession]] = {}
+        # 不支持 exec:sh 的设备（很老的 adbd），退回一次性 shell:
+        self.no_exec: Dict[str, str] = {}
+        self.opened: Dict[str, int] = {}
+        # (serial, kind) -> 统计
+        self.stats: Dict[Tuple[str, str], Dict] = {}
+        # exec-out 命令上次的输出大小，用于预分配 buffer
+        self.size_hints: Dict[Tuple[str, str], int] = {}
+
+    def record(self, serial: str, kind: str, cmd: str, started: float, ok: bool):
+        elapsed_ms = (time.time() - started) * 1000
+        with self.lock:
+            s = self.stats.setdefault((serial, kind), {
+                "calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0, "last_cmd": "",
+            })
+            s["calls"] += 1
+            s["errors"] += 0 if ok else 1
+            s["total_ms"] += elapsed_ms
+            s["max_ms"] = max(s["max_ms"], elapsed_ms)
+            s["last_ms"] = elapsed_ms
+            s["last_cmd"] = cmd[:200]
+
+    def _acquire(self, serial: str, timeout: float) -> Tuple[AdbShellSession, bool]:
+        with self.lock:
+            sessions = self.idle.get(serial)
+            if sessions:
+                return sessions.pop(), True
+        session = AdbShellSession(serial, timeout)
+        with self.lock:
+            self.opened[serial] = self.opened.get(serial, 0) + 1
+        return session, False
+
+    def _release(self, session: AdbShellSession):
+        with self.lock:
+            sessions = self.idle.setdefault(session.serial, [])
+            if len(sessions) < self.size:
+                sessions.append(session)
+                return
+        session.close()
+
+    def shell(self, serial: str, cmd: str, timeout: float = 10) -> Tuple[int, bytes, bytes]:
+        """在常驻会话里执行 shell 命令，返回 (exit code, stdout, stderr)。
+
+        只有会话在命令发出前就已断开时才换新会话重试；超时或已经读到输出后不重试，
+        避免 input tap 之类的命令被执行两次。
+        """
+        started = time.time()
+        ok = False
+        try:
+            if serial in self.no_exec:
+                out = self.shell_oneshot(serial, cmd, timeout, record=False)
+                ok = True
+                return 0, out, b""
+            for _ in range(2):
+                try:
+                    session, reused = self._acquire(serial, timeout)
+                except AdbServiceError as e:
+                    # adbd 不认识 exec: 服务
+                    self.no_exec[serial] = str(e)
+                    adb_log.warning(f"⚠️ {serial} 不支持 exec:sh，退回一次性 shell: ({e})")
+                    out = self.shell_oneshot(serial, cmd, timeout, record=False)
+                    ok = True
+                    return 0, out, b""
+                try:
+                    code, out, err = session.run(cmd, timeout)
+                except AdbSessionClosed:
+                    session.close()
+                    # 池里的旧会话已经断了（设备重连/adbd 重启），命令没发出去，换新会话重试一次
+                    if reused:
+                        continue
+                    raise
+                except Exception:
+                    session.close()
+                    raise
+                self._release(session)
+                ok = True
+                return code, out, err
+            raise EOFError("adb shell session closed")
+        finally:
+            self.record(serial, "shell", cmd, started, ok)
+
+    def shell_oneshot(self, serial: str, cmd: str, timeout: float = 10, record: bool = True) -> bytes:
+        """一次性 `shell:` 服务（有 pty 转换，只在需要和 `adb shell` 行为完全一致时使用）。"""
+        started = time.time()
+        ok = False
+        try:
+            with _adb_open_service(serial, "shell:" + cmd, timeout) as c:
+                out = c.read_until_close(encoding=None)
+            ok = True
+            return out
+        finally:
+            if record:
+                self.record(serial, "shell:", cmd, started, ok)
+
+    def exec_out(self, serial: str, cmd: str, timeout: float = 10) -> memoryview:
+        """exec: 服务读取原始二进制输出，直接写进预分配的 bytearray。"""
+        started = time.time()
+        ok = False
+        hint_key = (serial, cmd)
+        try:
+            with _adb_open_service(serial, "exec:" + cmd, timeout) as c:
+                sock = c.conn
+                buf = bytearray(self.size_hints.get(hint_key, ADB_EXEC_OUT_BUFSIZE))
+                view = memoryview(buf)
+                n = 0
+                while True:
+                    if n == len(buf):
+                        view.release()
+                        buf.extend(bytes(len(buf)))
+                        view = memoryview(buf)
+                    got = sock.recv_into(view[n:])
+                    if not got:
+                        break
+                    n += got
+            # 多留一点余量，下次通常一次就够
+            self.size_hints[hint_key] = n + 4096
+            ok = True
+            return view[:n]
+        finally:
+            self.record(serial, "exec-out", cmd, started, ok)
+
+    def host(self, serial: str, kind: str, fn, *args):
+        """host 命令（forward / connect 等）：只负责计时。"""
+        started = time.time()
+        ok = False
+        try:
+            result = fn(*args)
+            ok = True
+            return result
+        finally:
+            self.record(serial, kind, " ".join(str(a) for a in args), started, ok)
+
+    def close(self, serial: str):
+        with self.lock:
+            sessions = self.idle.pop(serial, [])
+            self.no_exec.pop(serial, None)
+            for key in [k for k in self.size_hints if k[0] == serial]:
+                del self.size_hints[key]
+        for session in sessions:
+            session.close()
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            calls = []
+            for (serial, kind), s in sorted(self.stats.items()):
+                item = {"serial": serial, "kind": kind}
+                item.update(s)
+                item["avg_ms"] = round(s["total_ms"] / s["calls"], 2) if s["calls"] else 0.0
+                item["total_ms"] = round(s["total_ms"], 2)
+                item["max_ms"] = round(s["max_ms"], 2)
+                item["last_ms"] = round(s["last_ms"], 2)
+                calls.append(item)
+            return {
+                "pool_size": self.size,
+                "idle_sessions": {k: len(v) for k, v in self.idle.items()},
+                "opened_sessions": dict(self.opened),
+                "no_exec": dict(self.no_exec),
+                "calls": calls,
+            }
+
+
+adb_pool = AdbTransportPool()
+
+
+def _completed(args, code: int, stdout, stderr="", text: bool = True) -> subprocess.CompletedProcess:
+    if text and isinstance(stdout, (bytes, bytearray, memoryview)):
+        stdout = bytes(stdout).decode("utf-8", errors="replace")
+    if text and isinstance(stderr, (bytes, bytearray, memoryview)):
+        stderr = bytes(stderr).decode("utf-8", errors="replace")
+    return subprocess.CompletedProcess(args, code, stdout, stderr)
+
+
+def _adb_run(args: List[str], timeout: int = 10, text: bool = True) -> subprocess.CompletedProcess:
+    """按 `adb ...` 命令行参数执行，常见命令走连接池，其余（install 等）才 fork adb 客户端。
+
+    返回值和 subprocess.run(capture_output=True) 一致；失败时不抛异常，returncode != 0。
+    """
+    rest = list(args[1:]) if args and args[0] == "adb" else list(args)
+    serial = None
+    if len(rest) >= 2 and rest[0] == "-s":
+        serial, rest = rest[1], rest[2:]
+    verb = rest[0] if rest else ""
+    try:
+        if serial and verb == "shell" and len(rest) > 1:
+            # 和 adb 客户端一样：多个参数用空格拼起来交给设备端 shell 解析
+            code, out, err = adb_pool.shell(serial, " ".join(rest[1:]), timeout=timeout)
+            return _completed(args, code, out, err, text=text)
+        if serial and verb == "exec-out" and len(rest) > 1:
+            out = adb_pool.exec_out(serial, " ".join(rest[1:]), timeout=timeout)
+            return _completed(args, 0, out if text else bytes(out), b"" if not text else "", text=text)
+        if serial and verb == "forward" and len(rest) == 3:
+            adb_pool.host(serial, "forward", adb.forward, serial, rest[1], rest[2])
+            return _completed(args, 0, "" if text else b"", "" if text else b"", text=text)
+        if serial and verb == "root" and len(rest) == 1:
+            out = adb_pool.host(serial, "root", _adb_root, serial, timeout)
+            return _completed(args, 0, out, "" if text else b"", text=text)
+        if verb == "connect" and len(rest) == 2:
+            out = adb_pool.host(rest[1], "connect", adb.connect, rest[1], timeout)
+            return _completed(args, 0, out, "" if text else b"", text=text)
+    except Exception as e:
+        err = str(e) or type(e).__name__
+        adb_log.warning(f"⚠️ {' '.join(args)} 失败: {err}")
+        return _completed(args, 1, "" if text else b"", err if text else err.encode(), text=text)
+
+    started = time.time()
+    ok = False
+    try:
+        result = subprocess.run(args, capture_output=True, text=text, timeout=timeout, check=False)
+        ok = result.returncode == 0
+        return result
+    finally:
+        adb_pool.record(serial or "-", "subprocess", " ".join(args), started, ok)
+
+
+def _adb_root(serial: str, timeout: float) -> bytes:
+    with _adb_open_service(serial, "root:", timeout) as c:
+        out = c.read_until_close(encoding=None)
+    # adbd 以 root 重启，旧会话都失效了
+    adb_pool.close(serial)
+    return out
+
+
 def _adb_shell_run(serial: str, cmd: str, timeout: int = 6) -> subprocess.CompletedProcess:
     """Run adb shell and return CompletedProcess (stdout/stderr/returncode)."""
-    return subprocess.run(
-        ["adb", "-s", serial, "shell", cmd],
-        capture_output=True,
-        text=True,
-        timeout=timeout,
-        check=False,
-    )
+    return _adb_run(["adb", "-s", serial, "shell", cmd], timeout=timeout)
+
+
+@app.get("/api/adb/stats")
+def get_adb_stats():
+    """adb 调用耗时统计（按设备 + 调用类型）、连接池状态、请求合并计数和 UI 树版本。"""
+    stats = adb_pool.snapshot()
+    stats["single_flight"] = single_flight.snapshot()
+    stats["hierarchy_versions"] = hierarchy_versions.snapshot()
+    return stats
 
 
 def _is_accessibility_shell_supported(serial: str) -> bool:
@@ -98,6 +647,10 @@ def _is_accessibility_shell_supported(serial: str) -> bool:
     Some SS4 setups use `localhost:5559` as the real Android shell, while the
     original physical serial may not expose full Android shell commands.
     """
+    # 优先使用 profile 中批量探测到的 shell 能力，避免每次都跑一遍 settings
+    caps = get_device_profile(serial).get("capabilities") or {}
+    if "settings" in caps:
+        return bool(caps["settings"])
     try:
         r = _adb_shell_run(serial, "settings get secure accessibility_enabled", timeout=4)
         out = (r.stdout or "") + (r.stderr or "")
@@ -183,14 +736,7 @@ def pick_accessibility_shell_serial(serial: str) -> str:
 def _adb_shell(serial: str, cmd: str, timeout: int = 5) -> str:
     """Run adb shell command and return stdout (best-effort)."""
     try:
-        res = subprocess.run(
-            ["adb", "-s", serial, "shell", cmd],
-            capture_output=True,
-            text=True,
-            timeout=timeout,
-            check=False,
-        )
-        return (res.stdout or "")
+        return _adb_shell_run(serial, cmd, timeout=timeout).stdout or ""
     except Exception:
         return ""
 
@@ -256,125 +802,295 @@ def api_diagnose_secure():
         raise HTTPException(status_code=400, detail="Device not connected")
     return diagnose_secure_layers(current_serial)
 
+def parse_display_mapping(sf_output: str, display_output: str):
+    """解析 `dumpsys SurfaceFlinger --display-id` + `dumpsys display` 的输出。
+
+    Returns:
+      (mapping, info_list): mapping 为 logical id -> physical id，info_list 为 display 描述列表
+    """
+    new_mapping = {}
+    info_list = []
+
+    # Parse SurfaceFlinger for physical IDs and names
+    sf_matches = re.finditer(r"Display ([\d]{10,20}) .*?displayName=\"([^\"]+)\"", sf_output or "")
+    phys_to_name = {m.group(1): m.group(2) for m in sf_matches}
+
+    # Parse dumpsys display for Logical to Physical mapping
+    devices_blocks = (display_output or "").split("Display Device ")
+    for block in devices_blocks[1:]:
+        id_match = re.search(r"mDisplayId=([\d]+)", block)
+        unique_match = re.search(r"mUniqueId=local:([\d]{10,20})", block)
+        if id_match and unique_match:
+            logical = id_match.group(1)
+            physical = unique_match.group(1)
+            new_mapping[logical] = physical
+
+            name = phys_to_name.get(physical, f"Display {logical}")
+            # Try to find resolution
+            res_match = re.search(r"([\d]+) x ([\d]+),", block)
+            res_str = ""
+            if res_match:
+                res_str = f" ({res_match.group(1)}x{res_match.group(2)})"
+
+            desc = name
+            if logical == "0": desc = f"Main Driver ({name})"
+            elif logical == "2": desc = f"Passenger ({name})"
+            elif logical == "4": desc = f"Rear Left ({name})"
+            elif logical == "5": desc = f"Rear Right ({name})"
+
+            info_list.append({
+                "id": logical,
+                "physical_id": physical,
+                "description": f"{desc}{res_str}"
+            })
+    return new_mapping, info_list
+
+
 def refresh_display_mapping(serial: str):
-    global display_mapping, display_info_cache
+    """强制重新读取 display 映射，并写回设备 profile。"""
     try:
         # 1. Get Physical IDs from SurfaceFlinger
-        sf_output = subprocess.run(["adb", "-s", serial, "shell", "dumpsys SurfaceFlinger --display-id"], 
-                                   capture_output=True, text=True, timeout=5).stdout
+        sf_output = _adb_run(["adb", "-s", serial, "shell", "dumpsys SurfaceFlinger --display-id"], timeout=5).stdout
         
         # 2. Get Logical ID mapping from dumpsys display
-        display_output = subprocess.run(["adb", "-s", serial, "shell", "dumpsys display"], 
-                                       capture_output=True, text=True, timeout=5).stdout
-        
-        new_mapping = {}
-        info_list = []
-        
-        # Parse SurfaceFlinger for physical IDs and names
-        sf_matches = re.finditer(r"Display ([\d]{10,20}) .*?displayName=\"([^\"]+)\"", sf_output)
-        phys_to_name = {m.group(1): m.group(2) for m in sf_matches}
-        
-        # Parse dumpsys display for Logical to Physical mapping
-        devices_blocks = display_output.split("Display Device ")
-        for block in devices_blocks[1:]:
-            id_match = re.search(r"mDisplayId=([\d]+)", block)
-            unique_match = re.search(r"mUniqueId=local:([\d]{10,20})", block)
-            if id_match and unique_match:
-                logical = id_match.group(1)
-                physical = unique_match.group(1)
-                new_mapping[logical] = physical
-                
-                name = phys_to_name.get(physical, f"Display {logical}")
-                # Try to find resolution
-                res_match = re.search(r"([\d]+) x ([\d]+),", block)
-                res_str = ""
-                if res_match:
-                    res_str = f" ({res_match.group(1)}x{res_match.group(2)})"
-                
-                desc = name
-                if logical == "0": desc = f"Main Driver ({name})"
-                elif logical == "2": desc = f"Passenger ({name})"
-                elif logical == "4": desc = f"Rear Left ({name})"
-                elif logical == "5": desc = f"Rear Right ({name})"
-                
-                info_list.append({
-                    "id": logical, 
-                    "physical_id": physical,
-                    "description": f"{desc}{res_str}"
-                })
+        display_output = _adb_run(["adb", "-s", serial, "shell", "dumpsys display"], timeout=5).stdout
 
+        new_mapping, info_list = parse_display_mapping(sf_output, display_output)
         if not info_list:
             # 如果无法获取display信息，返回None让调用方使用静态fallback
             return None
 
-        display_mapping = new_mapping
-        display_info_cache = info_list
-        return info_list
+        with device_profiles_lock:
+            profile = device_profiles.get(serial)
+            if profile is not None:
+                profile["display_mapping"] = new_mapping
+                profile["displays"] = info_list
+        return [dict(x) for x in info_list]
     except Exception as e:
-        print(f"Error refreshing display mapping: {e}")
+        displays_log.error(f"❌ 刷新 display 映射失败: {e}")
         return None
 
-def detect_ss_device(serial: str) -> Optional[str]:
-    """Detect if device is SS series (SS4, SS3, etc.) by checking display.id property"""
+
+def parse_ss_type(display_id: str) -> Optional[str]:
+    """根据 ro.build.display.id 判断 SS 系列设备类型（SS4/SS3/SS2/SS5）。"""
+    # Direct string search - most reliable method
+    output_upper = (display_id or "").upper()
+    if 'SS4' in output_upper:
+        return "SS4"
+    elif 'SS3' in output_upper:
+        return "SS3"
+    elif 'SS2' in output_upper:
+        return "SS2"
+    elif 'SS5' in output_upper:
+        return "SS5"
+    return None
+
+
+# --- 设备 profile 注册表 ---
+# 连接设备时用一次批量 adb shell 拿到 SS 类型、型号、SDK、display 映射和 shell 能力，
+# 之后所有接口都读这里，而不是每次请求都 getprop/dumpsys。
+# 设备断开/重启（track-devices 事件）时失效，下次访问重新获取。
+device_profiles: Dict[str, Dict] = {}
+device_profiles_lock = threading.Lock()
+device_tracker_started = False
+# 获取失败的设备在 PROFILE_FAILURE_TTL 内直接返回最小 profile，不在每次调用时都等满超时重试
+PROFILE_FAILURE_TTL = 10.0
+# serial -> (失败时间, 最小 profile)
+device_profile_failures: Dict[str, Tuple[float, Dict]] = {}
+
+# 批量探测时需要检查的 shell 命令
+PROFILE_SHELL_COMMANDS = ["settings", "pm", "uiautomator", "screencap", "input"]
+_PROFILE_MARK = "___CARUI_PROFILE_"
+
+
+def _build_profile_command() -> str:
+    sections = [
+        ("display_id", "getprop ro.build.display.id"),
+        ("model", "getprop ro.product.model"),
+        ("sdk", "getprop ro.build.version.sdk"),
+        ("boot_id", "cat /proc/sys/kernel/random/boot_id"),
+        (
+            "commands",
+            "for c in " + " ".join(PROFILE_SHELL_COMMANDS)
+            + "; do command -v $c >/dev/null 2>&1 && echo $c; done",
+        ),
+        ("surfaceflinger", "dumpsys SurfaceFlinger --display-id"),
+        ("display", "dumpsys display"),
+    ]
+    parts = []
+    for name, cmd in sections:
+        parts.append(f"echo {_PROFILE_MARK}{name}")
+        parts.append(f"{cmd} 2>/dev/null")
+    return "; ".join(parts)
+
+
+def _split_profile_output(output: str) -> Dict[str, str]:
+    sections: Dict[str, str] = {}
+    current = None
+    buf: List[str] = []
+    for line in (output or "").splitlines():
+        if line.startswith(_PROFILE_MARK):
+            if current is not None:
+                sections[current] = "\n".join(buf)
+            current = line[len(_PROFILE_MARK):].strip()
+            buf = []
+        elif current is not None:
+            buf.append(line)
+    if current is not None:
+        sections[current] = "\n".join(buf)
+    return sections
+
+
+def fetch_device_profile(serial: str) -> Dict:
+    """一次 adb shell 往返获取设备 profile。"""
+    t0 = time.time()
+    result = _adb_run(["adb", "-s", serial, "shell", _build_profile_command()], timeout=15)
+    if result.returncode != 0 and not result.stdout:
+        raise Exception(f"profile probe failed on {serial}: {(result.stderr or '').strip()}")
+
+    sections = _split_profile_output(result.stdout)
+    display_id = sections.get("display_id", "").strip()
+    profile_log.info(f"📱 Device: {serial}")
+    profile_log.info(f"📋 Display ID: '{display_id}'")
+    profile_log.debug(f"🔍 Raw repr: {repr(display_id)}")
+    commands = set(sections.get("commands", "").split())
+    mapping, displays = parse_display_mapping(sections.get("surfaceflinger", ""), sections.get("display", ""))
+
+    profile = {
+        "serial": serial,
+        "display_id": display_id,
+        "ss_type": parse_ss_type(display_id),
+        "model": sections.get("model", "").strip() or "Unknown",
+        "sdk": sections.get("sdk", "").strip() or "Unknown",
+        "boot_id": sections.get("boot_id", "").strip(),
+        "display_mapping": mapping,
+        "displays": displays,
+        "capabilities": {name: (name in commands) for name in PROFILE_SHELL_COMMANDS},
+        "fetched_at": time.time(),
+        "fetch_ms": int((time.time() - t0) * 1000),
+    }
+    profile_log.info(f"✅ {serial}: ss_type={profile['ss_type']}, model={profile['model']}, "
+                     f"sdk={profile['sdk']}, displays={len(displays)}, {profile['fetch_ms']}ms")
+    return profile
+
+
+def get_device_profile(serial: str, refresh: bool = False) -> Dict:
+    """读取设备 profile；不存在（或 refresh=True）时才访问设备。
+
+    获取失败时返回一个最小 profile（只在 PROFILE_FAILURE_TTL 内复用），调用方按“未知设备”处理。
+    """
+    if not refresh:
+        with device_profiles_lock:
+            cached = device_profiles.get(serial)
+            failure = device_profile_failures.get(serial)
+        if cached is not None:
+            return cached
+        if failure is not None and time.time() - failure[0] < PROFILE_FAILURE_TTL:
+            return failure[1]
     try:
-        # Use getprop directly to get ro.build.display.id
-        result = subprocess.run(
-            ["adb", "-s", serial, "shell", "getprop", "ro.build.display.id"],
-            capture_output=True, text=True, timeout=5
-        )
-        
-        if result.returncode != 0:
-            print(f"[SS_DETECT] ❌ Failed to get display.id for {serial}: {result.stderr}")
-            return None
-            
-        output = result.stdout.strip()
-        print(f"[SS_DETECT] 📱 Device: {serial}")
-        print(f"[SS_DETECT] 📋 Display ID: '{output}'")
-        print(f"[SS_DETECT] 🔍 Raw repr: {repr(output)}")
-        
-        # Convert to uppercase for easier matching
-        output_upper = output.upper()
-        print(f"[SS_DETECT] 🔠 Uppercase: '{output_upper}'")
-        
-        # Direct string search - most reliable method
-        if 'SS4' in output_upper:
-            print(f"[SS_DETECT] ✅✅✅ Detected SS4 device (string match): {serial}")
-            return "SS4"
-        elif 'SS3' in output_upper:
-            print(f"[SS_DETECT] ✅✅✅ Detected SS3 device (string match): {serial}")
-            return "SS3"
-        elif 'SS2' in output_upper:
-            print(f"[SS_DETECT] ✅✅✅ Detected SS2 device (string match): {serial}")
-            return "SS2"
-        elif 'SS5' in output_upper:
-            print(f"[SS_DETECT] ✅✅✅ Detected SS5 device (string match): {serial}")
-            return "SS5"
-        else:
-            print(f"[SS_DETECT] ❌ No SS device pattern found")
-            print(f"[SS_DETECT] 💡 If this should be an SS device, check the display.id format")
-        
-        return None
+        profile = fetch_device_profile(serial)
     except Exception as e:
-        print(f"[SS_DETECT] ⚠️ Exception occurred: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
+        profile_log.warning(f"⚠️ 获取 {serial} profile 失败: {e}")
+        fallback = {
+            "serial": serial,
+            "display_id": "",
+            "ss_type": None,
+            "model": "Unknown",
+            "sdk": "Unknown",
+            "boot_id": "",
+            "display_mapping": {},
+            "displays": [],
+            "capabilities": {},
+        }
+        with device_profiles_lock:
+            device_profile_failures[serial] = (time.time(), fallback)
+        return fallback
+    with device_profiles_lock:
+        device_profile_failures.pop(serial, None)
+        old = device_profiles.get(serial)
+        if old and old.get("boot_id") and old.get("boot_id") != profile.get("boot_id"):
+            profile_log.info(f"🔁 {serial} boot_id 变化，设备已重启")
+        device_profiles[serial] = profile
+    return profile
+
+
+def invalidate_device_profile(serial: str, reason: str = ""):
+    with device_profiles_lock:
+        removed = device_profiles.pop(serial, None)
+        # 设备状态变了（如重新上线），之前的失败不再算数
+        device_profile_failures.pop(serial, None)
+    if removed is not None:
+        profile_log.info(f"🗑️ 失效 {serial} profile ({reason})")
+
+
+def _device_tracker_loop():
+    """监听 adb track-devices：设备断开/重连（含重启）时使 profile 失效。"""
+    while True:
+        try:
+            for event in adb.track_devices():
+                # 设备断开/重连后旧的 adb 会话都不可用了
+                adb_pool.close(event.serial)
+                hierarchy_versions.forget(event.serial)
+                hierarchy_cache.forget(event.serial)
+                prefetcher.forget(event.serial)
+                accessibility_events.forget(event.serial)
+                if not event.present or event.status != "device":
+                    invalidate_device_profile(event.serial, f"status={event.status}")
+                else:
+                    # 重新上线（可能是重启），旧 profile 不可信
+                    invalidate_device_profile(event.serial, "reconnected")
+        except Exception as e:
+            profile_log.warning(f"⚠️ track-devices 中断: {e}，2s后重试")
+            # adb server 重启期间无法确定设备状态，全部失效
+            with device_profiles_lock:
+                device_profiles.clear()
+                device_profile_failures.clear()
+        time.sleep(2)
+
+
+def start_device_tracker():
+    global device_tracker_started
+    if device_tracker_started:
+        return
+    device_tracker_started = True
+    threading.Thread(target=_device_tracker_loop, name="device-tracker", daemon=True).start()
+
+
+@app.get("/api/device/profile")
+def api_device_profile(serial: Optional[str] = None, refresh: bool = False):
+    """返回设备 profile（SS 类型 / 型号 / SDK / display 映射 / shell 能力）。"""
+    target_serial = serial or current_serial
+    if not target_serial:
+        raise HTTPException(status_code=400, detail="Device not connected")
+    return get_device_profile(target_serial, refresh=refresh)
+
+
+def detect_ss_device(serial: str) -> Optional[str]:
+    """Detect if device is SS series (SS4, SS3, etc.) from the cached device profile"""
+    return get_device_profile(serial).get("ss_type")
 
 @app.get("/api/devices")
 def get_devices():
     global ss4_localhost_mapping
     try:
         devices = []
-        for d in adb.device_list():
-            model = d.prop.get("ro.product.model", "Unknown")
-            
+        device_list = adb.device_list()
+
+        # 已经不在 adb 列表里的设备：profile 失效
+        online = {d.serial for d in device_list}
+        with device_profiles_lock:
+            stale = [s for s in device_profiles if s not in online]
+        for s in stale:
+            invalidate_device_profile(s, "disconnected")
+
+        for d in device_list:
             # 检查该设备是否已经被初始化为localhost:5559
             # 如果该serial作为original_serial存在于映射表中，说明已被初始化，跳过
             is_already_initialized = False
             for localhost_serial, mapping_info in ss4_localhost_mapping.items():
                 if mapping_info.get("original_serial") == d.serial:
                     is_already_initialized = True
-                    print(f"[GET_DEVICES] 🚫 跳过已初始化设备 {d.serial} (已转换为 {localhost_serial})")
+                    devices_log.info(f"🚫 跳过已初始化设备 {d.serial} (已转换为 {localhost_serial})")
                     break
             
             # 如果设备已被初始化，不显示在列表中
@@ -384,9 +1100,10 @@ def get_devices():
             # 特殊处理：如果是localhost:5559，检查映射表
             if d.serial == "localhost:5559" and d.serial in ss4_localhost_mapping:
                 ss_type = ss4_localhost_mapping[d.serial]["type"]  # 从字典中提取type
-                print(f"[GET_DEVICES] 从映射表识别 {d.serial} 为 {ss_type}")
+                devices_log.debug(f"从映射表识别 {d.serial} 为 {ss_type}")
             else:
                 ss_type = detect_ss_device(d.serial)
+            model = get_device_profile(d.serial).get("model", "Unknown")
             
             # 判断是否需要初始化
             # 如果是SS4设备且不是localhost:5559，说明需要初始化
@@ -401,7 +1118,7 @@ def get_devices():
             devices.append(device_info)
         return devices
     except Exception as e:
-        print(f"Error listing devices: {e}")
+        devices_log.error(f"❌ 获取设备列表失败: {e}")
         return []
 
 class ConnectRequest(BaseModel):
@@ -417,52 +1134,47 @@ def init_ss4_device(req: SS4InitRequest):
     global ss4_localhost_mapping
     try:
         serial = req.serial
-        print(f"Initializing SS4 device: {serial}")
+        connect_log.info(f"🔧 初始化SS4设备: {serial}")
         
         # Step 1: adb root
-        result = subprocess.run(["adb", "-s", serial, "root"], 
-                              capture_output=True, text=True, timeout=10)
-        print(f"adb root: {result.stdout}")
+        result = _adb_run(["adb", "-s", serial, "root"], timeout=10)
+        connect_log.info(f"adb root: {result.stdout.strip()}")
         if result.returncode != 0:
-            print(f"Warning: adb root failed: {result.stderr}")
+            connect_log.warning(f"⚠️ adb root 失败: {result.stderr.strip()}")
         
         # Wait a bit for root to take effect
         import time
         time.sleep(1)
         
         # Step 2: adb shell adbconnect.sh
-        result = subprocess.run(["adb", "-s", serial, "shell", "adbconnect.sh"], 
-                              capture_output=True, text=True, timeout=10)
-        print(f"adbconnect.sh: {result.stdout}")
+        result = _adb_run(["adb", "-s", serial, "shell", "adbconnect.sh"], timeout=10)
+        connect_log.info(f"adbconnect.sh: {result.stdout.strip()}")
         if result.returncode != 0:
-            print(f"Warning: adbconnect.sh failed: {result.stderr}")
+            connect_log.warning(f"⚠️ adbconnect.sh 失败: {result.stderr.strip()}")
         
         time.sleep(1)
         
         # Step 3: adb forward tcp:5559 tcp:5557
-        result = subprocess.run(["adb", "-s", serial, "forward", "tcp:5559", "tcp:5557"], 
-                              capture_output=True, text=True, timeout=10)
-        print(f"adb forward: {result.stdout}")
+        result = _adb_run(["adb", "-s", serial, "forward", "tcp:5559", "tcp:5557"], timeout=10)
+        connect_log.info(f"adb forward: {result.stdout.strip()}")
         if result.returncode != 0:
             raise Exception(f"adb forward failed: {result.stderr}")
         
         time.sleep(1)
         
         # Step 4: adb connect localhost:5559
-        result = subprocess.run(["adb", "connect", "localhost:5559"], 
-                              capture_output=True, text=True, timeout=10)
-        print(f"adb connect: {result.stdout}")
+        result = _adb_run(["adb", "connect", "localhost:5559"], timeout=10)
+        connect_log.info(f"adb connect: {result.stdout.strip()}")
         if result.returncode != 0:
-            print(f"Warning: adb connect failed: {result.stderr}")
+            connect_log.warning(f"⚠️ adb connect 失败: {result.stderr.strip()}")
         
         time.sleep(2)
         
         # Step 5: adb -s localhost:5559 root
-        result = subprocess.run(["adb", "-s", "localhost:5559", "root"], 
-                              capture_output=True, text=True, timeout=10)
-        print(f"adb root (localhost): {result.stdout}")
+        result = _adb_run(["adb", "-s", "localhost:5559", "root"], timeout=10)
+        connect_log.info(f"adb root (localhost): {result.stdout.strip()}")
         if result.returncode != 0:
-            print(f"Warning: final root failed: {result.stderr}")
+            connect_log.warning(f"⚠️ localhost:5559 adb root 失败: {result.stderr.strip()}")
         
         time.sleep(1)
         
@@ -471,7 +1183,7 @@ def init_ss4_device(req: SS4InitRequest):
             "type": "SS4",
             "original_serial": serial  # 保存原始物理设备序列号
         }
-        print(f"[INIT_SS4] ✅ 已记录映射: localhost:5559 -> SS4 (原始序列号: {serial})")
+        devices_log.info(f"✅ 已记录映射: localhost:5559 -> SS4 (原始序列号: {serial})")
         
         return {
             "status": "success",
@@ -479,12 +1191,12 @@ def init_ss4_device(req: SS4InitRequest):
             "new_serial": "localhost:5559"
         }
     except Exception as e:
-        print(f"SS4 initialization error: {e}")
+        connect_log.error(f"❌ SS4 初始化失败: {e}")
         raise HTTPException(status_code=500, detail=f"SS4 initialization failed: {str(e)}")
 
 @app.get("/api/displays")
-def get_displays(serial: Optional[str] = None):
-    global current_serial, display_info_cache, ss4_localhost_mapping
+def get_displays(serial: Optional[str] = None, refresh: bool = False):
+    global current_serial, ss4_localhost_mapping
     target_serial = serial or current_serial
     
     if not target_serial:
@@ -495,64 +1207,61 @@ def get_displays(serial: Optional[str] = None):
     ss_type = None
     if target_serial == "localhost:5559" and target_serial in ss4_localhost_mapping:
         ss_type = ss4_localhost_mapping[target_serial]["type"]  # 从字典中提取type
-        print(f"[DISPLAYS] 从映射表识别 {target_serial} 为 {ss_type}")
+        displays_log.debug(f"从映射表识别 {target_serial} 为 {ss_type}")
     else:
         # 直接检测设备类型（适用于未初始化的SS4设备）
         ss_type = detect_ss_device(target_serial)
-        print(f"[DISPLAYS] 通过getprop检测设备类型: {ss_type}")
+        displays_log.debug(f"通过getprop检测设备类型: {ss_type}")
     
-    print(f"[DISPLAYS] Device type: {ss_type}")
-    print(f"[DISPLAYS] Device serial: {target_serial}")
-    print(f"[DISPLAYS] 开始动态探测设备的display配置...")
+    displays_log.debug(f"Device type: {ss_type}")
+    displays_log.debug(f"Device serial: {target_serial}")
+    displays_log.debug(f"开始动态探测设备的display配置...")
     
-    # 尝试动态获取设备实际支持的display列表
-    res = refresh_display_mapping(target_serial)
+    # 尝试动态获取设备实际支持的display列表（来自 profile；refresh=True 时重新读取）
+    if refresh:
+        res = refresh_display_mapping(target_serial)
+    else:
+        res = [dict(x) for x in get_device_profile(target_serial).get("displays") or []]
     if res:
         # 只显示Display ID，不添加额外描述
-        print(f"[DISPLAYS] 从dumpsys获取到 {len(res)} 个display")
+        displays_log.info(f"从dumpsys获取到 {len(res)} 个display")
         for display in res:
             display_id = display["id"]
             display["description"] = f"Display {display_id}"
         return res
     
     # 如果无法获取，尝试通过screencap探测实际可用的display
-    print(f"[DISPLAYS] dumpsys方式失败，尝试探测可用display...")
+    displays_log.info(f"dumpsys方式失败，尝试探测可用display...")
     available_displays = []
     
     try:
-        d = adb.device(serial=target_serial)
         # 探测display 0-5，看哪些可用
         for display_id in range(6):
             try:
                 # 尝试快速截图测试display是否存在
-                result = subprocess.run(
-                    ["adb", "-s", target_serial, "shell", f"screencap -d {display_id} -p"],
-                    capture_output=True, 
-                    timeout=2,
-                    check=False
-                )
+                result = _adb_run(["adb", "-s", target_serial, "exec-out", f"screencap -d {display_id} -p"], timeout=2, text=False)
                 # 如果返回数据大于100字节且包含PNG头，说明display存在
                 if result.returncode == 0 and len(result.stdout) > 100 and b"\x89PNG" in result.stdout:
                     available_displays.append({
                         "id": str(display_id),
                         "description": f"Display {display_id}"
                     })
-                    print(f"[DISPLAYS] ✅ Display {display_id} 可用")
+                    displays_log.info(f"✅ Display {display_id} 可用")
                 else:
-                    print(f"[DISPLAYS] ❌ Display {display_id} 不可用或无响应")
+                    displays_log.warning(f"❌ Display {display_id} 不可用或无响应")
             except Exception as e:
-                print(f"[DISPLAYS] ⚠️ Display {display_id} 探测失败: {e}")
+                displays_log.warning(f"⚠️ Display {display_id} 探测失败: {e}")
                 continue
     except Exception as e:
-        print(f"[DISPLAYS] ⚠️ 探测过程出错: {e}")
+        displays_log.warning(f"⚠️ 探测过程出错: {e}")
     
     # 如果探测到了display，返回探测结果
     if available_displays:
-        print(f"[DISPLAYS] 探测成功，找到 {len(available_displays)} 个可用display")
+        displays_log.info(f"探测成功，找到 {len(available_displays)} 个可用display")
         return available_displays
     
     # 最后的fallback：至少返回display 0
-    print(f"[DISPLAYS] 所有方式都失败，返回最小配置 (Display 0)")
+    displays_log.info(f"所有方式都失败，返回最小配置 (Display 0)")
     return [{"id": "0", "description": "Display 0"}]
 
 @app.post("/api/connect")
@@ -561,18 +1270,21 @@ def connect_device(req: ConnectRequest):
     try:
         if req.serial:
             current_serial = req.serial
-            print(f"[CONNECT] 设置 current_serial 为: {current_serial}")
+            connect_log.info(f"设置 current_serial 为: {current_serial}")
         else:
             devices = adb.device_list()
             if not devices:
                 raise HTTPException(status_code=404, detail="No devices found")
             current_serial = devices[0].serial
-            print(f"[CONNECT] 自动选择第一个设备: {current_serial}")
+            connect_log.info(f"自动选择第一个设备: {current_serial}")
         
-        d = adb.device(serial=current_serial)
-        model = d.prop.get("ro.product.model", "Unknown")
+        # 连接时批量获取一次设备 profile，后续接口都从 registry 读取
+        profile = get_device_profile(current_serial, refresh=True)
+        model = profile.get("model", "Unknown")
+        # 后台 benchmark 各 display 的截图方式，首帧不必再现场探测
+        warm_capture_strategies(current_serial)
         
-        print(f"[CONNECT] ✅ 连接成功: {current_serial}, Model: {model}")
+        connect_log.info(f"✅ 连接成功: {current_serial}, Model: {model}")
         
         return {
             "status": "connected", 
@@ -580,951 +1292,3199 @@ def connect_device(req: ConnectRequest):
             "info": {
                 "productName": model,
                 "model": model,
-                "sdk": d.prop.get("ro.build.version.sdk", "Unknown")
+                "sdk": profile.get("sdk", "Unknown"),
+                "ss_type": profile.get("ss_type"),
             }
         }
     except Exception as e:
-        print(f"[CONNECT] ❌ 连接失败: {e}")
+        connect_log.error(f"❌ 连接失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/screenshot")
-def get_screenshot(display: str = "0"):
-    global current_serial, display_mapping
-    if not current_serial:
-         raise HTTPException(status_code=400, detail="Device not connected")
-    
-    try:
-        print(f"[SCREENSHOT] 📸 请求截图 - Display ID: {display}, Device: {current_serial}")
-        
-        # Detect device type for special handling
-        ss_type = detect_ss_device(current_serial)
-        print(f"[SCREENSHOT] 🚗 设备类型: {ss_type}")
-        
-        # Use physical ID for screencap if available
-        phys_id = display_mapping.get(display, display)
-        print(f"[SCREENSHOT] 🔄 物理ID映射: {display} -> {phys_id}")
-        
-        raw_png = None
-        last_err = ""
-        d = adb.device(serial=current_serial)
-        
-        # 优化的命令尝试顺序 - SS2MAX前后排设备都能正确截图
-        cmd_variations = []
-        
-        # SS2/SS2MAX设备专用优化策略
-        if ss_type == "SS2":
-            print(f"[SCREENSHOT] 🚙 SS2/SS2MAX设备，使用优化截图策略")
-            
-            # Display 0 - 主屏优先使用最简命令
-            if display == "0":
-                print(f"[SCREENSHOT] 🎯 Display 0（主屏），使用简化命令")
-                cmd_variations.append("screencap -p")
-                cmd_variations.append(f"screencap -d {display} -p")
-                cmd_variations.append(f"screencap -p -d {display}")
-            else:
-                # Display 1, 2 等副屏 - 优先使用logical display ID
-                print(f"[SCREENSHOT] 🎯 Display {display}（副屏），优先logical ID")
-                cmd_variations.append(f"screencap -d {display} -p")
-                cmd_variations.append(f"screencap -p -d {display}")
-                
-                # 尝试physical ID（如果有映射）
-                if phys_id != display:
-                    print(f"[SCREENSHOT] 🔄 尝试物理ID: {phys_id}")
-                    cmd_variations.append(f"screencap -d {phys_id} -p")
-                    cmd_variations.append(f"screencap -p -d {phys_id}")
-        else:
-            # 其他设备（非SS2）的通用策略
-            if display == "0":
-                cmd_variations.append("screencap -p")
-            
-            # 优先logical ID
-            cmd_variations.append(f"screencap -d {display} -p")
-            cmd_variations.append(f"screencap -p -d {display}")
-            
-            # 然后physical ID
-            if phys_id != display:
-                cmd_variations.append(f"screencap -d {phys_id} -p")
-                cmd_variations.append(f"screencap -p -d {phys_id}")
+# --- 截图方式自动选择（capture autotuner） ---
+# 每个 (serial, display) 在首次截图/连接时探测一次：
+#   1) 先找出可用的 screencap 参数形式（无 -d / logical id / physical id）
+#   2) 再对该参数形式 benchmark 各种传输方式（exec-out PNG、shell PNG、raw framebuffer 等）
+# 之后直接使用最快的那一个；只有当它失败时才重新探测。
+capture_tuners: Dict[Tuple[str, str], Dict] = {}
+capture_tuners_lock = threading.Lock()
+# 每个 key 一把锁，避免并发请求同时跑探测
+_capture_probe_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+# screencap raw 输出的 pixel format -> (PIL rawmode, bytes per pixel)
+# 截图不需要 alpha，统一按 RGB 解码（X 表示忽略该字节），省掉一次 convert
+RAW_PIXEL_FORMATS = {
+    1: ("RGBX", 4),  # RGBA_8888
+    2: ("RGBX", 4),  # RGBX_8888
+    3: ("RGB", 3),   # RGB_888
+    5: ("BGRX", 4),  # BGRA_8888
+}
+RAW_PIXEL_FORMATS_BPP = {rawmode: bpp for rawmode, bpp in RAW_PIXEL_FORMATS.values()}
+
+# /api/screenshot 支持的输出格式 -> (PIL format, media type)
+SCREENSHOT_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+def _adb_exec_out(serial: str, cmd: str, timeout: float = 10) -> memoryview:
+    """通过 adb server 的 exec: 服务执行命令，返回原始二进制 stdout（无 pty 转换）。"""
+    return adb_pool.exec_out(serial, cmd, timeout=timeout)
+
+
+def _screencap_display_args(serial: str, display: str) -> List[str]:
+    """按优先级列出 screencap 的 display 参数形式。"""
+    profile = get_device_profile(serial)
+    phys_id = (profile.get("display_mapping") or {}).get(display, display)
+    args: List[str] = []
+    if display == "0":
+        args.append("")
+    # 优先logical ID
+    args.append(f"-d {display}")
+    # 然后physical ID
+    if phys_id != display:
+        args.append(f"-d {phys_id}")
+    return args
+
+
+def _capture_methods_for(serial: str, display: str, display_arg: str) -> List[Dict]:
+    """给定 display 参数形式，列出所有待 benchmark 的传输方式。"""
+    png_cmd = f"screencap -p {display_arg}".strip()
+    raw_cmd = f"screencap {display_arg}".strip()
+    methods = [
+        {"name": f"exec-out {png_cmd}", "transport": "exec-out", "cmd": png_cmd, "encoding": "png"},
+        {"name": f"shell {png_cmd}", "transport": "shell", "cmd": png_cmd, "encoding": "png"},
+        {"name": f"exec-out {raw_cmd}", "transport": "exec-out", "cmd": raw_cmd, "encoding": "raw"},
+        {"name": f"subprocess exec-out {png_cmd}", "transport": "subprocess", "cmd": png_cmd, "encoding": "png"},
+    ]
+    if display == "0":
+        # adbd framebuffer: 服务只支持主屏
+        methods.append({"name": "framebuffer:", "transport": "framebuffer", "cmd": "", "encoding": "image"})
+    return methods
+
+
+def parse_raw_screencap(data: bytes) -> Dict:
+    """解析 `screencap`（不带 -p）的原始输出：w/h/format(/dataspace) 头 + 像素数据。"""
+    if len(data) < 12:
+        raise Exception(f"raw screencap too small: {len(data)} bytes")
+    width, height, fmt = struct.unpack_from("<III", data, 0)
+    if fmt not in RAW_PIXEL_FORMATS:
+        raise Exception(f"unsupported raw pixel format: {fmt}")
+    rawmode, bpp = RAW_PIXEL_FORMATS[fmt]
+    pixel_bytes = width * height * bpp
+    # Android 12+ 在头部多了 4 字节 dataspace
+    header_len = len(data) - pixel_bytes
+    if header_len not in (12, 16):
+        raise Exception(f"raw screencap size mismatch: {len(data)} bytes for {width}x{height}x{bpp}")
+    return {
+        "width": width,
+        "height": height,
+        "rawmode": rawmode,
+        "offset": header_len,
+    }
 
-        # 使用adbutils执行命令（更快更稳定）
-        for cmd_str in cmd_variations:
-            try:
-                print(f"[SCREENSHOT] 🔧 尝试命令: {cmd_str}")
-                # 注意：不同版本的adbutils对shell()的返回值处理不同
-                # 新版本返回bytes，旧版本可能返回str
-                res = d.shell(cmd_str)
-                # 如果返回的是字符串，转换为bytes
-                if isinstance(res, str):
-                    res = res.encode('latin1')
-                if res and len(res) > 100:
-                    print(f"[SCREENSHOT] ✅ 成功！截图大小: {len(res)} bytes")
-                    raw_png = res
-                    break
-                else:
-                    print(f"[SCREENSHOT] ❌ 返回数据太小或为空: {len(res) if res else 0} bytes")
-            except Exception as e:
-                print(f"[SCREENSHOT] ❌ 命令失败: {e}")
-                last_err = str(e)
-                continue
 
-        # Subprocess fallback（兜底方案）
-        if not raw_png:
-            print(f"[SCREENSHOT] 🔄 使用subprocess fallback")
-            subprocess_variations = []
-            
-            # 构建subprocess命令列表
-            if ss_type == "SS2":
-                if display == "0":
-                    subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-p"])
-                subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-d", display, "-p"])
-                subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-p", "-d", display])
-                if phys_id != display:
-                    subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-d", phys_id, "-p"])
-            else:
-                if display == "0":
-                    subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-p"])
-                subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-d", display, "-p"])
-                subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-p", "-d", display])
-                if phys_id != display:
-                    subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-d", phys_id, "-p"])
-                    subprocess_variations.append(["adb", "-s", current_serial, "shell", "screencap", "-p", "-d", phys_id])
-            
-            for cmd in subprocess_variations:
-                print(f"[SCREENSHOT] 🔧 subprocess尝试: {' '.join(cmd)}")
-                result = subprocess.run(cmd, capture_output=True, check=False, timeout=10)
-                if result.returncode == 0 and result.stdout and len(result.stdout) > 100:
-                    print(f"[SCREENSHOT] ✅ subprocess成功！大小: {len(result.stdout)} bytes")
-                    raw_png = result.stdout
-                    break
-                if result.stderr:
-                    last_err = result.stderr.decode(errors='ignore')
-                    print(f"[SCREENSHOT] ❌ subprocess错误: {last_err}")
+def _run_capture_method(serial: str, method: Dict) -> Dict:
+    """执行一种截图方式，返回 frame dict（校验失败时抛异常）。"""
+    transport = method["transport"]
+    if transport == "framebuffer":
+        image = adb.device(serial=serial).framebuffer()
+        return {"encoding": "image", "image": image, "width": image.width, "height": image.height}
 
-        if not raw_png:
-             raise Exception(f"Failed to get screenshot for display {display} (Physical: {phys_id}). Last error: {last_err}")
-        
-        # 验证PNG格式
-        png_header = b"\x89PNG"
-        start_idx = raw_png.find(png_header)
-        if start_idx != -1:
-            raw_png = raw_png[start_idx:]
-            print(f"[SCREENSHOT] 🎨 PNG数据有效，起始位置: {start_idx}, 最终大小: {len(raw_png)} bytes")
-        else:
-            raise Exception("Invalid screenshot format: No PNG header found")
+    if transport == "exec-out":
+        data = _adb_exec_out(serial, method["cmd"])
+    elif transport == "shell":
+        data = memoryview(adb_pool.shell_oneshot(serial, method["cmd"]))
+    else:
+        # 兜底：fork 本机 adb 客户端（adb server 协议异常时仍可用），同样计入 adb 调用统计
+        started = time.time()
+        result = subprocess.run(
+            ["adb", "-s", serial, "exec-out", method["cmd"]],
+            capture_output=True, check=False, timeout=10,
+        )
+        adb_pool.record(serial, "subprocess", method["cmd"], started, result.returncode == 0)
+        if result.returncode != 0:
+            raise Exception(result.stderr.decode(errors="ignore").strip() or f"exit {result.returncode}")
+        data = result.stdout
 
-        return StreamingResponse(io.BytesIO(raw_png), media_type="image/png")
-    except Exception as e:
-        print(f"[SCREENSHOT] ❌ 截图失败 display {display}: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    if not data or len(data) <= 100:
+        raise Exception(f"返回数据太小或为空: {len(data) if data else 0} bytes")
 
-def check_accessibility_service(serial: str) -> bool:
-    """检查辅助服务是否可用"""
-    try:
-        # 设置端口转发
-        fw = subprocess.run(
-            ["adb", "-s", serial, "forward", "tcp:8765", "tcp:8765"],
-            capture_output=True,
-            text=True,
-            timeout=3,
-            check=False,
-        )
-        if fw.returncode != 0:
-            print(f"[Accessibility] ⚠️ adb forward failed on {serial}: {fw.stderr.strip()}")
-        
-        if requests is None:
-            print("[Accessibility] ⚠️ Python requests not installed, cannot probe /api/status")
-            return False
+    if method["encoding"] == "raw":
+        info = parse_raw_screencap(data)
+        info.update({"encoding": "raw", "data": data})
+        return info
 
-        # 测试连接
-        response = requests.get("http://localhost:8765/api/status", timeout=2)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get("service") == "running":
-                print(f"[Accessibility] ✅ 辅助服务可用")
-                return True
-    except Exception as e:
-        print(f"[Accessibility] ⚠️ 辅助服务不可用(serial={serial}): {e}")
-    return False
+    # PNG: 校验头尾，shell 在旧设备上可能做 \n -> \r\n 转换导致数据损坏
+    # 只在开头一小段里找 PNG 头（shell 可能带前导输出），memoryview 切片不拷贝
+    data = memoryview(data)
+    start_idx = bytes(data[:64]).find(b"\x89PNG")
+    if start_idx == -1:
+        raise Exception("Invalid screenshot format: No PNG header found")
+    if start_idx:
+        data = data[start_idx:]
+    if b"IEND" not in bytes(data[-16:]):
+        raise Exception("Invalid screenshot format: PNG truncated or corrupted")
+    return {"encoding": "png", "data": data}
 
 
-def probe_accessibility_service(serial: str) -> Dict:
-    """Probe accessibility service and return details for diagnosis.
+def _benchmark_capture_method(serial: str, method: Dict) -> Dict:
+    """跑一次截图方式，返回 adb 传输耗时和服务端编码成 PNG 的耗时。
 
-    Returns:
-      {
-        ok: bool,
-        forward_ok: bool,
-        forward_stderr: str,
-        http_ok: bool,
-        http_error: str,
-        status_json: dict|None,
-      }
+    raw/framebuffer 传输快但要在服务端编码，PNG 透传不用编码；
+    只比传输耗时会偏向 raw，所以打分用两者之和（score_ms）。
     """
-    info: Dict = {
-        "ok": False,
-        "forward_ok": False,
-        "forward_stderr": "",
-        "http_ok": False,
-        "http_error": "",
-        "status_json": None,
+    t0 = time.time()
+    frame = _run_capture_method(serial, method)
+    t1 = time.time()
+    encode_frame(frame, "png")
+    t2 = time.time()
+    return {
+        "latency_ms": round((t1 - t0) * 1000, 1),
+        "encode_ms": round((t2 - t1) * 1000, 1),
+        "score_ms": round((t2 - t0) * 1000, 1),
     }
 
-    try:
-        fw = subprocess.run(
-            ["adb", "-s", serial, "forward", "tcp:8765", "tcp:8765"],
-            capture_output=True,
-            text=True,
-            timeout=3,
-            check=False,
-        )
-        info["forward_ok"] = fw.returncode == 0
-        info["forward_stderr"] = (fw.stderr or "").strip()
 
-        if requests is None:
-            info["http_error"] = "python requests not installed"
-            return info
+def probe_capture_strategy(serial: str, display: str) -> Dict:
+    """探测并 benchmark 当前 (serial, display) 可用的截图方式，记住（截图+编码）最快的那个。"""
+    results: List[Dict] = []
+    working: List[Dict] = []
+    chosen = None
+    best = None
+    working_arg = None
 
+    # 阶段1：找出可用的 display 参数形式（用 exec-out PNG 测试即可）
+    for display_arg in _screencap_display_args(serial, display):
+        method = _capture_methods_for(serial, display, display_arg)[0]
         try:
-            resp = requests.get("http://localhost:8765/api/status", timeout=2)
-            if resp.status_code == 200:
-                info["http_ok"] = True
-                try:
-                    info["status_json"] = resp.json()
-                except Exception:
-                    info["status_json"] = None
-            else:
-                info["http_error"] = f"HTTP {resp.status_code}"
+            timing = _benchmark_capture_method(serial, method)
+            results.append(dict(timing, name=method["name"], ok=True))
+            working.append(dict(method, **timing))
+            working_arg = display_arg
+            chosen, best = method, timing
+            break
         except Exception as e:
-            info["http_error"] = str(e)
-
-        info["ok"] = bool(info["http_ok"] and (info.get("status_json") or {}).get("service") == "running")
-        return info
-    except Exception as e:
-        info["http_error"] = str(e)
-        return info
-
-
-def probe_accessibility_service_any(serial: str) -> Dict:
-    """Probe possible serials and return the first successful result.
+            results.append({"name": method["name"], "ok": False, "error": str(e)})
+
+    # 阶段2：对可用参数形式 benchmark 其余传输方式；找不到时仍把所有组合都试一遍
+    arg_candidates = [working_arg] if working_arg is not None else _screencap_display_args(serial, display)
+    for display_arg in arg_candidates:
+        methods = _capture_methods_for(serial, display, display_arg)
+        for method in methods:
+            if chosen is not None and method["name"] == chosen["name"]:
+                continue
+            if working_arg is None and method is methods[0]:
+                continue  # 阶段1已经测过
+            try:
+                timing = _benchmark_capture_method(serial, method)
+                results.append(dict(timing, name=method["name"], ok=True))
+                working.append(dict(method, **timing))
+                if best is None or timing["score_ms"] < best["score_ms"]:
+                    chosen, best = method, timing
+            except Exception as e:
+                results.append({"name": method["name"], "ok": False, "error": str(e)})
 
-    Returns a dict with extra keys:
+    state = {
+        "serial": serial,
+        "display": display,
+        "method": chosen,
+        "latency_ms": best["latency_ms"] if best else None,
+        "encode_ms": best["encode_ms"] if best else None,
+        "score_ms": best["score_ms"] if best else None,
+        "avg_latency_ms": best["latency_ms"] if best else None,
+        "probed_at": time.time(),
+        "probe_results": results,
+        # 所有可用方式（按截图+编码总耗时排序），raw 模式从这里挑最快的 raw 方式
+        "working": sorted(working, key=lambda m: m["score_ms"]),
+        "frames": 0,
+        "failures": 0,
+    }
+    with capture_tuners_lock:
+        capture_tuners[(serial, display)] = state
+    if chosen:
+        capture_log.info(
+            f"🏁 {serial} display {display}: 选择 '{chosen['name']}' "
+            f"({best['latency_ms']:.0f}ms + 编码 {best['encode_ms']:.0f}ms)"
+        )
+    else:
+        capture_log.error(f"❌ {serial} display {display}: 没有可用的截图方式")
+    return state
+
+
+def _get_capture_state(serial: str, display: str, reprobe: bool = False) -> Dict:
+    key = (serial, display)
+    requested_at = time.time()
+    with capture_tuners_lock:
+        lock = _capture_probe_locks.setdefault(key, threading.Lock())
+        state = capture_tuners.get(key)
+    if state is not None and state.get("method") and not reprobe:
+        return state
+    with lock:
+        # 等锁期间可能已经被别的请求探测完，直接复用
+        with capture_tuners_lock:
+            state = capture_tuners.get(key)
+        if state is not None and state.get("method"):
+            if not reprobe or state.get("probed_at", 0) >= requested_at:
+                return state
+        return probe_capture_strategy(serial, display)
+
+
+def _pick_capture_method(state: Dict, prefer_raw: bool) -> Optional[Dict]:
+    """prefer_raw 时选最快的未压缩方式（raw screencap / framebuffer），没有则退回最快方式。"""
+    if prefer_raw:
+        for method in state.get("working") or []:
+            if method["encoding"] in ("raw", "image"):
+                return method
+    return state.get("method")
+
+
+def capture_frame(serial: str, display: str, prefer_raw: bool = False) -> Dict:
+    """用 autotuner 选中的方式截一帧；失败时重新探测一次再试。
+
+    prefer_raw=True 时优先拉取未压缩的 framebuffer，由服务端负责编码。
+    """
+    state = _get_capture_state(serial, display)
+    for attempt in range(2):
+        method = _pick_capture_method(state, prefer_raw)
+        if not method:
+            break
+        t0 = time.time()
+        try:
+            frame = _run_capture_method(serial, method)
+            ms = (time.time() - t0) * 1000
+            with capture_tuners_lock:
+                state["frames"] += 1
+                prev = state.get("avg_latency_ms") or ms
+                state["avg_latency_ms"] = round(prev * 0.8 + ms * 0.2, 1)
+            frame["method"] = method["name"]
+            frame["latency_ms"] = round(ms, 1)
+            return frame
+        except Exception as e:
+            capture_log.warning(f"⚠️ '{method['name']}' 失败: {e}，重新探测")
+            with capture_tuners_lock:
+                state["failures"] += 1
+            if attempt == 0:
+                state = _get_capture_state(serial, display, reprobe=True)
+    errors = [r.get("error") for r in state.get("probe_results", []) if not r.get("ok")]
+    raise Exception(f"Failed to get screenshot for display {display}. Last error: {errors[-1] if errors else ''}")
+
+
+def frame_to_image(frame: Dict) -> Image.Image:
+    """把 frame 解码成 PIL Image（raw 像素直接按 rawmode 解包为 RGB）。"""
+    if frame["encoding"] == "raw":
+        return Image.frombytes(
+            "RGB", (frame["width"], frame["height"]),
+            memoryview(frame["data"])[frame["offset"]:], "raw", frame["rawmode"],
+        )
+    if frame["encoding"] == "png":
+        return Image.open(io.BytesIO(frame["data"]))
+    return frame["image"]
+
+
+def encode_frame(frame: Dict, fmt: str = "png", quality: int = 80, scale: float = 1.0) -> Tuple[bytes, str]:
+    """在服务端编码 frame，返回 (bytes, media_type)。
+
+    设备已经给了 PNG 且不需要缩放时直接透传，不做任何解码。
+    """
+    pil_format, media_type = SCREENSHOT_FORMATS[fmt]
+    if frame["encoding"] == "png" and pil_format == "PNG" and scale >= 1.0:
+        return bytes(frame["data"]), media_type
+
+    image = frame_to_image(frame)
+    if scale < 1.0:
+        size = (max(1, int(round(image.width * scale))), max(1, int(round(image.height * scale))))
+        image = image.resize(size, Image.BILINEAR)
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buf = io.BytesIO()
+    if pil_format == "PNG":
+        # 本地编码追求速度，压缩率次要
+        image.save(buf, format="PNG", compress_level=1)
+    elif pil_format == "JPEG":
+        image.save(buf, format="JPEG", quality=quality)
+    else:
+        # method=0 最快，车机截图实时预览足够
+        image.save(buf, format="WEBP", quality=quality, method=0)
+    return buf.getvalue(), media_type
+
+
+def frame_size(frame: Dict) -> Tuple[int, int]:
+    """帧的原始分辨率；PNG 直接读 IHDR，不解码。"""
+    if "width" in frame:
+        return frame["width"], frame["height"]
+    if frame["encoding"] == "png":
+        width, height = struct.unpack(">II", frame["data"][16:24])
+    else:
+        width, height = frame["image"].size
+    frame["width"], frame["height"] = width, height
+    return width, height
+
+
+# --- 最近一帧全分辨率缓存 + 编码结果缓存 ---
+# 预览用缩小图，放大查看细节时可以直接从缓存取全分辨率，不必再截一次
+last_frames: Dict[Tuple[str, str], Dict] = {}
+last_frames_lock = threading.Lock()
+ENCODED_FRAME_CACHE_SIZE = 8
+# key=(digest, format, quality, scale) -> (bytes, media_type)
+_encoded_frame_cache: "OrderedDict[Tuple, Tuple[bytes, str]]" = OrderedDict()
+
+
+def remember_frame(serial: str, display: str, frame: Dict):
+    with last_frames_lock:
+        last_frames[(serial, display)] = frame
+
+
+def get_remembered_frame(serial: str, display: str) -> Optional[Dict]:
+    with last_frames_lock:
+        return last_frames.get((serial, display))
+
+
+def encode_frame_cached(frame: Dict, fmt: str, quality: int, scale: float) -> Tuple[bytes, str]:
+    """encode_frame + 小 LRU：同一帧同一参数（例如多个客户端 / 304 之后的重取）只编码一次。"""
+    key = (frame_digest(frame), fmt, quality, scale)
+    with last_frames_lock:
+        cached = _encoded_frame_cache.get(key)
+        if cached is not None:
+            _encoded_frame_cache.move_to_end(key)
+            return cached
+    result = encode_frame(frame, fmt, quality, scale)
+    with last_frames_lock:
+        _encoded_frame_cache[key] = result
+        while len(_encoded_frame_cache) > ENCODED_FRAME_CACHE_SIZE:
+            _encoded_frame_cache.popitem(last=False)
+    return result
+
+
+def frame_digest(frame: Dict) -> str:
+    """帧内容哈希（只算像素/PNG 数据），用于 ETag 和推流去重。结果缓存在 frame 上。"""
+    digest = frame.get("digest")
+    if digest:
+        return digest
+    h = hashlib.blake2b(digest_size=16)
+    if frame["encoding"] == "raw":
+        h.update(memoryview(frame["data"])[frame["offset"]:])
+    elif frame["encoding"] == "png":
+        h.update(frame["data"])
+    else:
+        h.update(frame["image"].tobytes())
+    digest = h.hexdigest()
+    frame["digest"] = digest
+    return digest
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag or tag == "*":
+            return True
+    return False
+
+
+# --- 帧差分：按 tile 比较相邻两帧，推流时只发送变化区域 ---
+STREAM_TILE_SIZE = 64
+# 变化面积超过该比例时直接发关键帧，拆成小块反而更大
+STREAM_KEYFRAME_RATIO = 0.5
+
+
+def frame_pixels(frame: Dict):
+    """把 frame 转成 numpy 数组：4 字节像素用 (h, w) uint32 视图（零拷贝），其他为 (h, w, 3)。"""
+    if frame["encoding"] == "raw" and RAW_PIXEL_FORMATS_BPP.get(frame["rawmode"]) == 4:
+        return np.frombuffer(frame["data"], dtype=np.uint32, count=frame["width"] * frame["height"],
+                             offset=frame["offset"]).reshape(frame["height"], frame["width"])
+    return np.asarray(frame_to_image(frame).convert("RGB"))
+
+
+def tile_diff(prev, cur, tile: int = STREAM_TILE_SIZE):
+    """返回 (rows, cols) 的 bool 数组，True 表示该 tile 有像素变化。"""
+    neq = prev != cur
+    if neq.ndim == 3:
+        neq = neq.any(axis=2)
+    rows = np.logical_or.reduceat(neq, np.arange(0, neq.shape[0], tile), axis=0)
+    return np.logical_or.reduceat(rows, np.arange(0, neq.shape[1], tile), axis=1)
+
+
+def tile_mask_to_rects(mask, tile: int, width: int, height: int) -> List[Tuple[int, int, int, int]]:
+    """把变化 tile 合并成矩形 (x, y, w, h)：同一行连续 tile 合并，上下对齐的行段再纵向合并。"""
+    rects: List[List[int]] = []
+    open_runs: Dict[Tuple[int, int], List[int]] = {}
+    for ty in range(mask.shape[0]):
+        row = mask[ty]
+        runs = []
+        tx = 0
+        while tx < len(row):
+            if row[tx]:
+                start = tx
+                while tx < len(row) and row[tx]:
+                    tx += 1
+                runs.append((start, tx))
+            else:
+                tx += 1
+        next_open: Dict[Tuple[int, int], List[int]] = {}
+        for run in runs:
+            r = open_runs.get(run)
+            if r is not None:
+                r[3] += 1
+            else:
+                r = [run[0], ty, run[1] - run[0], 1]
+                rects.append(r)
+            next_open[run] = r
+        open_runs = next_open
+    out = []
+    for tx, ty, tw, th in rects:
+        x, y = tx * tile, ty * tile
+        out.append((x, y, min(tw * tile, width - x), min(th * tile, height - y)))
+    return out
+
+
+def warm_capture_strategies(serial: str):
+    """连接时在后台为设备的每个 display 预先跑一遍探测。"""
+    def worker():
+        displays = [d["id"] for d in (get_device_profile(serial).get("displays") or [])] or ["0"]
+        for display in displays:
+            try:
+                _get_capture_state(serial, display, reprobe=True)
+            except Exception as e:
+                capture_log.warning(f"⚠️ 预探测 display {display} 失败: {e}")
+
+    threading.Thread(target=worker, name=f"capture-probe-{serial}", daemon=True).start()
+
+
+@app.get("/api/capture/strategy")
+def get_capture_strategy(serial: Optional[str] = None, display: Optional[str] = None):
+    """返回 autotuner 为各 display 选中的截图方式和实测延迟。"""
+    target_serial = serial or current_serial
+    if not target_serial:
+        raise HTTPException(status_code=400, detail="Device not connected")
+    with capture_tuners_lock:
+        states = [
+            dict(s) for (s_serial, s_display), s in capture_tuners.items()
+            if s_serial == target_serial and (display is None or s_display == display)
+        ]
+    return {"serial": target_serial, "strategies": states}
+
+
+class CaptureReprobeRequest(BaseModel):
+    display: str = "0"
+
+
+@app.post("/api/capture/reprobe")
+def reprobe_capture_strategy(req: CaptureReprobeRequest):
+    """手动触发重新 benchmark。"""
+    if not current_serial:
+        raise HTTPException(status_code=400, detail="Device not connected")
+    return _get_capture_state(current_serial, req.display, reprobe=True)
+
+
+# --- 请求合并（single-flight） ---
+# 浏览器页面和 IDE 工具窗口经常同时请求同一个 display 的截图 / UI 树，
+# refreshSnapshot() 也会并行发两者。按 (serial, display, kind) 合并：
+#   - 已有同 key 的请求在跑：直接等它的结果
+#   - 刚完成不久（freshness window 内）：直接复用上一次结果
+SINGLE_FLIGHT_FRESH_SECONDS = {
+    "screenshot": 0.15,
+    "hierarchy": 0.5,
+}
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> {"event", "result", "error", "generation"}
+        self.calls: Dict[Tuple, Dict] = {}
+        # key -> (finished_at, result)
+        self.recent: Dict[Tuple, Tuple[float, object]] = {}
+        # serial -> generation；forget() 递增，旧 generation 的结果不再复用
+        self.generations: Dict[str, int] = {}
+        self.stats = {"calls": 0, "shared": 0, "fresh": 0}
+
+    def do(self, key: Tuple, fn, fresh: float = 0.0):
+        serial = key[0]
+        with self.lock:
+            self.stats["calls"] += 1
+            if fresh > 0:
+                hit = self.recent.get(key)
+                if hit is not None and time.time() - hit[0] <= fresh:
+                    self.stats["fresh"] += 1
+                    return hit[1]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {
+                    "event": threading.Event(),
+                    "result": None,
+                    "error": None,
+                    "generation": self.generations.get(serial, 0),
+                }
+                self.calls[key] = call
+            else:
+                self.stats["shared"] += 1
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+                if call["error"] is None and call["generation"] == self.generations.get(serial, 0):
+                    self.recent[key] = (time.time(), call["result"])
+            call["event"].set()
+
+    def generation(self, serial: str) -> int:
+        with self.lock:
+            return self.generations.get(serial, 0)
+
+    def forget(self, serial: str):
+        """设备状态变了（点击/滑动/返回）：丢掉该设备已完成的结果，正在跑的也不再给新请求复用。"""
+        with self.lock:
+            self.generations[serial] = self.generations.get(serial, 0) + 1
+            for key in [k for k in self.recent if k[0] == serial]:
+                del self.recent[key]
+            for key in [k for k in self.calls if k[0] == serial]:
+                del self.calls[key]
+
+    def forget_display(self, serial: str, display: str):
+        """只有一个 display 变了：丢掉该 display 的结果，其它 display 照常复用（不递增 generation）。"""
+        with self.lock:
+            for key in [k for k in self.recent if k[0] == serial and str(k[1]) == display]:
+                del self.recent[key]
+            for key in [k for k in self.calls if k[0] == serial and str(k[1]) == display]:
+                del self.calls[key]
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return dict(self.stats, in_flight=[list(k) for k in self.calls])
+
+
+single_flight = SingleFlight()
+
+
+def capture_frame_shared(serial: str, display: str, prefer_raw: bool = False, kind: str = "screenshot",
+                         fresh: Optional[float] = None) -> Dict:
+    """capture_frame 的 single-flight 版本：同一 display 的并发截图只跑一次 adb。"""
+    if fresh is None:
+        fresh = SINGLE_FLIGHT_FRESH_SECONDS["screenshot"]
+    return single_flight.do(
+        (serial, str(display), kind),
+        lambda: capture_frame(serial, display, prefer_raw=prefer_raw),
+        fresh=fresh,
+    )
+
+
+@app.get("/api/screenshot")
+def get_screenshot(request: Request, display: str = "0", format: str = "png", quality: int = 80,
+                   scale: float = 1.0, max_width: Optional[int] = None, capture: str = "auto",
+                   cached: bool = False):
+    """截图。
+
+    响应带 ETag（帧内容哈希 + 编码参数）；请求带匹配的 If-None-Match 时返回 304，跳过编码和传输。
+
+    - format: png / jpeg / webp（服务端用 Pillow 编码）
+    - quality: jpeg/webp 质量 1-100
+    - scale: 0-1 缩放比例
+    - max_width: 输出宽度上限（与 scale 取更小者），用于 IDE 窄面板预览
+    - capture: auto / raw / png。auto 时非 PNG 输出优先拉 raw framebuffer，把压缩从车机挪到服务端
+    - cached: 不截图，直接用最近一帧的全分辨率缓存重新编码（预览图放大看细节时用）
+
+    响应头 X-Scale-Factor 为实际缩放比例，X-Frame-Width/X-Frame-Height 为设备原始分辨率，
+    hierarchy bounds 按 X-Frame-* 的坐标系映射即可。
+    """
+    global current_serial
+    if not current_serial:
+         raise HTTPException(status_code=400, detail="Device not connected")
+    fmt = format.lower()
+    if fmt not in SCREENSHOT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    if not (0 < scale <= 1.0):
+        raise HTTPException(status_code=400, detail="scale must be in (0, 1]")
+    if capture not in ("auto", "raw", "png"):
+        raise HTTPException(status_code=400, detail=f"Unsupported capture mode: {capture}")
+    if max_width is not None and max_width <= 0:
+        raise HTTPException(status_code=400, detail="max_width must be positive")
+    quality = max(1, min(100, quality))
+    # 服务端反正要解码/编码时（非 PNG 或需要缩放），优先拉 raw，省掉车机上的 PNG 压缩
+    resizing = scale < 1.0 or max_width is not None
+    prefer_raw = capture == "raw" or (capture == "auto" and (fmt != "png" or resizing))
+    
+    try:
+        if cached:
+            frame = get_remembered_frame(current_serial, display)
+            if frame is None:
+                raise HTTPException(status_code=404, detail=f"No cached frame for display {display}")
+        else:
+            prefetcher.touch(current_serial, display)
+            frame = prefetcher.take_frame(current_serial, display) if capture == "auto" else None
+            if frame is None:
+                # 显式指定 capture 时只和同一种 capture 合并
+                kind = "screenshot" if capture == "auto" else f"screenshot:{capture}"
+                frame = capture_frame_shared(current_serial, display, prefer_raw=prefer_raw, kind=kind)
+            # 预取帧和新截的帧都要记下，之后 cached=true 取全分辨率时拿到的就是客户端正在看的这一帧
+            remember_frame(current_serial, display, frame)
+
+        width, height = frame_size(frame)
+        effective_scale = scale
+        if max_width is not None and width > max_width:
+            effective_scale = min(effective_scale, max_width / width)
+        effective_scale = round(effective_scale, 4)
+
+        etag = f'"{frame_digest(frame)}-{fmt}-{quality}-{effective_scale}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "no-cache",
+            "X-Capture-Method": frame["method"],
+            "X-Capture-Ms": str(frame["latency_ms"]),
+            "X-Scale-Factor": str(effective_scale),
+            "X-Frame-Width": str(width),
+            "X-Frame-Height": str(height),
+        }
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        content, media_type = encode_frame_cached(frame, fmt, quality, effective_scale)
+        return Response(content=content, media_type=media_type, headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        screenshot_log.error(f"❌ 截图失败 display {display}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- 实时画面推流（替代 Turbo Mode 下的逐帧 /api/screenshot 轮询） ---
+# 每个 (serial, display) 一个后台截图循环，帧率由截图速度决定；
+# 只保留最新一帧（latest-frame-wins），慢客户端直接跳帧而不是排队。
+# 客户端单次等新帧最多 STREAM_WAIT_TIMEOUT；静止画面下客户端一直在等，
+# 所以空闲判定要明显长于单次等待，否则截图循环会在客户端还连着时退出
+STREAM_WAIT_TIMEOUT = 5.0
+STREAM_IDLE_TIMEOUT = 15.0
+# 画面没变时下一次截图前的等待：从 STREAM_IDENTICAL_BACKOFF 开始翻倍，最多 STREAM_IDENTICAL_BACKOFF_MAX，画面一变就重置
+STREAM_IDENTICAL_BACKOFF = 0.02
+STREAM_IDENTICAL_BACKOFF_MAX = 0.2
+screen_streamers: Dict[Tuple[str, str], "ScreenStreamer"] = {}
+screen_streamers_lock = threading.Lock()
+
+
+class ScreenStreamer:
+    """单个 (serial, display) 的后台截图循环。没有客户端取帧超过 STREAM_IDLE_TIMEOUT 后自动退出。"""
+
+    def __init__(self, serial: str, display: str):
+        self.serial = serial
+        self.display = display
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.frame: Optional[Dict] = None
+        # 当前帧的编码结果，key=(format, quality, scale)，多个相同参数的客户端共享
+        self.encoded: Dict[Tuple, Tuple[bytes, str]] = {}
+        self.error: Optional[str] = None
+        self.fps = 0.0
+        # 最近若干帧的变化 tile（seq -> mask），用于给落后的客户端合并增量
+        self.tile_history: Dict[int, object] = {}
+        self.pixels = None
+        self.skipped_identical = 0
+        self.last_access = time.time()
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._loop, name=f"stream-{serial}-{display}", daemon=True
+        )
+        self.thread.start()
+
+    def _loop(self):
+        stream_log.info(f"▶️ 开始推流 {self.serial} display {self.display}")
+        last_ts = None
+        backoff = 0.0
+        while time.time() - self.last_access <= STREAM_IDLE_TIMEOUT:
+            try:
+                # 只合并正在跑的截图，不复用旧结果（否则会空转拿到同一帧）
+                frame = capture_frame_shared(self.serial, self.display, prefer_raw=True, fresh=0)
+            except Exception as e:
+                with self.cond:
+                    self.error = str(e)
+                    self.cond.notify_all()
+                time.sleep(0.5)
+                continue
+            now = time.time()
+            # 与上一帧完全相同：不产生新帧，客户端什么都不用收
+            if self.frame is not None and frame_digest(frame) == frame_digest(self.frame):
+                self.skipped_identical += 1
+                # 静止画面不用连续截图把 adb/screencap 跑满
+                backoff = min(STREAM_IDENTICAL_BACKOFF_MAX, backoff * 2 or STREAM_IDENTICAL_BACKOFF)
+                time.sleep(backoff)
+                continue
+            backoff = 0.0
+            mask = None
+            pixels = None
+            if np is not None:
+                try:
+                    pixels = frame_pixels(frame)
+                    if self.pixels is not None and self.pixels.shape == pixels.shape:
+                        mask = tile_diff(self.pixels, pixels)
+                except Exception as e:
+                    stream_log.warning(f"⚠️ tile diff 失败: {e}")
+            with self.cond:
+                self.seq += 1
+                self.frame = frame
+                self.pixels = pixels
+                self.encoded = {}
+                self.error = None
+                self.tile_history[self.seq] = mask
+                self.tile_history.pop(self.seq - 16, None)
+                if last_ts is not None:
+                    inst = 1.0 / max(1e-3, now - last_ts)
+                    self.fps = inst if not self.fps else self.fps * 0.8 + inst * 0.2
+                self.cond.notify_all()
+            last_ts = now
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        with screen_streamers_lock:
+            if screen_streamers.get((self.serial, self.display)) is self:
+                del screen_streamers[(self.serial, self.display)]
+        stream_log.info(f"⏹️ 停止推流 {self.serial} display {self.display}（无客户端）")
+
+    def wait_frame(self, after_seq: int, fmt: str, quality: int, scale: float,
+                   timeout: float = STREAM_WAIT_TIMEOUT) -> Optional[Tuple[int, bytes, str]]:
+        """等待比 after_seq 更新的一帧并按参数编码；超时/停止返回 None。"""
+        deadline = time.time() + timeout
+        with self.cond:
+            self.last_access = time.time()
+            while self.seq <= after_seq and self.running:
+                # 等待期间客户端一直在，每次醒来都刷新
+                self.last_access = time.time()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            if self.seq <= after_seq:
+                return None
+            seq, frame = self.seq, self.frame
+            cached = self.encoded.get((fmt, quality, scale))
+        if cached is None:
+            cached = encode_frame(frame, fmt, quality, scale)
+            with self.cond:
+                if self.seq == seq:
+                    self.encoded[(fmt, quality, scale)] = cached
+        return seq, cached[0], cached[1]
+
+    def _dirty_mask_since(self, after_seq: int):
+        """after_seq 之后所有帧变化 tile 的并集；历史不完整时返回 None（需要关键帧）。"""
+        if after_seq <= 0 or np is None:
+            return None
+        mask = None
+        for s in range(after_seq + 1, self.seq + 1):
+            m = self.tile_history.get(s)
+            if m is None:
+                return None
+            mask = m if mask is None else (mask | m)
+        return mask
+
+    def wait_packet(self, after_seq: int, fmt: str, quality: int, scale: float,
+                    timeout: float = STREAM_WAIT_TIMEOUT) -> Optional[Tuple[int, bytes]]:
+        """增量推流用：返回 (seq, packet)。
+
+        packet = uint32(header_len, big-endian) + JSON header + 各矩形图片数据依次拼接。
+        header: {type: key|delta, seq, width, height, mime, rects: [[x, y, w, h, nbytes], ...]}
+        坐标为缩放后的画面坐标；客户端按顺序把每块画到对应位置即可。
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            self.last_access = time.time()
+            while self.seq <= after_seq and self.running:
+                # 等待期间客户端一直在，每次醒来都刷新
+                self.last_access = time.time()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            if self.seq <= after_seq:
+                return None
+            seq, frame = self.seq, self.frame
+            mask = self._dirty_mask_since(after_seq)
+            cache_key = ("packet", after_seq if mask is not None else 0, fmt, quality, scale)
+            cached = self.encoded.get(cache_key)
+        if cached is not None:
+            return seq, cached
+
+        _, media_type = SCREENSHOT_FORMATS[fmt]
+        image = frame_to_image(frame)
+        width, height = image.size
+        out_w = max(1, int(round(width * scale)))
+        out_h = max(1, int(round(height * scale)))
+        rects = []
+        if mask is not None:
+            if not mask.any():
+                rects = []
+            elif mask.mean() <= STREAM_KEYFRAME_RATIO:
+                rects = tile_mask_to_rects(mask, STREAM_TILE_SIZE, width, height)
+            else:
+                mask = None
+
+        parts: List[bytes] = []
+        header_rects = []
+        if mask is None:
+            content, _ = encode_frame(frame, fmt, quality, scale)
+            parts.append(content)
+            header_rects.append([0, 0, out_w, out_h, len(content)])
+        else:
+            if scale < 1.0:
+                image = image.resize((out_w, out_h), Image.BILINEAR)
+            pil_format = SCREENSHOT_FORMATS[fmt][0]
+            for x, y, w, h in rects:
+                # 缩放后坐标向外取整，避免块之间出现缝隙
+                x0, y0 = int(x * scale), int(y * scale)
+                x1 = min(out_w, math.ceil((x + w) * scale))
+                y1 = min(out_h, math.ceil((y + h) * scale))
+                crop = image.crop((x0, y0, x1, y1))
+                buf = io.BytesIO()
+                if pil_format == "PNG":
+                    crop.save(buf, format="PNG", compress_level=1)
+                elif pil_format == "JPEG":
+                    crop.convert("RGB").save(buf, format="JPEG", quality=quality)
+                else:
+                    crop.save(buf, format="WEBP", quality=quality, method=0)
+                data = buf.getvalue()
+                parts.append(data)
+                header_rects.append([x0, y0, x1 - x0, y1 - y0, len(data)])
+
+        header = json.dumps({
+            "type": "key" if mask is None else "delta",
+            "seq": seq,
+            "width": out_w,
+            "height": out_h,
+            "mime": media_type,
+            "rects": header_rects,
+        }).encode("utf-8")
+        packet = struct.pack(">I", len(header)) + header + b"".join(parts)
+        with self.cond:
+            if self.seq == seq:
+                self.encoded[cache_key] = packet
+        return seq, packet
+
+    def status(self) -> Dict:
+        return {
+            "serial": self.serial,
+            "display": self.display,
+            "running": self.running,
+            "seq": self.seq,
+            "fps": round(self.fps, 1),
+            "skipped_identical": self.skipped_identical,
+            "error": self.error,
+        }
+
+
+def get_screen_streamer(serial: str, display: str) -> ScreenStreamer:
+    with screen_streamers_lock:
+        streamer = screen_streamers.get((serial, display))
+        if streamer is None or not streamer.running:
+            streamer = ScreenStreamer(serial, display)
+            screen_streamers[(serial, display)] = streamer
+        return streamer
+
+
+def _validate_stream_params(fmt: str, quality: int, scale: float) -> Tuple[str, int, float]:
+    fmt = fmt.lower()
+    if fmt not in SCREENSHOT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+    if not (0 < scale <= 1.0):
+        raise HTTPException(status_code=400, detail="scale must be in (0, 1]")
+    return fmt, max(1, min(100, quality)), scale
+
+
+@app.get("/api/stream/mjpeg")
+def stream_mjpeg(display: str = "0", quality: int = 70, scale: float = 1.0):
+    """multipart/x-mixed-replace 推流，可直接作为 <img src> 使用。"""
+    if not current_serial:
+        raise HTTPException(status_code=400, detail="Device not connected")
+    _, quality, scale = _validate_stream_params("jpeg", quality, scale)
+    serial = current_serial
+
+    def frames():
+        seq = 0
+        streamer = get_screen_streamer(serial, display)
+        while True:
+            res = streamer.wait_frame(seq, "jpeg", quality, scale)
+            if res is None:
+                if not streamer.running:
+                    streamer = get_screen_streamer(serial, display)
+                    seq = 0
+                continue
+            seq, content, media_type = res
+            yield (
+                b"--frame\r\nContent-Type: " + media_type.encode() +
+                b"\r\nContent-Length: " + str(len(content)).encode() + b"\r\n\r\n" +
+                content + b"\r\n"
+            )
+
+    return StreamingResponse(frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+
+
+async def _watch_disconnect(websocket: WebSocket, closed: asyncio.Event):
+    """推流协议里客户端不发数据；一直读到断开为止，断开时置位 closed。
+
+    只靠 send 失败来发现断开会让已离开的客户端继续占着截图循环（没有新帧时 send 根本不会发生）。
+    """
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    except Exception:
+        pass
+    finally:
+        closed.set()
+
+
+@app.websocket("/api/stream/ws")
+async def stream_ws(websocket: WebSocket, display: str = "0", format: str = "jpeg",
+                    quality: int = 70, scale: float = 1.0, delta: bool = False):
+    """WebSocket 推流；出错时发送 JSON 文本消息。
+
+    - delta=false: 每条 binary 消息是一帧完整图片
+    - delta=true: 每条 binary 消息是一个增量包（见 ScreenStreamer.wait_packet），只含变化的 tile
+    """
+    await websocket.accept()
+    try:
+        fmt, quality, scale = _validate_stream_params(format, quality, scale)
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "error": e.detail})
+        await websocket.close()
+        return
+    serial = current_serial
+    if not serial:
+        await websocket.send_json({"type": "error", "error": "Device not connected"})
+        await websocket.close()
+        return
+
+    seq = 0
+    streamer = get_screen_streamer(serial, display)
+    closed = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(websocket, closed))
+    try:
+        while not closed.is_set():
+            if delta:
+                res = await run_in_threadpool(streamer.wait_packet, seq, fmt, quality, scale)
+            else:
+                res = await run_in_threadpool(streamer.wait_frame, seq, fmt, quality, scale)
+            if closed.is_set():
+                break
+            if res is None:
+                if streamer.error:
+                    await websocket.send_json({"type": "error", "error": streamer.error})
+                if not streamer.running:
+                    # 新的截图循环 seq 从头开始，需要重新发关键帧
+                    streamer = get_screen_streamer(serial, display)
+                    seq = 0
+                continue
+            seq, content = res[0], res[1]
+            # send 完成前不会取下一帧：客户端慢时中间帧直接被跳过
+            await websocket.send_bytes(content)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        stream_log.warning(f"⚠️ WebSocket 推流中断: {e}")
+    finally:
+        watcher.cancel()
+
+
+@app.get("/api/stream/status")
+def get_stream_status():
+    with screen_streamers_lock:
+        streams = [s.status() for s in screen_streamers.values()]
+    with wall_streamers_lock:
+        streams.extend(s.status() for s in wall_streamers.values())
+    return streams
+
+
+# --- 多屏墙：一次截取设备所有 display / 多屏轮询推流 ---
+def _device_display_ids(serial: str) -> List[str]:
+    return [d["id"] for d in (get_device_profile(serial).get("displays") or [])] or ["0"]
+
+
+def _frame_payload(display: str, frame: Dict, fmt: str, quality: int, max_width: Optional[int]) -> Dict:
+    width, height = frame_size(frame)
+    scale = 1.0
+    if max_width and width > max_width:
+        scale = round(max_width / width, 4)
+    content, media_type = encode_frame_cached(frame, fmt, quality, scale)
+    return {
+        "id": display,
+        "width": width,
+        "height": height,
+        "scale": scale,
+        "mime": media_type,
+        "etag": frame_digest(frame),
+        "capture_method": frame.get("method"),
+        "capture_ms": frame.get("latency_ms"),
+        "image": base64.b64encode(content).decode("ascii"),
+    }
+
+
+@app.get("/api/screenshot/all")
+def get_all_screenshots(format: str = "jpeg", quality: int = 70, max_width: Optional[int] = None):
+    """并发截取当前设备所有 display，一次返回（图片为 base64）。"""
+    if not current_serial:
+        raise HTTPException(status_code=400, detail="Device not connected")
+    fmt, quality, _ = _validate_stream_params(format, quality, 1.0)
+    serial = current_serial
+    displays = _device_display_ids(serial)
+    prefer_raw = fmt != "png" or max_width is not None
+    t0 = time.time()
+
+    def capture_one(display: str) -> Dict:
+        try:
+            frame = capture_frame_shared(serial, display, prefer_raw=prefer_raw)
+            remember_frame(serial, display, frame)
+            return _frame_payload(display, frame, fmt, quality, max_width)
+        except Exception as e:
+            return {"id": display, "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=len(displays)) as pool:
+        results = list(pool.map(capture_one, displays))
+    return {
+        "serial": serial,
+        "elapsed_ms": int((time.time() - t0) * 1000),
+        "displays": results,
+    }
+
+
+WALL_DEFAULT_FPS = 2.0
+wall_streamers: Dict[str, "WallStreamer"] = {}
+wall_streamers_lock = threading.Lock()
+
+
+class WallStreamer:
+    """多屏墙推流：对设备所有 display 轮询截图（同一时刻只有一个截图在跑），
+    每个 display 限制在 per_display_fps，避免 adb 负载随屏幕数成倍增加。
+
+    每个客户端有自己的 fps：截图循环按所有客户端里最高的 fps 跑，
+    较慢的客户端在 wait_frames 里按自己的间隔跳帧，互不影响。
+    """
+
+    def __init__(self, serial: str, per_display_fps: float = WALL_DEFAULT_FPS):
+        self.serial = serial
+        # 没有客户端登记 fps 时的默认值
+        self.default_fps = per_display_fps
+        # client id -> 该客户端要求的每屏 fps
+        self.client_fps: Dict[int, float] = {}
+        self._next_client = 0
+        self.cond = threading.Condition()
+        self.seq = 0
+        # display -> (seq, frame)
+        self.frames: Dict[str, Tuple[int, Dict]] = {}
+        self.encoded: Dict[Tuple, bytes] = {}
+        self.errors: Dict[str, str] = {}
+        self.last_access = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name=f"wall-{serial}", daemon=True)
+        self.thread.start()
+
+    @property
+    def per_display_fps(self) -> float:
+        with self.cond:
+            return max(self.client_fps.values(), default=self.default_fps)
+
+    def add_client(self, fps: float) -> int:
+        with self.cond:
+            self._next_client += 1
+            self.client_fps[self._next_client] = fps
+            self.last_access = time.time()
+            return self._next_client
+
+    def remove_client(self, client: int):
+        with self.cond:
+            self.client_fps.pop(client, None)
+
+    def _loop(self):
+        stream_log.info(f"▶️ 开始多屏墙推流 {self.serial}")
+        next_due: Dict[str, float] = {}
+        while time.time() - self.last_access <= STREAM_IDLE_TIMEOUT:
+            displays = _device_display_ids(self.serial)
+            interval = 1.0 / max(0.1, self.per_display_fps)
+            now = time.time()
+            # round-robin：挑最早到期的 display
+            display = min(displays, key=lambda d: next_due.get(d, 0))
+            wait = next_due.get(display, 0) - now
+            if wait > 0:
+                time.sleep(min(wait, 0.5))
+                continue
+            next_due[display] = now + interval
+            try:
+                frame = capture_frame_shared(self.serial, display, prefer_raw=True, fresh=0)
+            except Exception as e:
+                with self.cond:
+                    self.errors[display] = str(e)
+                continue
+            remember_frame(self.serial, display, frame)
+            with self.cond:
+                self.errors.pop(display, None)
+                prev = self.frames.get(display)
+                if prev is not None and frame_digest(prev[1]) == frame_digest(frame):
+                    continue
+                self.seq += 1
+                self.frames[display] = (self.seq, frame)
+                self.cond.notify_all()
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        with wall_streamers_lock:
+            if wall_streamers.get(self.serial) is self:
+                del wall_streamers[self.serial]
+        stream_log.info(f"⏹️ 停止多屏墙推流 {self.serial}（无客户端）")
+
+    def wait_frames(self, seen: Dict[str, int], fmt: str, quality: int, scale: float,
+                    timeout: float = STREAM_WAIT_TIMEOUT, min_interval: float = 0.0,
+                    sent_at: Optional[Dict[str, float]] = None) -> List[Tuple[str, int, bytes]]:
+        """返回客户端还没收到过的各 display 最新帧 (display, seq, packet)。
+
+        min_interval/sent_at 是该客户端自己的限速：某个 display 距上次发送不足 min_interval 时先不返回它。
+        """
+        sent_at = sent_at or {}
+        deadline = time.time() + timeout
+        with self.cond:
+            self.last_access = time.time()
+            while self.running:
+                now = time.time()
+                pending = []
+                next_due = deadline
+                for d, (s, f) in self.frames.items():
+                    if s <= seen.get(d, 0):
+                        continue
+                    due = sent_at.get(d, 0) + min_interval
+                    if due <= now:
+                        pending.append((d, s, f))
+                    else:
+                        next_due = min(next_due, due)
+                if pending:
+                    break
+                remaining = next_due - now
+                if remaining <= 0:
+                    if now >= deadline:
+                        return []
+                    continue
+                self.cond.wait(remaining)
+            else:
+                return []
+        out = []
+        for display, seq, frame in pending:
+            key = (display, seq, fmt, quality, scale)
+            with self.cond:
+                packet = self.encoded.get(key)
+            if packet is None:
+                content, media_type = encode_frame(frame, fmt, quality, scale)
+                width, height = frame_size(frame)
+                header = json.dumps({
+                    "display": display,
+                    "seq": seq,
+                    "width": width,
+                    "height": height,
+                    "scale": scale,
+                    "mime": media_type,
+                }).encode("utf-8")
+                packet = struct.pack(">I", len(header)) + header + content
+                with self.cond:
+                    # 只保留各 display 当前帧的编码结果
+                    self.encoded = {k: v for k, v in self.encoded.items()
+                                    if self.frames.get(k[0], (0,))[0] == k[1]}
+                    self.encoded[key] = packet
+            out.append((display, seq, packet))
+        return out
+
+    def status(self) -> Dict:
+        return {
+            "serial": self.serial,
+            "mode": "wall",
+            "running": self.running,
+            "per_display_fps": self.per_display_fps,
+            "client_fps": sorted(self.client_fps.values()),
+            "displays": {d: s for d, (s, _) in self.frames.items()},
+            "errors": dict(self.errors),
+        }
+
+
+def get_wall_streamer(serial: str) -> WallStreamer:
+    with wall_streamers_lock:
+        streamer = wall_streamers.get(serial)
+        if streamer is None or not streamer.running:
+            streamer = WallStreamer(serial)
+            wall_streamers[serial] = streamer
+        return streamer
+
+
+@app.websocket("/api/stream/wall")
+async def stream_wall_ws(websocket: WebSocket, format: str = "jpeg", quality: int = 60,
+                         scale: float = 0.5, fps: float = WALL_DEFAULT_FPS):
+    """多屏墙 WebSocket 推流。
+
+    每条 binary 消息 = uint32(header长度, big-endian) + JSON header({display, seq, width, height, scale, mime}) + 图片。
+    """
+    await websocket.accept()
+    try:
+        fmt, quality, scale = _validate_stream_params(format, quality, scale)
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "error": e.detail})
+        await websocket.close()
+        return
+    serial = current_serial
+    if not serial:
+        await websocket.send_json({"type": "error", "error": "Device not connected"})
+        await websocket.close()
+        return
+
+    fps = max(0.1, min(fps, 30.0))
+    # 该客户端自己的节奏：每个 display 两次发送至少间隔 1/fps
+    min_interval = 1.0 / fps
+    seen: Dict[str, int] = {}
+    sent_at: Dict[str, float] = {}
+    streamer = get_wall_streamer(serial)
+    client = streamer.add_client(fps)
+    closed = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(websocket, closed))
+    try:
+        while not closed.is_set():
+            packets = await run_in_threadpool(
+                streamer.wait_frames, seen, fmt, quality, scale, STREAM_WAIT_TIMEOUT, min_interval, sent_at,
+            )
+            if closed.is_set():
+                break
+            if not packets:
+                if not streamer.running:
+                    streamer = get_wall_streamer(serial)
+                    client = streamer.add_client(fps)
+                    seen = {}
+                    sent_at = {}
+                continue
+            for display, seq, packet in packets:
+                seen[display] = seq
+                sent_at[display] = time.time()
+                await websocket.send_bytes(packet)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        stream_log.warning(f"⚠️ 多屏墙推流中断: {e}")
+    finally:
+        watcher.cancel()
+        streamer.remove_client(client)
+
+def check_accessibility_service(serial: str) -> bool:
+    """检查辅助服务是否可用"""
+    try:
+        # 设置端口转发
+        fw = _adb_run(["adb", "-s", serial, "forward", "tcp:8765", "tcp:8765"], timeout=3)
+        if fw.returncode != 0:
+            accessibility_log.warning(f"⚠️ adb forward failed on {serial}: {fw.stderr.strip()}")
+        
+        if requests is None:
+            accessibility_log.warning("⚠️ Python requests not installed, cannot probe /api/status")
+            return False
+
+        # 测试连接
+        response = requests.get("http://localhost:8765/api/status", timeout=2)
+        if response.status_code == 200:
+            data = response.json()
+            if data.get("service") == "running":
+                accessibility_log.info(f"✅ 辅助服务可用")
+                return True
+    except Exception as e:
+        accessibility_log.warning(f"⚠️ 辅助服务不可用(serial={serial}): {e}")
+    return False
+
+
+def probe_accessibility_service(serial: str) -> Dict:
+    """Probe accessibility service and return details for diagnosis.
+
+    Returns:
+      {
+        ok: bool,
+        forward_ok: bool,
+        forward_stderr: str,
+        http_ok: bool,
+        http_error: str,
+        status_json: dict|None,
+      }
+    """
+    info: Dict = {
+        "ok": False,
+        "forward_ok": False,
+        "forward_stderr": "",
+        "http_ok": False,
+        "http_error": "",
+        "status_json": None,
+    }
+
+    try:
+        fw = _adb_run(["adb", "-s", serial, "forward", "tcp:8765", "tcp:8765"], timeout=3)
+        info["forward_ok"] = fw.returncode == 0
+        info["forward_stderr"] = (fw.stderr or "").strip()
+
+        if requests is None:
+            info["http_error"] = "python requests not installed"
+            return info
+
+        try:
+            resp = requests.get("http://localhost:8765/api/status", timeout=2)
+            if resp.status_code == 200:
+                info["http_ok"] = True
+                try:
+                    info["status_json"] = resp.json()
+                except Exception:
+                    info["status_json"] = None
+            else:
+                info["http_error"] = f"HTTP {resp.status_code}"
+        except Exception as e:
+            info["http_error"] = str(e)
+
+        info["ok"] = bool(info["http_ok"] and (info.get("status_json") or {}).get("service") == "running")
+        return info
+    except Exception as e:
+        info["http_error"] = str(e)
+        return info
+
+
+def probe_accessibility_service_any(serial: str) -> Dict:
+    """Probe possible serials and return the first successful result.
+
+    Returns a dict with extra keys:
       - candidates: [..]
       - ok_serial: str
       - by_serial: {serial: probe_dict}
     """
-    candidates = get_accessibility_candidate_serials(serial)
-    by_serial: Dict[str, Dict] = {}
-    ok_serial = ""
-    ok = False
-    for s in candidates:
-        r = probe_accessibility_service(s)
-        by_serial[s] = r
-        if not ok and r.get("ok"):
-            ok = True
-            ok_serial = s
+    candidates = get_accessibility_candidate_serials(serial)
+    by_serial: Dict[str, Dict] = {}
+    ok_serial = ""
+    ok = False
+    for s in candidates:
+        r = probe_accessibility_service(s)
+        by_serial[s] = r
+        if not ok and r.get("ok"):
+            ok = True
+            ok_serial = s
+    return {
+        "ok": ok,
+        "ok_serial": ok_serial,
+        "candidates": candidates,
+        "by_serial": by_serial,
+    }
+
+
+def ensure_accessibility_service(serial: str, apk_path: Optional[str] = None, install_if_missing: bool = True) -> Dict:
+    """Ensure CarUI accessibility service is installed, enabled and running.
+
+    This is designed for 'one-click' UX:
+    - Optional install/update APK
+    - Enable service in secure settings (requires root / WRITE_SECURE_SETTINGS / userdebug)
+    - Forward 8765 and verify /api/status
+    """
+    result: Dict = {
+        "serial": serial,
+        "target_serial": resolve_accessibility_target_serial(serial),
+        "apk_installed": None,
+        "apk_install_attempted": False,
+        "enabled": False,
+        "running": False,
+        "steps": [],
+        "error": None,
+    }
+
+    target_serial = result["target_serial"]
+
+    def step(msg: str):
+        accessibility_log.info(f"[Ensure] {msg}")
+        result["steps"].append(msg)
+
+    try:
+        # 0) Validate adb device
+        step(f"Using target_serial={target_serial}")
+
+        # 1) Check APK installed
+        pkg = "com.carui.accessibility"
+        r = _adb_run(["adb", "-s", target_serial, "shell", "pm", "path", pkg], timeout=8)
+        installed = (r.returncode == 0) and ("package:" in (r.stdout or ""))
+        result["apk_installed"] = installed
+        step(f"APK installed? {installed}")
+
+        # 2) Install if missing (or user provided path)
+        if (not installed) and install_if_missing:
+            # If path not specified, try default build output relative to repo/plugin
+            if not apk_path:
+                # server/main.py is inside <plugin>/server
+                # Try to locate apk built by compile_apk.sh
+                candidate = os.path.abspath(os.path.join(script_dir, "..", "accessibility_service", "build", "outputs", "apk", "debug", "accessibility_service-debug.apk"))
+                if os.path.exists(candidate):
+                    apk_path = candidate
+
+            if apk_path and os.path.exists(apk_path):
+                result["apk_install_attempted"] = True
+                step(f"Installing APK: {apk_path}")
+                ir = _adb_run(["adb", "-s", target_serial, "install", "-r", apk_path], timeout=90)
+                if ir.returncode != 0:
+                    step(f"APK install failed: {ir.stderr.strip()}")
+                else:
+                    step("APK install success")
+                    result["apk_installed"] = True
+            else:
+                step("APK missing and no apk_path provided")
+
+        # 3) Enable secure settings (requires privileged environment)
+        # Read current services
+        r = _adb_run(["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"], timeout=6)
+        current_services = (r.stdout or "").strip()
+        component = "com.carui.accessibility/.CarUIAccessibilityService"
+        if "com.carui.accessibility" in current_services:
+            step("Service already in enabled_accessibility_services")
+        else:
+            new_services = (
+                f"{current_services}:{component}" if current_services and current_services != "null" else component
+            )
+            step(f"Enabling service via secure settings: {component}")
+            _adb_run(["adb", "-s", target_serial, "shell", "settings", "put", "secure", "enabled_accessibility_services", new_services], timeout=6)
+
+        _adb_run(["adb", "-s", target_serial, "shell", "settings", "put", "secure", "accessibility_enabled", "1"], timeout=6)
+
+        # 4) Forward and probe running
+        _adb_run(["adb", "-s", target_serial, "forward", "tcp:8765", "tcp:8765"], timeout=6)
+
+        # Poll up to 4s
+        import time
+        enabled_services_now = _adb_run(["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"], timeout=6).stdout.strip()
+        result["enabled"] = "com.carui.accessibility" in (enabled_services_now or "")
+
+        step(f"Enabled now? {result['enabled']}")
+
+        running = False
+        for i in range(1, 9):
+            if check_accessibility_service(target_serial):
+                running = True
+                break
+            time.sleep(0.5)
+        result["running"] = running
+        step(f"Running? {running}")
+        if running:
+            accessibility_events.ensure(serial, target_serial)
+
+        if not result["enabled"]:
+            step("WARNING: enable may require root/WRITE_SECURE_SETTINGS; please enable manually in Settings")
+        if not result["running"]:
+            step("WARNING: service not responding on 8765; please open Accessibility settings and toggle service")
+
+        return result
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+
+def iter_accessibility_tree(stream):
+    """逐个产出辅助服务 /api/hierarchy 响应的顶层字段 (key, value)；nodes 里的根节点逐个产出为 ("node", dict)。
+
+    有 ijson 时边收边解析，同一时刻只有一个窗口的 JSON 在内存里；否则整体解析。
+    """
+    if ijson is None:
+        data = json.load(stream)
+        for key, value in data.items():
+            if key == "nodes":
+                for node in value or []:
+                    yield "node", node
+            else:
+                yield key, value
+        return
+
+    builder = None
+    name = target = None
+    for prefix, event, value in ijson.parse(stream):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == target and event in ("end_map", "end_array"):
+                yield name, builder.value
+                builder = None
+            continue
+        if prefix == "nodes.item" and event == "start_map":
+            name, target = "node", prefix
+        elif not prefix or "." in prefix or prefix == "nodes":
+            continue
+        elif event in ("start_map", "start_array"):
+            name, target = prefix, prefix
+        else:
+            yield prefix, value
+            continue
+        builder = ijson.ObjectBuilder()
+        builder.event(event, value)
+
+
+# --- 坐标归一化：将“全局坐标”转换为“当前 display 截图坐标系” ---
+# 在多屏/分屏场景下，AccessibilityNodeInfo#getBoundsInScreen 可能返回带 display 偏移的坐标，
+# 而 screencap -d <display> 的截图坐标原点是 (0,0)。
+# 这里用该 display 的窗口 bounds 的最小 left/top 作为 display 的原点偏移，并对疑似“绝对坐标”的节点做减偏移。
+def accessibility_display_origin(window_bounds: List[Dict]) -> Tuple[int, int]:
+    try:
+        xs = []
+        ys = []
+        for wb in window_bounds:
+            if "left" in wb and "top" in wb:
+                xs.append(int(wb.get("left", 0)))
+                ys.append(int(wb.get("top", 0)))
+        if xs and ys:
+            return min(xs), min(ys)
+    except Exception:
+        pass
+    return 0, 0
+
+
+def normalize_accessibility_bounds(b: Dict, origin: Tuple[int, int]) -> Dict:
+    """按需将 bounds 从全局坐标转换为 display 内坐标。"""
+    if not b:
+        return b
+    origin_x, origin_y = origin
+    try:
+        l = int(b.get("left", 0))
+        t = int(b.get("top", 0))
+        r = int(b.get("right", 0))
+        bt = int(b.get("bottom", 0))
+
+        # 如果 origin 很接近 0，说明已是 display 坐标系
+        if origin_x < 50 and origin_y < 50:
+            return {"left": l, "top": t, "right": r, "bottom": bt}
+
+        margin = 200
+        # 只有当节点坐标看起来“落在 origin 偏移之后”，才做减偏移
+        if l >= origin_x - margin and t >= origin_y - margin and r > origin_x and bt > origin_y:
+            nl = max(0, l - origin_x)
+            nt = max(0, t - origin_y)
+            nr = max(0, r - origin_x)
+            nb = max(0, bt - origin_y)
+            return {"left": nl, "top": nt, "right": nr, "bottom": nb}
+
+        # 否则保持原值（一般是 already-relative）
+        return {"left": l, "top": t, "right": r, "bottom": bt}
+    except Exception:
+        return b
+
+
+def accessibility_node_attrs(json_node: Dict, origin: Tuple[int, int]) -> Dict[str, str]:
+    """辅助服务的 JSON 节点 -> uiautomator 风格的属性（bounds 已换算到 display 坐标系）。"""
+    attrs = {
+        # 基本属性
+        'class': json_node.get('className', ''),
+        'package': json_node.get('packageName', ''),
+        'text': json_node.get('text', ''),
+        'content-desc': json_node.get('contentDescription', ''),
+        'resource-id': json_node.get('resourceId', ''),
+    }
+
+    # 坐标
+    bounds = normalize_accessibility_bounds(json_node.get('bounds', {}), origin)
+    attrs['bounds'] = f"[{bounds.get('left',0)},{bounds.get('top',0)}][{bounds.get('right',0)},{bounds.get('bottom',0)}]"
+
+    # 状态属性
+    attrs['clickable'] = str(json_node.get('clickable', False)).lower()
+    attrs['long-clickable'] = str(json_node.get('longClickable', False)).lower()
+    attrs['enabled'] = str(json_node.get('enabled', True)).lower()
+    # Accessibility 专有：是否对用户可见
+    if 'visibleToUser' in json_node:
+        attrs['visible-to-user'] = str(json_node.get('visibleToUser', False)).lower()
+    for key in ('focusable', 'focused', 'selected', 'checkable', 'checked', 'scrollable'):
+        attrs[key] = str(json_node.get(key, False)).lower()
+    return attrs
+
+
+def get_hierarchy_from_accessibility(serial: str, display: int = 0) -> Optional[str]:
+    """从辅助服务获取UI树并转换为XML格式
+
+    辅助服务按 chunked + gzip 边遍历边输出 JSON，这里边收边转换：
+    windows 字段在 nodes 之前，先算出 display 原点，之后每个根节点（窗口）到了就转成 XML。
+    """
+    try:
+        import requests
+        import xml.etree.ElementTree as ET
+        
+        accessibility_log.debug(f"📡 从辅助服务获取UI树...")
+        
+        # 确保端口转发（某些设备/系统在状态检测后仍可能失效，兜底再 forward 一次）
+        _adb_run(["adb", "-s", serial, "forward", "tcp:8765", "tcp:8765"], timeout=3)
+
+        # 请求UI树
+        response = requests.get(f"http://localhost:8765/api/hierarchy?display={display}", timeout=5, stream=True)
+        if response.status_code != 200:
+            accessibility_log.error(f"❌ 请求失败: {response.status_code}")
+            response.close()
+            return None
+        # 按 Content-Encoding 解压
+        response.raw.decode_content = True
+
+        origin = (0, 0)
+
+        # 转换为XML格式
+        hierarchy = ET.Element('hierarchy')
+        hierarchy.set('rotation', '0')
+        
+        def convert_node_to_xml(json_node, parent_elem):
+            """递归转换JSON节点到XML"""
+            node = ET.SubElement(parent_elem, 'node', accessibility_node_attrs(json_node, origin))
+            
+            # 递归处理子节点
+            for child in json_node.get('children', []):
+                convert_node_to_xml(child, node)
+        
+        # 边收边转换根节点；旧版本服务没有 windows 字段（且 nodes 在前），先攒齐再算原点
+        data: Dict = {}
+        origin_known = False
+        buffered = []
+        count = 0
+        with response:
+            for key, value in iter_accessibility_tree(response.raw):
+                if key == "windows":
+                    origin = accessibility_display_origin([(w or {}).get("bounds") or {} for w in value or []])
+                    origin_known = True
+                elif key == "node":
+                    count += 1
+                    if origin_known:
+                        convert_node_to_xml(value, hierarchy)
+                    else:
+                        buffered.append(value)
+                else:
+                    data[key] = value
+
+        if not data.get("success"):
+            accessibility_log.error(f"❌ 获取失败: {data.get('error')}")
+            return None
+        accessibility_log.debug(f"✅ 获取到 {count} 个根节点")
+
+        if buffered:
+            origin = accessibility_display_origin([((rn.get("window") or {}).get("bounds") or {}) for rn in buffered])
+            for root_node in buffered:
+                convert_node_to_xml(root_node, hierarchy)
+        
+        # 生成XML字符串
+        xml_str = ET.tostring(hierarchy, encoding='unicode')
+        xml_content = '<?xml version="1.0" encoding="UTF-8"?>' + xml_str
+        
+        accessibility_log.debug(f"✅ 转换完成，XML长度: {len(xml_content)}")
+        return xml_content
+        
+    except Exception as e:
+        accessibility_log.error(f"❌ 获取UI树失败: {e}", exc_info=True)
+        return None
+
+
+# 和辅助服务 /api/find 的默认值一致
+ACCESSIBILITY_FIND_DEFAULT_LIMIT = 50
+
+
+def find_from_accessibility(serial: str, display: int, selector: Dict[str, str], window: Optional[str] = None,
+                            limit: int = ACCESSIBILITY_FIND_DEFAULT_LIMIT) -> Dict:
+    """在设备上由辅助服务查节点（/api/find），只传回匹配的节点，不拉整棵树。
+
+    selector 的 key 为 text / textContains / viewId / className。返回的节点属性和 bounds 同 /api/query
+    （bounds 已换算到 display 坐标系）。服务不可用或返回错误时抛异常。
+    """
+    if requests is None:
+        raise Exception("Python requests not installed")
+    _adb_run(["adb", "-s", serial, "forward", "tcp:8765", "tcp:8765"], timeout=3)
+    params = dict(selector, display=display, limit=limit)
+    if window:
+        params["window"] = window
+    response = requests.get("http://localhost:8765/api/find", params=params, timeout=5)
+    data = response.json()
+    if response.status_code != 200 or not data.get("success"):
+        raise Exception(data.get("error") or f"HTTP {response.status_code}")
+
+    origin = accessibility_display_origin([(w or {}).get("bounds") or {} for w in data.get("windows") or []])
+    nodes = []
+    for json_node in data.get("nodes") or []:
+        attrs = accessibility_node_attrs(json_node, origin)
+        b = normalize_accessibility_bounds(json_node.get("bounds") or {}, origin)
+        b = [b.get("left", 0), b.get("top", 0), b.get("right", 0), b.get("bottom", 0)] if b else None
+        nodes.append({
+            "attrs": attrs,
+            "window": (json_node.get("window") or {}).get("title"),
+            "bounds": b,
+            "center": [(b[0] + b[2]) // 2, (b[1] + b[3]) // 2] if b else None,
+        })
+    return {"strategy": data.get("strategy"), "count": data.get("count", len(nodes)), "nodes": nodes}
+
+# --- UI 树转换（uiautomator --windows 格式 -> 单个 display 的 hierarchy） ---
+# 一次 iterparse 把请求的 display 解析成扁平数组（HierarchySnapshot），
+# 再用 NumPy 一次性完成窗口坐标转换和 0 bounds 继承，最后拼接输出；不深拷贝节点，不递归。
+_BOUNDS_RE = re.compile(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]')
+_XML_ATTR_ESCAPES = [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&quot;"),
+                     ("\r", "&#13;"), ("\n", "&#10;"), ("\t", "&#09;")]
+_XML_ATTR_SPECIAL = re.compile(r'[&<>"\r\n\t]')
+HIERARCHY_XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>'
+
+Bounds = Tuple[int, int, int, int]
+
+
+def parse_bounds(bounds_str: Optional[str]) -> Optional[Bounds]:
+    """"[x1,y1][x2,y2]" -> (x1, y1, x2, y2)；解析失败返回 None。"""
+    if not bounds_str:
+        return None
+    m = _BOUNDS_RE.match(bounds_str)
+    if not m:
+        return None
+    return int(m.group(1)), int(m.group(2)), int(m.group(3)), int(m.group(4))
+
+
+def format_bounds(b: Bounds) -> str:
+    return f"[{b[0]},{b[1]}][{b[2]},{b[3]}]"
+
+
+def is_zero_bounds(b: Optional[Bounds]) -> bool:
+    return not b or b[0] == b[2] or b[1] == b[3]
+
+
+def _xml_attr(value: str) -> str:
+    if _XML_ATTR_SPECIAL.search(value):
+        for ch, rep in _XML_ATTR_ESCAPES:
+            value = value.replace(ch, rep)
+    return value
+
+
+def decide_window_transform(dst: Optional[Bounds], src: Optional[Bounds],
+                            ss_type: Optional[str]) -> Tuple[float, float, float, float, str]:
+    """判断窗口内 hierarchy 是否是相对坐标，返回 (scale_x, scale_y, offset_x, offset_y, reason)。
+
+    SS2/SS2MAX 等设备上 window 内 hierarchy 的坐标系可能是“逻辑分辨率”，
+    例如 src 为 [0,0][1906,1440]，window bounds 为 [20,1440][2860,1620]，需要 scale + offset。
+    """
+    identity = (1.0, 1.0, 0.0, 0.0)
+    # 全屏窗口（window起点在原点附近）：hierarchy坐标已经是绝对坐标
+    if dst and dst[0] < 100 and dst[1] < 100:
+        return identity + ("全屏窗口，跳过转换",)
+    if not dst or is_zero_bounds(src):
+        return identity + ("无可用 bounds，保持原坐标",)
+
+    src_x, src_y = src[0], src[1]
+    margin = 200
+    in_window = (dst[0] - margin <= src_x <= dst[2] + margin) and (dst[1] - margin <= src_y <= dst[3] + margin)
+    near_origin = src_x < 50 and src_y < 50
+    much_smaller = (src_x < dst[0] - 100) and (src_y < dst[1] - 100)
+
+    if in_window:
+        return identity + ("节点坐标在window范围内，已是绝对坐标",)
+    if near_origin:
+        reason = "节点坐标接近原点，是相对坐标"
+    elif much_smaller:
+        # SS2特殊处理：如果节点x坐标>1000，大概率是绝对坐标
+        if ss_type == "SS2" and src_x > 1000:
+            return identity + ("SS2设备，节点X>1000，判断为绝对坐标",)
+        reason = "节点坐标远小于window起点，是相对坐标"
+    else:
+        return identity + ("无明确特征，保持不转换（安全策略）",)
+
+    scale_x = max(1, dst[2] - dst[0]) / max(1, src[2] - src[0])
+    scale_y = max(1, dst[3] - dst[1]) / max(1, src[3] - src[1])
+    return (scale_x, scale_y, dst[0] - src[0] * scale_x, dst[1] - src[1] * scale_y, reason)
+
+
+# 窗口坐标转换决策缓存：同一分屏布局（设备 + 窗口标题 + 窗口 bounds + src 坐标系）的重复 dump 不再跑启发式判断
+WINDOW_TRANSFORM_CACHE_SIZE = 256
+window_transform_cache: "OrderedDict[Tuple, Tuple[float, float, float, float, str]]" = OrderedDict()
+window_transform_cache_lock = threading.Lock()
+window_transform_stats = {"hits": 0, "misses": 0}
+IDENTITY_TRANSFORM = (1.0, 1.0, 0.0, 0.0)
+
+
+def cached_window_transform(serial: Optional[str], title: str, dst: Optional[Bounds], src: Optional[Bounds],
+                            ss_type: Optional[str]) -> Tuple[float, float, float, float, str]:
+    key = (serial, ss_type, title, dst, src)
+    with window_transform_cache_lock:
+        hit = window_transform_cache.get(key)
+        if hit is not None:
+            window_transform_cache.move_to_end(key)
+            window_transform_stats["hits"] += 1
+            return hit
+        window_transform_stats["misses"] += 1
+    decision = decide_window_transform(dst, src, ss_type)
+    with window_transform_cache_lock:
+        window_transform_cache[key] = decision
+        while len(window_transform_cache) > WINDOW_TRANSFORM_CACHE_SIZE:
+            window_transform_cache.popitem(last=False)
+    return decision
+
+
+class HierarchySnapshot:
+    """扁平化（前序）的 UI 树。
+
+    attrs[i] 为节点 i 的原始属性，parent[i] 为父节点下标（顶层为 -1），depth[i] 从 0 开始；
+    bounds[i] 为最终（转换、继承后）坐标，bounds_valid[i] 表示该节点有可用 bounds，
+    bounds_changed[i] 表示输出时要用 bounds[i] 改写原 bounds 属性。
+    有 NumPy 时 bounds 为 (N, 4) int32 数组，否则为 tuple 列表。
+    """
+
+    def __init__(self, attrs: List[Dict[str, str]], parent, depth, bounds, bounds_valid, bounds_changed):
+        self.attrs = attrs
+        self.parent = parent
+        self.depth = depth
+        self.bounds = bounds
+        self.bounds_valid = bounds_valid
+        self.bounds_changed = bounds_changed
+
+    def __len__(self) -> int:
+        return len(self.attrs)
+
+    def to_xml(self) -> str:
+        n = len(self.attrs)
+        if not n:
+            return HIERARCHY_XML_HEADER + '<hierarchy rotation="0" />'
+        bounds = self.bounds.tolist() if np is not None and isinstance(self.bounds, np.ndarray) else self.bounds
+        changed = list(self.bounds_changed)
+        depth = list(self.depth)
+        out = [HIERARCHY_XML_HEADER, '<hierarchy rotation="0">']
+        for i, attrib in enumerate(self.attrs):
+            new_bounds = format_bounds(bounds[i]) if changed[i] else None
+            out.append("<node")
+            for key, value in attrib.items():
+                if key == "bounds" and new_bounds is not None:
+                    out.append(f' bounds="{new_bounds}"')
+                else:
+                    out.append(f' {key}="{_xml_attr(value)}"')
+            if new_bounds is not None and "bounds" not in attrib:
+                out.append(f' bounds="{new_bounds}"')
+            next_depth = depth[i + 1] if i + 1 < n else -1
+            if next_depth > depth[i]:
+                out.append(">")
+            else:
+                out.append(" />")
+                out.append("</node>" * (depth[i] - max(next_depth, 0)))
+        out.append("</hierarchy>")
+        return "".join(out)
+
+    def node_attrs(self) -> List[Dict[str, str]]:
+        """每个节点输出时的属性（bounds 已换成转换/继承后的坐标）。"""
+        bounds = self.bounds.tolist() if np is not None and isinstance(self.bounds, np.ndarray) else self.bounds
+        out = []
+        for attrib, changed, b in zip(self.attrs, list(self.bounds_changed), bounds):
+            if changed:
+                attrib = dict(attrib)
+                attrib["bounds"] = format_bounds(b)
+            out.append(attrib)
+        return out
+
+    def node_ids(self) -> List[str]:
+        """稳定节点 id：父节点 id + class + resource-id + 同类兄弟中的序号。
+
+        文本 / 状态 / bounds 变化不影响 id，前后两次 dump 的同一个控件拿到同一个 id。
+        """
+        ids: List[str] = []
+        seen = set()
+        ordinals: Dict[Tuple[str, str, str], int] = {}
+        parent = list(self.parent)
+        for i, attrib in enumerate(self.attrs):
+            parent_id = ids[parent[i]] if parent[i] >= 0 else ""
+            key = (parent_id, attrib.get("class", ""), attrib.get("resource-id", ""))
+            k = ordinals.get(key, 0)
+            ordinals[key] = k + 1
+            node_id = hashlib.blake2b(f"{key[0]}\0{key[1]}\0{key[2]}\0{k}".encode("utf-8"),
+                                      digest_size=6).hexdigest()
+            while node_id in seen:
+                node_id += "~"
+            seen.add(node_id)
+            ids.append(node_id)
+        return ids
+
+
+def _is_actionable(attrib: Dict[str, str]) -> bool:
+    return bool(attrib.get("text") or attrib.get("resource-id") or attrib.get("clickable") == "true")
+
+
+def _resolve_bounds_numpy(raw: List[Bounds], valid: List[bool], node_transform: List[int],
+                          transforms: List[Tuple[float, float, float, float]], parent: List[int],
+                          actionable: List[bool]):
+    """一次向量化完成：affine 转换 + 负坐标失效 + 0 bounds 继承最近的非 0 祖先。"""
+    n = len(raw)
+    b = np.asarray(raw, dtype=np.int64).reshape(n, 4)
+    valid_arr = np.asarray(valid, dtype=bool)
+    t = np.asarray(transforms, dtype=np.float64).reshape(-1, 4)[np.asarray(node_transform, dtype=np.intp)]
+    moved = valid_arr & ~np.all(t == IDENTITY_TRANSFORM, axis=1)
+    if moved.any():
+        scale = t[moved][:, [0, 1, 0, 1]]
+        offset = t[moved][:, [2, 3, 2, 3]]
+        # np.rint 与 Python round() 一样是 banker's rounding
+        b[moved] = np.rint(b[moved] * scale + offset).astype(np.int64)
+    changed = moved.copy()
+    # 转换后出现负坐标（窗口外）：和 bounds 字符串解析规则一致，视为无效 bounds
+    valid_arr &= ~(moved & (b.min(axis=1) < 0))
+    nonzero = valid_arr & (b[:, 0] != b[:, 2]) & (b[:, 1] != b[:, 3])
+
+    # 最近的非 0 祖先（含自身）：pointer jumping，O(N log depth)；下标 n 为哨兵（无祖先）
+    par = np.asarray(parent, dtype=np.intp)
+    par = np.where(par < 0, n, par)
+    nearest = np.append(np.where(nonzero, np.arange(n), par), n)
+    while True:
+        jumped = nearest[nearest]
+        if np.array_equal(jumped, nearest):
+            break
+        nearest = jumped
+    inherited = nearest[par]
+    fix = ~nonzero & np.asarray(actionable, dtype=bool) & (inherited < n)
+    if fix.any():
+        b[fix] = b[inherited[fix]]
+        valid_arr |= fix
+        changed |= fix
+    return b.astype(np.int32), valid_arr, changed
+
+
+def _resolve_bounds_python(raw: List[Bounds], valid: List[bool], node_transform: List[int],
+                           transforms: List[Tuple[float, float, float, float]], parent: List[int],
+                           actionable: List[bool]):
+    """_resolve_bounds_numpy 的纯 Python 版本（没装 NumPy 时用）。"""
+    n = len(raw)
+    bounds: List[Bounds] = list(raw)
+    valid_out = list(valid)
+    changed = [False] * n
+    nearest = [-1] * n  # 最近的非 0 祖先（含自身）
+    for i in range(n):
+        b = bounds[i]
+        sx, sy, ox, oy = transforms[node_transform[i]]
+        if valid_out[i] and (sx, sy, ox, oy) != IDENTITY_TRANSFORM:
+            b = (int(round(b[0] * sx + ox)), int(round(b[1] * sy + oy)),
+                 int(round(b[2] * sx + ox)), int(round(b[3] * sy + oy)))
+            bounds[i] = b
+            changed[i] = True
+            if min(b) < 0:
+                valid_out[i] = False
+        inherited = nearest[parent[i]] if parent[i] >= 0 else -1
+        if valid_out[i] and not is_zero_bounds(b):
+            nearest[i] = i
+        elif actionable[i] and inherited >= 0:
+            bounds[i] = bounds[inherited]
+            valid_out[i] = True
+            changed[i] = True
+            nearest[i] = inherited
+        else:
+            nearest[i] = inherited
+    return bounds, valid_out, changed
+
+
+class _DisplayNodes:
+    """解析 <displays> 时一个 display 的节点收集器（前序平行数组 + 窗口列表）。"""
+
+    def __init__(self, display_id: str):
+        self.display_id = display_id
+        self.attrs: List[Dict[str, str]] = []
+        self.parent: List[int] = []
+        self.depth: List[int] = []
+        self.raw: List[Bounds] = []
+        self.valid: List[bool] = []
+        self.actionable: List[bool] = []
+        self.node_top: List[int] = []
+        # 每个窗口: (title, window bounds, [顶层节点下标])
+        self.windows: List[Tuple[str, Optional[Bounds], List[int]]] = []
+
+    def add(self, attrib: Dict[str, str], stack: List[int]) -> int:
+        idx = len(self.attrs)
+        b = parse_bounds(attrib.get("bounds"))
+        self.attrs.append(attrib)
+        self.parent.append(stack[-1] if stack else -1)
+        self.depth.append(len(stack))
+        self.raw.append(b or (0, 0, 0, 0))
+        self.valid.append(b is not None)
+        self.actionable.append(_is_actionable(attrib))
+        if stack:
+            self.node_top.append(self.node_top[stack[-1]])
+        else:
+            self.node_top.append(idx)
+            self.windows[-1][2].append(idx)
+        return idx
+
+    def finish(self, serial: Optional[str], ss_type: Optional[str]) -> HierarchySnapshot:
+        raw, valid = self.raw, self.valid
+        # 每个顶层节点一个转换：src 坐标系为它自身 bounds；为 0 时用它和同窗口所有非 0 顶层 bounds 的并集
+        transforms: List[Tuple[float, float, float, float]] = []
+        top_transform: Dict[int, int] = {}
+        # 每个窗口的转换决策统计只用于日志，debug 关闭时不统计
+        debug = hierarchy_log.debug_enabled
+        for window_no, (title, window_bounds, tops) in enumerate(self.windows, 1):
+            top_nonzero = [raw[t] for t in tops if valid[t] and not is_zero_bounds(raw[t])]
+            decisions: Dict[str, int] = {}
+            for t in tops:
+                src = raw[t] if valid[t] else None
+                if is_zero_bounds(src):
+                    for b in top_nonzero:
+                        src = b if src is None else (min(src[0], b[0]), min(src[1], b[1]),
+                                                     max(src[2], b[2]), max(src[3], b[3]))
+                sx, sy, ox, oy, reason = cached_window_transform(serial, title, window_bounds, src, ss_type)
+                if debug:
+                    decisions[reason] = decisions.get(reason, 0) + 1
+                top_transform[t] = len(transforms)
+                transforms.append((sx, sy, ox, oy))
+            if debug:
+                hierarchy_log.debug(f"display {self.display_id} 窗口{window_no}: title='{title}', "
+                                    f"bounds={format_bounds(window_bounds) if window_bounds else ''}, 坐标: {decisions}",
+                                    display=self.display_id, window=title, decisions=decisions)
+
+        node_transform = [top_transform[t] for t in self.node_top]
+        resolve = _resolve_bounds_numpy if np is not None and self.attrs else _resolve_bounds_python
+        bounds, bounds_valid, bounds_changed = resolve(raw, valid, node_transform,
+                                                       transforms or [IDENTITY_TRANSFORM],
+                                                       self.parent, self.actionable)
+        if np is not None:
+            parent_arr = np.asarray(self.parent, dtype=np.int32)
+            depth_arr = np.asarray(self.depth, dtype=np.int32)
+        else:
+            parent_arr, depth_arr = self.parent, self.depth
+        return HierarchySnapshot(self.attrs, parent_arr, depth_arr, bounds, bounds_valid, bounds_changed)
+
+
+def parse_uiautomator_displays(xml_content: str, serial: Optional[str] = None, ss_type: Optional[str] = None,
+                               only: Optional[str] = None) -> Optional[Dict[str, HierarchySnapshot]]:
+    """把 `uiautomator dump --windows` 的 <displays> 输出一次解析成 {display id: HierarchySnapshot}。
+
+    一次 iterparse，不深拷贝、不递归；only 指定时其它 display 边解析边丢弃。
+    bounds 解析成数组后统一做窗口坐标转换和 0 bounds 继承。非 <displays> 格式返回 None。
+    """
+    collectors: Dict[str, _DisplayNodes] = {}
+    cur: Optional[_DisplayNodes] = None
+    in_window_hierarchy = False
+    stack: List[int] = []
+
+    first = True
+    for event, elem in ET.iterparse(io.StringIO(xml_content), events=("start", "end")):
+        tag = elem.tag
+        if first:
+            first = False
+            if tag != "displays":
+                return None
+        if event == "start":
+            if tag == "display":
+                display_id = elem.get("id", "unknown")
+                if only is None or display_id == only:
+                    cur = collectors.setdefault(display_id, _DisplayNodes(display_id))
+            elif cur is None:
+                continue
+            elif tag == "window":
+                cur.windows.append((elem.get("title", ""), parse_bounds(elem.get("bounds", "")), []))
+            elif tag == "hierarchy" and not stack:
+                in_window_hierarchy = True
+            elif tag == "node" and in_window_hierarchy and cur.windows:
+                # 拷贝一份：纯 Python 的 ElementTree 在 elem.clear() 时会清空 attrib 字典本身
+                stack.append(cur.add(dict(elem.attrib), stack))
+        else:
+            if tag == "node" and cur is not None and in_window_hierarchy and stack:
+                stack.pop()
+                # 属性已经拷贝收集，释放子元素
+                elem.clear()
+            elif tag == "hierarchy" and in_window_hierarchy and not stack:
+                in_window_hierarchy = False
+            elif tag in ("node", "window", "display"):
+                if tag == "display":
+                    cur = None
+                elem.clear()
+
+    return {display_id: nodes.finish(serial, ss_type) for display_id, nodes in collectors.items()}
+
+
+def parse_uiautomator_windows(xml_content: str, display: int, serial: Optional[str] = None,
+                              ss_type: Optional[str] = None) -> Optional[HierarchySnapshot]:
+    """只解析 <displays> 里的一个 display（没有该 display 时为空树）。非 <displays> 格式返回 None。"""
+    target = str(display)
+    parsed = parse_uiautomator_displays(xml_content, serial, ss_type, only=target)
+    if parsed is None:
+        return None
+    snapshot = parsed.get(target)
+    if snapshot is None:
+        snapshot = _DisplayNodes(target).finish(serial, ss_type)
+    return snapshot
+
+
+def transform_uiautomator_xml(xml_content: str, display: int, ss_type: Optional[str] = None,
+                              serial: Optional[str] = None) -> str:
+    """把 `uiautomator dump --windows` 的 <displays> 输出转换成单个 display 的 <hierarchy>。
+
+    非 <displays> 格式（单 hierarchy）原样返回。
+    """
+    snapshot = parse_uiautomator_windows(xml_content, display, serial, ss_type)
+    if snapshot is None:
+        return xml_content
+    return snapshot.to_xml()
+
+
+def snapshot_from_hierarchy_xml(xml_content: str) -> HierarchySnapshot:
+    """普通 <hierarchy> XML（单 hierarchy dump / 辅助服务 / 缓存）-> HierarchySnapshot，不做坐标转换。"""
+    attrs: List[Dict[str, str]] = []
+    parent: List[int] = []
+    depth: List[int] = []
+    raw: List[Bounds] = []
+    valid: List[bool] = []
+    stack: List[int] = []
+    for event, elem in ET.iterparse(io.StringIO(xml_content), events=("start", "end")):
+        if elem.tag != "node":
+            continue
+        if event == "start":
+            b = parse_bounds(elem.attrib.get("bounds"))
+            # 拷贝一份：下面的 elem.clear() 在纯 Python 的 ElementTree 里会清空 attrib 字典本身
+            attrs.append(dict(elem.attrib))
+            parent.append(stack[-1] if stack else -1)
+            depth.append(len(stack))
+            raw.append(b or (0, 0, 0, 0))
+            valid.append(b is not None)
+            stack.append(len(attrs) - 1)
+        else:
+            stack.pop()
+            elem.clear()
+    changed = [False] * len(attrs)
+    if np is not None:
+        return HierarchySnapshot(attrs, np.asarray(parent, dtype=np.int32), np.asarray(depth, dtype=np.int32),
+                                 np.asarray(raw, dtype=np.int32).reshape(-1, 4), np.asarray(valid, dtype=bool),
+                                 np.asarray(changed, dtype=bool))
+    return HierarchySnapshot(attrs, parent, depth, raw, valid, changed)
+
+
+def hierarchy_snapshot(result: Dict) -> HierarchySnapshot:
+    """_fetch_hierarchy 的结果 -> snapshot（uiautomator 路径已经带了，其它来源从 XML 解析）。"""
+    snapshot = result.get("snapshot")
+    if snapshot is None:
+        snapshot = snapshot_from_hierarchy_xml(result["xml"])
+    return snapshot
+
+
+# --- columnar 格式（format=columnar） ---
+# 整棵树编码为平行数组，前端不用 DOMParser / 逐节点正则解析 bounds：
+#   parent/depth/index: int 数组（前序）；bounds: 扁平 int32 [x1,y1,x2,y2,...]，-1 表示无 bounds
+#   class/package/resource-id/text/content-desc: strings 字符串表下标，-1 表示没有该属性
+#   flags: 布尔属性位图（位定义见 flag_bits，只列出树里出现过的）；其它属性放在稀疏的 extras 里
+COLUMNAR_STRING_ATTRS = ["class", "package", "resource-id", "text", "content-desc"]
+COLUMNAR_FLAGS = ["checkable", "checked", "clickable", "enabled", "focusable", "focused", "scrollable",
+                  "long-clickable", "password", "selected", "visible-to-user"]
+COLUMNAR_ENCODINGS = {"json": "application/json", "msgpack": "application/x-msgpack"}
+
+
+def hierarchy_to_columnar(snapshot: HierarchySnapshot) -> Dict:
+    n = len(snapshot)
+    strings: List[str] = []
+    string_ids: Dict[str, int] = {}
+    columns: Dict[str, List[int]] = {name: [-1] * n for name in COLUMNAR_STRING_ATTRS}
+    index = [-1] * n
+    flags = [0] * n
+    flags_seen = 0
+    extras: Dict[str, Dict[str, str]] = {}
+    flag_bits = {name: bit for bit, name in enumerate(COLUMNAR_FLAGS)}
+    known = set(COLUMNAR_STRING_ATTRS) | set(COLUMNAR_FLAGS) | {"index", "bounds"}
+
+    valid = list(snapshot.bounds_valid)
+    if np is not None and isinstance(snapshot.bounds, np.ndarray):
+        bounds_arr = snapshot.bounds.astype(np.int32, copy=True)
+        bounds_arr[~np.asarray(snapshot.bounds_valid, dtype=bool)] = -1
+        bounds = bounds_arr.reshape(-1).tolist()
+        parent = np.asarray(snapshot.parent).tolist()
+        depth = np.asarray(snapshot.depth).tolist()
+    else:
+        bounds = []
+        for b, ok in zip(snapshot.bounds, valid):
+            bounds.extend(b if ok else (-1, -1, -1, -1))
+        parent = list(snapshot.parent)
+        depth = list(snapshot.depth)
+
+    for i, attrib in enumerate(snapshot.attrs):
+        mask = 0
+        for key, value in attrib.items():
+            column = columns.get(key)
+            if column is not None:
+                sid = string_ids.get(value)
+                if sid is None:
+                    sid = string_ids[value] = len(strings)
+                    strings.append(value)
+                column[i] = sid
+            elif key in flag_bits:
+                bit = 1 << flag_bits[key]
+                flags_seen |= bit
+                if value == "true":
+                    mask |= bit
+            elif key == "index" and value.isdigit():
+                index[i] = int(value)
+            elif key not in known or (key == "bounds" and not valid[i]):
+                # 解析不了的 bounds 原样保留
+                extras.setdefault(str(i), {})[key] = value
+        flags[i] = mask
+
+    payload = {
+        "format": "columnar",
+        "count": n,
+        "parent": parent,
+        "depth": depth,
+        "index": index,
+        "bounds": bounds,
+        "strings": strings,
+        "flags": flags,
+        "flag_bits": {name: bit for name, bit in flag_bits.items() if flags_seen & (1 << bit)},
+        "extras": extras,
+    }
+    for name, column in columns.items():
+        payload[name.replace("-", "_")] = column
+    return payload
+
+
+def encode_payload(payload: Dict, encoding: str = "json") -> Response:
+    """用最快的可用编码器输出（orjson / msgpack，没装时退回标准库 json）。"""
+    if encoding == "msgpack":
+        if msgpack is None:
+            raise HTTPException(status_code=400, detail="msgpack is not installed on the server")
+        return Response(content=msgpack.packb(payload, use_bin_type=True), media_type=COLUMNAR_ENCODINGS["msgpack"])
+    if orjson is not None:
+        content = orjson.dumps(payload)
+    else:
+        content = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return Response(content=content, media_type=COLUMNAR_ENCODINGS["json"])
+
+
+# --- 增量 UI 树（?since=<version>） ---
+# 每个 (serial, display, source) 保留最近几个版本（节点 id -> 输出属性）。
+# 客户端带上手里的版本号，服务端只回 added / removed / changed；
+# 基础版本已被淘汰、兄弟顺序变了或者改动太多时，退回完整快照。
+HIERARCHY_VERSION_HISTORY = 8
+# 改动节点数超过新树节点数的这个比例就直接发完整快照
+HIERARCHY_DELTA_MAX_RATIO = 0.5
+
+
+class HierarchyVersion:
+    def __init__(self, version: int, snapshot: HierarchySnapshot):
+        self.version = version
+        self.snapshot = snapshot
+        self.ids = snapshot.node_ids()
+        attrs = snapshot.node_attrs()
+        parent = list(snapshot.parent)
+        self.attrs: Dict[str, Dict[str, str]] = dict(zip(self.ids, attrs))
+        self.parent: Dict[str, Optional[str]] = {
+            node_id: (self.ids[p] if p >= 0 else None) for node_id, p in zip(self.ids, parent)
+        }
+        self.order: Dict[str, int] = {node_id: i for i, node_id in enumerate(self.ids)}
+        self.spatial: Optional["HierarchySpatialIndex"] = None
+        self.query: Optional["HierarchyQueryIndex"] = None
+
+    def spatial_index(self) -> "HierarchySpatialIndex":
+        """命中测试用的网格索引，第一次用到时才建（同一版本只建一次）。"""
+        if self.spatial is None:
+            self.spatial = HierarchySpatialIndex(self.snapshot)
+        return self.spatial
+
+    def query_index(self) -> "HierarchyQueryIndex":
+        """选择器查询用的倒排索引，同样按版本懒构建。"""
+        if self.query is None:
+            self.query = HierarchyQueryIndex(self)
+        return self.query
+
+    def same_tree(self, other: "HierarchyVersion") -> bool:
+        return self.ids == other.ids and self.attrs == other.attrs
+
+
+class HierarchyVersionStore:
+    def __init__(self, history: int = HIERARCHY_VERSION_HISTORY):
+        self.lock = threading.Lock()
+        self.history = history
+        self.next_version = 1
+        # (serial, display, source) -> 版本列表（旧 -> 新）
+        self.versions: Dict[Tuple, List[HierarchyVersion]] = {}
+        # (serial, display) -> (key, 最近一次登记的版本)，不区分数据源
+        self.latest: Dict[Tuple, Tuple[Tuple, HierarchyVersion]] = {}
+        self.stats = {"full": 0, "delta": 0, "unchanged": 0, "evicted": 0, "fallback": 0}
+
+    def commit(self, key: Tuple, snapshot: HierarchySnapshot) -> HierarchyVersion:
+        """登记一次 dump；内容和最新版本一样就沿用旧版本号。"""
+        with self.lock:
+            chain = self.versions.get(key)
+            if chain and chain[-1].snapshot is snapshot:
+                # single-flight 共享的同一份结果
+                self.latest[key[:2]] = (key, chain[-1])
+                return chain[-1]
+        entry = HierarchyVersion(0, snapshot)
+        with self.lock:
+            chain = self.versions.setdefault(key, [])
+            if chain and chain[-1].same_tree(entry):
+                chain[-1].snapshot = snapshot
+                entry = chain[-1]
+            else:
+                entry.version = self.next_version
+                self.next_version += 1
+                chain.append(entry)
+                del chain[:-self.history]
+            self.latest[key[:2]] = (key, entry)
+            return entry
+
+    def current(self, serial: str, display: int) -> Optional[Tuple[Tuple, HierarchyVersion]]:
+        with self.lock:
+            return self.latest.get((serial, display))
+
+    def base(self, key: Tuple, since: int) -> Optional[HierarchyVersion]:
+        with self.lock:
+            for entry in self.versions.get(key, ()):
+                if entry.version == since:
+                    return entry
+        return None
+
+    def delta(self, key: Tuple, since: int, current: HierarchyVersion) -> Optional[Dict]:
+        """current 相对 since 的增量；做不了增量时返回 None（调用方发完整快照）。"""
+        if since == current.version:
+            with self.lock:
+                self.stats["unchanged"] += 1
+            return {"format": "delta", "version": current.version, "base": since, "count": len(current.ids),
+                    "added": [], "removed": [], "changed": []}
+        old = self.base(key, since)
+        if old is None:
+            with self.lock:
+                self.stats["evicted"] += 1
+            return None
+
+        # 保留下来的节点前序顺序必须不变，否则增量表达不了（兄弟重排）
+        last = -1
+        for node_id in current.ids:
+            pos = old.order.get(node_id)
+            if pos is None:
+                continue
+            if pos < last:
+                with self.lock:
+                    self.stats["fallback"] += 1
+                return None
+            last = pos
+
+        limit = max(1, int(len(current.ids) * HIERARCHY_DELTA_MAX_RATIO))
+        removed = [node_id for node_id in old.ids if node_id not in current.order]
+        added = []
+        changed = []
+        prev_sibling: Dict[Optional[str], Optional[str]] = {}
+        for node_id in current.ids:
+            parent_id = current.parent[node_id]
+            after = prev_sibling.get(parent_id)
+            prev_sibling[parent_id] = node_id
+            attrs = current.attrs[node_id]
+            old_attrs = old.attrs.get(node_id)
+            if old_attrs is None:
+                added.append({"id": node_id, "parent": parent_id, "after": after, "attrs": attrs})
+            elif old_attrs != attrs:
+                set_attrs = {k: v for k, v in attrs.items() if old_attrs.get(k) != v}
+                unset = [k for k in old_attrs if k not in attrs]
+                changed.append({"id": node_id, "set": set_attrs, "unset": unset})
+            if len(added) + len(changed) + len(removed) > limit:
+                with self.lock:
+                    self.stats["fallback"] += 1
+                return None
+
+        with self.lock:
+            self.stats["delta"] += 1
+        return {"format": "delta", "version": current.version, "base": since, "count": len(current.ids),
+                "added": added, "removed": removed, "changed": changed}
+
+    def count_full(self):
+        with self.lock:
+            self.stats["full"] += 1
+
+    def forget(self, serial: str):
+        with self.lock:
+            for key in [k for k in self.versions if k[0] == serial]:
+                del self.versions[key]
+            for key in [k for k in self.latest if k[0] == serial]:
+                del self.latest[key]
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return dict(self.stats, latest=self.next_version - 1,
+                        chains={f"{k[0]}:{k[1]}:{k[2]}": [e.version for e in v] for k, v in self.versions.items()})
+
+
+hierarchy_versions = HierarchyVersionStore()
+
+
+# --- 命中测试（/api/hit） ---
+# 在 bounds 上建均匀网格：每个格子记录覆盖它的节点（前序），查询时只检查点所在格子里的候选。
+# 网格按树的外接范围切成最多 HIERARCHY_GRID_CELLS x HIERARCHY_GRID_CELLS 格。
+HIERARCHY_GRID_CELLS = 32
+
+
+class HierarchySpatialIndex:
+    """节点 bounds 的均匀网格索引。
+
+    只收可见节点：bounds 可用、面积 > 0、且不是 visible-to-user="false"。
+    命中规则和前端一致：包含该点（含边界）的节点里面积最小的；面积相同取前序靠后的（后画的在上面）。
+    """
+
+    def __init__(self, snapshot: HierarchySnapshot, cells: int = HIERARCHY_GRID_CELLS):
+        bounds = snapshot.bounds.tolist() if np is not None and isinstance(snapshot.bounds, np.ndarray) \
+            else list(snapshot.bounds)
+        valid = list(snapshot.bounds_valid)
+        self.parent: List[int] = [int(p) for p in snapshot.parent]
+        self.bounds: List[Bounds] = bounds
+        self.area: List[int] = [(b[2] - b[0]) * (b[3] - b[1]) for b in bounds]
+        members = [i for i, attrib in enumerate(snapshot.attrs)
+                   if valid[i] and self.area[i] > 0 and attrib.get("visible-to-user") != "false"]
+        self.cells: Dict[int, List[int]] = {}
+        if not members:
+            self.x0 = self.y0 = 0
+            self.cell_w = self.cell_h = 1
+            self.cols = 1
+            return
+        self.x0 = min(bounds[i][0] for i in members)
+        self.y0 = min(bounds[i][1] for i in members)
+        x1 = max(bounds[i][2] for i in members)
+        y1 = max(bounds[i][3] for i in members)
+        self.cell_w = max(1, -(-(x1 - self.x0 + 1) // cells))
+        self.cell_h = max(1, -(-(y1 - self.y0 + 1) // cells))
+        self.cols = cells
+        for i in members:
+            b = bounds[i]
+            cx0, cx1 = (b[0] - self.x0) // self.cell_w, (b[2] - self.x0) // self.cell_w
+            cy0, cy1 = (b[1] - self.y0) // self.cell_h, (b[3] - self.y0) // self.cell_h
+            for cy in range(cy0, cy1 + 1):
+                row = cy * self.cols
+                for cx in range(cx0, cx1 + 1):
+                    self.cells.setdefault(row + cx, []).append(i)
+
+    def hits(self, x: int, y: int) -> List[int]:
+        """包含 (x, y) 的所有节点（前序）。"""
+        if x < self.x0 or y < self.y0:
+            return []
+        cx, cy = (x - self.x0) // self.cell_w, (y - self.y0) // self.cell_h
+        if cx >= self.cols or cy >= self.cols:
+            return []
+        out = []
+        for i in self.cells.get(cy * self.cols + cx, ()):
+            b = self.bounds[i]
+            if b[0] <= x <= b[2] and b[1] <= y <= b[3]:
+                out.append(i)
+        return out
+
+    def best(self, x: int, y: int) -> Optional[int]:
+        best = None
+        for i in self.hits(x, y):
+            if best is None or self.area[i] <= self.area[best]:
+                best = i
+        return best
+
+    def ancestors(self, i: int) -> List[int]:
+        """i 以及它的所有祖先（根在前）。"""
+        chain = []
+        while i >= 0:
+            chain.append(i)
+            i = self.parent[i]
+        chain.reverse()
+        return chain
+
+
+# --- 选择器查询（/api/query） ---
+# 每个版本建一次倒排索引：属性值 -> 节点、resource-id / class 短名 -> 节点、
+# text / content-desc 的字符三元组 -> 属性值（contains 查询先用三元组缩小候选再核对）。
+# 选择器编译成 [(axis, 名字, 条件...)] 的步骤列表，最后一步走索引取候选，前面的步骤沿祖先链核对。
+QUERY_INDEXED_ATTRS = ["resource-id", "text", "content-desc", "class", "package"] + COLUMNAR_FLAGS
+QUERY_TRIGRAM_ATTRS = ["text", "content-desc"]
+QUERY_DEFAULT_LIMIT = 100
+
+# 一个条件：(属性, op, 值)，op 为 eq / contains / short（resource-id / class 按短名比较）
+QueryCond = Tuple[str, str, str]
+
+_XPATH_STEP_RE = re.compile(r"(//|/)([\w.$*-]+)")
+_XPATH_PRED_RE = re.compile(
+    r"""\[\s*(?:@([\w-]+)\s*=\s*(['"])(.*?)\2|contains\(\s*@([\w-]+)\s*,\s*(['"])(.*?)\5\s*\))\s*\]""")
+
+
+def _short_name(attr: str, value: str) -> str:
+    if attr == "resource-id":
+        return value.rsplit("/", 1)[-1]
+    return value.rsplit(".", 1)[-1]
+
+
+def query_cond(attr: str, op: str, value: str) -> QueryCond:
+    """resource-id 没写包名（不含 "/"）、class 没写包名（不含 "."）时按短名匹配。"""
+    if op == "eq" and ((attr == "resource-id" and "/" not in value) or (attr == "class" and "." not in value)):
+        return (attr, "short", value)
+    return (attr, op, value)
+
+
+def parse_xpath_selector(xpath: str) -> List[Tuple[str, List[QueryCond]]]:
+    """XPath 子集 -> [(axis, conds)]。
+
+    支持 //Class、/Class、* / node、[@attr='v']、[contains(@attr,'v')]，例如
+    //FrameLayout[@resource-id='id/panel']//TextView[contains(@text,'播放')]。
+    第一步用 / 表示顶层节点；步骤只针对 <node>，不含外层 <hierarchy>。
+    """
+    steps = []
+    pos = 0
+    xpath = xpath.strip()
+    while pos < len(xpath):
+        m = _XPATH_STEP_RE.match(xpath, pos)
+        if not m:
+            raise ValueError(f"bad xpath near: {xpath[pos:pos + 20]!r}")
+        axis, name = m.group(1), m.group(2)
+        pos = m.end()
+        conds: List[QueryCond] = []
+        if name not in ("*", "node"):
+            conds.append(query_cond("class", "eq", name))
+        while pos < len(xpath) and xpath[pos] == "[":
+            p = _XPATH_PRED_RE.match(xpath, pos)
+            if not p:
+                raise ValueError(f"unsupported predicate near: {xpath[pos:pos + 20]!r}")
+            if p.group(1):
+                conds.append(query_cond(p.group(1), "eq", p.group(3)))
+            else:
+                conds.append((p.group(4), "contains", p.group(6)))
+            pos = p.end()
+        steps.append((axis, conds))
+    if not steps:
+        raise ValueError("empty xpath")
+    return steps
+
+
+def _trigrams(value: str):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class HierarchyQueryIndex:
+    def __init__(self, version: "HierarchyVersion"):
+        self.attrs: List[Dict[str, str]] = [version.attrs[node_id] for node_id in version.ids]
+        self.parent: List[int] = [int(p) for p in version.snapshot.parent]
+        # attr -> value -> [节点下标]（前序）
+        self.exact: Dict[str, Dict[str, List[int]]] = {attr: {} for attr in QUERY_INDEXED_ATTRS}
+        self.short: Dict[str, Dict[str, List[int]]] = {"resource-id": {}, "class": {}}
+        # attr -> 三元组 -> {属性值}
+        self.trigrams: Dict[str, Dict[str, set]] = {attr: {} for attr in QUERY_TRIGRAM_ATTRS}
+        for i, attrib in enumerate(self.attrs):
+            for attr, value in attrib.items():
+                postings = self.exact.get(attr)
+                if postings is None:
+                    continue
+                postings.setdefault(value, []).append(i)
+                if attr in self.short:
+                    self.short[attr].setdefault(_short_name(attr, value), []).append(i)
+        for attr in QUERY_TRIGRAM_ATTRS:
+            grams = self.trigrams[attr]
+            for value in self.exact[attr]:
+                for gram in _trigrams(value):
+                    grams.setdefault(gram, set()).add(value)
+
+    def _lookup(self, cond: QueryCond) -> Optional[List[int]]:
+        """用索引取满足单个条件的节点；该条件没有索引可用时返回 None。"""
+        attr, op, value = cond
+        if op == "eq" and attr in self.exact:
+            return self.exact[attr].get(value, [])
+        if op == "short" and attr in self.short:
+            return self.short[attr].get(value, [])
+        if op == "contains" and attr in self.exact:
+            if attr in self.trigrams and len(value) >= 3:
+                values = None
+                for gram in _trigrams(value):
+                    hit = self.trigrams[attr].get(gram, set())
+                    values = hit if values is None else values & hit
+                    if not values:
+                        return []
+            else:
+                # 太短没法用三元组：扫去重后的属性值（远少于节点数）
+                values = self.exact[attr].keys()
+            out: List[int] = []
+            for v in values:
+                if value in v:
+                    out.extend(self.exact[attr][v])
+            out.sort()
+            return out
+        return None
+
+    def _matches(self, i: int, conds: List[QueryCond]) -> bool:
+        attrib = self.attrs[i]
+        for attr, op, value in conds:
+            actual = attrib.get(attr)
+            if actual is None:
+                return False
+            if op == "eq":
+                if actual != value:
+                    return False
+            elif op == "short":
+                if actual != value and _short_name(attr, actual) != value:
+                    return False
+            elif value not in actual:
+                return False
+        return True
+
+    def _path_matches(self, i: int, steps: List[Tuple[str, List[QueryCond]]], k: int) -> bool:
+        """节点 i 满足第 k 步，且祖先链满足前面的步骤。"""
+        if not self._matches(i, steps[k][1]):
+            return False
+        axis = steps[k][0]
+        if k == 0:
+            return axis == "//" or self.parent[i] < 0
+        p = self.parent[i]
+        if axis == "/":
+            return p >= 0 and self._path_matches(p, steps, k - 1)
+        while p >= 0:
+            if self._path_matches(p, steps, k - 1):
+                return True
+            p = self.parent[p]
+        return False
+
+    def find(self, steps: List[Tuple[str, List[QueryCond]]]) -> List[int]:
+        conds = steps[-1][1]
+        candidates = None
+        for cond in conds:
+            postings = self._lookup(cond)
+            if postings is not None and (candidates is None or len(postings) < len(candidates)):
+                candidates = postings
+        if candidates is None:
+            candidates = range(len(self.attrs))
+        last = len(steps) - 1
+        return [i for i in candidates if self._path_matches(i, steps, last)]
+
+
+def fetch_hierarchy_version(display: int, force_accessibility: bool = False) -> Tuple[Dict, Tuple, HierarchyVersion]:
+    """拉取（或复用 single-flight 结果）UI 树并登记版本，返回 (result, version_key, version)。"""
+    kind = "hierarchy:accessibility" if force_accessibility else "hierarchy"
+    result = single_flight.do(
+        (current_serial, str(display), kind),
+        lambda: _fetch_hierarchy(display, force_accessibility),
+        fresh=SINGLE_FLIGHT_FRESH_SECONDS["hierarchy"],
+    )
+    version_key = (current_serial, display, result.get("source"))
+    return result, version_key, hierarchy_versions.commit(version_key, hierarchy_snapshot(result))
+
+
+def current_hierarchy_version(display: int, refresh: bool = False) -> Tuple[Tuple, HierarchyVersion]:
+    """该 display 最近登记的版本；已经过了缓存有效期（TTL、点击/滑动/返回、UI 变化事件作废）时重新拉取。
+
+    versions 里的 latest 本身不会过期，只能以 hierarchy_cache 里同一份结果是否还有效为准。
+    """
+    cached = None if refresh else hierarchy_versions.current(current_serial, display)
+    if cached is not None:
+        version_key, current = cached
+        result = hierarchy_cache.get(version_key)
+        # 缓存里是更新的一次 dump（还没登记版本）时也要重新拉
+        if result is not None and result.get("snapshot", current.snapshot) is current.snapshot:
+            return version_key, current
+    _, version_key, current = fetch_hierarchy_version(display)
+    return version_key, current
+
+
+@app.get("/api/hierarchy")
+def get_hierarchy(display: int = 0, force_accessibility: bool = False, format: str = "xml",
+                  encoding: str = "json", since: Optional[int] = None):
+    """UI 树。
+
+    - format: xml（默认，{"xml": ..., "source": ...}）/ columnar（平行数组，见 hierarchy_to_columnar）
+    - encoding: columnar / delta 时的编码，json / msgpack
+    - since: 客户端手里的版本号；能做增量时返回 {"format": "delta", ...}，否则返回完整快照。
+      带 since 的完整快照会附上前序的节点 id 列表（ids），供下次应用增量。
+    """
+    global current_serial
+    if not current_serial:
+         raise HTTPException(status_code=400, detail="Device not connected")
+    if format not in ("xml", "columnar"):
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    if encoding not in COLUMNAR_ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"Unsupported encoding: {encoding}")
+    prefetcher.touch(current_serial, str(display), force_accessibility)
+    result, version_key, current = fetch_hierarchy_version(display, force_accessibility)
+    meta = {k: v for k, v in result.items() if k not in ("xml", "snapshot")}
+    meta["version"] = current.version
+    if since is not None:
+        delta = hierarchy_versions.delta(version_key, since, current)
+        if delta is not None:
+            delta.update(meta)
+            return encode_payload(delta, encoding)
+        meta["ids"] = current.ids
+    hierarchy_versions.count_full()
+    if format == "xml":
+        return dict(meta, xml=result["xml"])
+    payload = hierarchy_to_columnar(current.snapshot)
+    payload.update(meta)
+    return encode_payload(payload, encoding)
+
+
+@app.get("/api/query")
+def query_hierarchy(display: int = 0, xpath: Optional[str] = None, resource_id: Optional[str] = None,
+                    text: Optional[str] = None, text_contains: Optional[str] = None,
+                    desc: Optional[str] = None, desc_contains: Optional[str] = None,
+                    class_name: Optional[str] = None, package: Optional[str] = None,
+                    clickable: Optional[bool] = None, enabled: Optional[bool] = None,
+                    checked: Optional[bool] = None, selected: Optional[bool] = None,
+                    scrollable: Optional[bool] = None, limit: int = QUERY_DEFAULT_LIMIT,
+                    refresh: bool = False):
+    """在缓存的 UI 树上按选择器查节点，缓存有效时不重新 dump（没有、已过期或 refresh=true 时先拉一次）。
+
+    xpath 支持子集（见 parse_xpath_selector）；其余参数都是对最终节点的附加条件（AND）。
+    resource_id / class_name 不带包名时按短名匹配。返回节点的前序下标、稳定 id、属性、bounds 和中心点。
+    """
+    if not current_serial:
+        raise HTTPException(status_code=400, detail="Device not connected")
+    try:
+        steps = parse_xpath_selector(xpath) if xpath else [("//", [])]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    conds = steps[-1][1]
+    for attr, value in (("resource-id", resource_id), ("text", text), ("content-desc", desc),
+                        ("class", class_name), ("package", package)):
+        if value is not None:
+            conds.append(query_cond(attr, "eq", value))
+    for attr, value in (("text", text_contains), ("content-desc", desc_contains)):
+        if value is not None:
+            conds.append((attr, "contains", value))
+    for attr, value in (("clickable", clickable), ("enabled", enabled), ("checked", checked),
+                        ("selected", selected), ("scrollable", scrollable)):
+        if value is not None:
+            conds.append((attr, "eq", "true" if value else "false"))
+
+    version_key, current = current_hierarchy_version(display, refresh)
+    t0 = time.perf_counter()
+    matches = current.query_index().find(steps)
+    snapshot = current.snapshot
+    nodes = []
+    for i in matches[:max(limit, 0)]:
+        node_id = current.ids[i]
+        b = [int(v) for v in snapshot.bounds[i]] if snapshot.bounds_valid[i] else None
+        nodes.append({
+            "index": i,
+            "id": node_id,
+            "attrs": current.attrs[node_id],
+            "bounds": b,
+            "center": [(b[0] + b[2]) // 2, (b[1] + b[3]) // 2] if b else None,
+        })
+    return {
+        "display": display,
+        "version": current.version,
+        "source": version_key[2],
+        "count": len(matches),
+        "nodes": nodes,
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 3),
+    }
+
+
+@app.get("/api/hit")
+def hit_test(x: int, y: int, display: int = 0, refresh: bool = False):
+    """坐标命中测试：返回 (x, y) 处最小的可见节点，以及从根到它的节点栈。
+
+    默认用该 display 最近一次拉到的 UI 树（没有、已过期或 refresh=true 时先拉一次）。
+    节点用前序下标 index 和稳定 id 标识，version 对应 /api/hierarchy 返回的版本号。
+    """
+    if not current_serial:
+        raise HTTPException(status_code=400, detail="Device not connected")
+    version_key, current = current_hierarchy_version(display, refresh)
+    t0 = time.perf_counter()
+    index = current.spatial_index()
+    best = index.best(x, y)
+    stack = []
+    if best is not None:
+        for i in index.ancestors(best):
+            node_id = current.ids[i]
+            stack.append({"index": i, "id": node_id, "attrs": current.attrs[node_id]})
     return {
-        "ok": ok,
-        "ok_serial": ok_serial,
-        "candidates": candidates,
-        "by_serial": by_serial,
+        "display": display,
+        "x": x,
+        "y": y,
+        "version": current.version,
+        "source": version_key[2],
+        "node": stack[-1] if stack else None,
+        "stack": stack,
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 3),
     }
 
 
-def _adb_run(args: List[str], timeout: int = 10) -> subprocess.CompletedProcess:
-    """Run adb subprocess (best-effort, capture output)."""
-    return subprocess.run(args, capture_output=True, text=True, timeout=timeout, check=False)
+# --- uiautomator dump ---
+# 优先让 uiautomator 直接把 XML 写到 stdout（exec-out 读回），不落盘、一次往返；
+# 设备不支持时退回每次唯一的临时文件（dump + cat + rm 合成一条命令）。
+# "could not get idle state" 是界面在动画/持续刷新，按退避时间重试；其它错误直接换下一种方式。
+UIAUTOMATOR_IDLE_BACKOFF = [0.1, 0.25, 0.5, 1.0]
+UIAUTOMATOR_DUMP_TIMEOUT = 20
+UIAUTOMATOR_TMP_DIR = "/data/local/tmp"
+# 判定不支持 stdout 之后隔这么久再试一次（可能只是当时的偶发错误）
+UIAUTOMATOR_STDOUT_REPROBE = 600.0
+# serial -> (是否支持 dump 到 /dev/stdout, 判定时间)；没有条目表示还没试过
+_uiautomator_stdout_ok: Dict[str, Tuple[bool, float]] = {}
 
+# 同一设备上的 uiautomator 串行执行（同时只能注册一个 UiAutomation）；
+# 可重入：_fetch_hierarchy 持锁复查缓存后再 dump
+_uiautomator_dump_locks: Dict[str, threading.RLock] = {}
+_uiautomator_dump_locks_guard = threading.Lock()
 
-def ensure_accessibility_service(serial: str, apk_path: Optional[str] = None, install_if_missing: bool = True) -> Dict:
-    """Ensure CarUI accessibility service is installed, enabled and running.
 
-    This is designed for 'one-click' UX:
-    - Optional install/update APK
-    - Enable service in secure settings (requires root / WRITE_SECURE_SETTINGS / userdebug)
-    - Forward 8765 and verify /api/status
-    """
-    result: Dict = {
-        "serial": serial,
-        "target_serial": resolve_accessibility_target_serial(serial),
-        "apk_installed": None,
-        "apk_install_attempted": False,
-        "enabled": False,
-        "running": False,
-        "steps": [],
-        "error": None,
-    }
+def _uiautomator_dump_lock(serial: str) -> threading.RLock:
+    with _uiautomator_dump_locks_guard:
+        return _uiautomator_dump_locks.setdefault(serial, threading.RLock())
 
-    target_serial = result["target_serial"]
 
-    def step(msg: str):
-        print(f"[Accessibility][Ensure] {msg}")
-        result["steps"].append(msg)
+def _extract_dump_xml(output: str) -> Optional[str]:
+    """从 dump 输出里截出 XML（后面通常跟着 "UI hierchary dumped to: ..."）。"""
+    start = output.find("<?xml")
+    end = output.rfind(">")
+    if start == -1 or end < start:
+        return None
+    xml = output[start:end + 1]
+    if "</hierarchy>" not in xml:
+        return None
+    return xml
 
-    try:
-        # 0) Validate adb device
-        step(f"Using target_serial={target_serial}")
 
-        # 1) Check APK installed
-        pkg = "com.carui.accessibility"
-        r = _adb_run(["adb", "-s", target_serial, "shell", "pm", "path", pkg], timeout=8)
-        installed = (r.returncode == 0) and ("package:" in (r.stdout or ""))
-        result["apk_installed"] = installed
-        step(f"APK installed? {installed}")
+def _uiautomator_dump_once(serial: str, target_args: str, to_stdout: bool) -> Tuple[Optional[str], str]:
+    """执行一次 dump，返回 (xml 或 None, 原始输出)。"""
+    if to_stdout:
+        data = adb_pool.exec_out(serial, f"uiautomator dump --compressed {target_args} /dev/stdout",
+                                 timeout=UIAUTOMATOR_DUMP_TIMEOUT)
+        output = bytes(data).decode("utf-8", errors="replace")
+    else:
+        path = f"{UIAUTOMATOR_TMP_DIR}/carui_dump_{uuid.uuid4().hex[:12]}.xml"
+        _, out, err = adb_pool.shell(
+            serial,
+            f"uiautomator dump --compressed {target_args} {path} && cat {path}; rm -f {path}",
+            timeout=UIAUTOMATOR_DUMP_TIMEOUT,
+        )
+        # idle state 等错误信息在 stderr，一起交给调用方判断
+        output = (out + err).decode("utf-8", errors="replace")
+    return _extract_dump_xml(output), output
 
-        # 2) Install if missing (or user provided path)
-        if (not installed) and install_if_missing:
-            # If path not specified, try default build output relative to repo/plugin
-            if not apk_path:
-                # server/main.py is inside <plugin>/server
-                # Try to locate apk built by compile_apk.sh
-                candidate = os.path.abspath(os.path.join(script_dir, "..", "accessibility_service", "build", "outputs", "apk", "debug", "accessibility_service-debug.apk"))
-                if os.path.exists(candidate):
-                    apk_path = candidate
 
-            if apk_path and os.path.exists(apk_path):
-                result["apk_install_attempted"] = True
-                step(f"Installing APK: {apk_path}")
-                ir = _adb_run(["adb", "-s", target_serial, "install", "-r", apk_path], timeout=90)
-                if ir.returncode != 0:
-                    step(f"APK install failed: {ir.stderr.strip()}")
-                else:
-                    step("APK install success")
-                    result["apk_installed"] = True
-            else:
-                step("APK missing and no apk_path provided")
+def _uiautomator_dump_with_backoff(serial: str, target_args: str,
+                                   to_stdout: bool) -> Tuple[Optional[str], str, bool]:
+    """dump 一次；遇到 idle state 错误按 UIAUTOMATOR_IDLE_BACKOFF 退避重试。
 
-        # 3) Enable secure settings (requires privileged environment)
-        # Read current services
-        r = _adb_run(["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"], timeout=6)
-        current_services = (r.stdout or "").strip()
-        component = "com.carui.accessibility/.CarUIAccessibilityService"
-        if "com.carui.accessibility" in current_services:
-            step("Service already in enabled_accessibility_services")
-        else:
-            new_services = (
-                f"{current_services}:{component}" if current_services and current_services != "null" else component
+    返回 (xml 或 None, 原始输出, 命令是否正常跑完)；adb 超时/断开等异常时最后一项为 False。
+    """
+    mode = "stdout" if to_stdout else "tmpfile"
+    for attempt in range(len(UIAUTOMATOR_IDLE_BACKOFF) + 1):
+        t0 = time.time()
+        completed = True
+        try:
+            xml, output = _uiautomator_dump_once(serial, target_args, to_stdout)
+        except Exception as e:
+            xml, output, completed = None, str(e), False
+        if xml:
+            elapsed_ms = int((time.time() - t0) * 1000)
+            hierarchy_log.debug(f"✅ uiautomator dump {target_args} ({mode}) {len(xml)} chars, {elapsed_ms}ms",
+                                serial=serial, mode=mode, chars=len(xml), ms=elapsed_ms)
+            return xml, output, True
+        if "idle state" not in output or attempt == len(UIAUTOMATOR_IDLE_BACKOFF):
+            break
+        delay = UIAUTOMATOR_IDLE_BACKOFF[attempt]
+        hierarchy_log.info(f"⏳ could not get idle state，{delay}s 后重试 ({attempt + 1})")
+        time.sleep(delay)
+    hierarchy_log.warning(f"⚠️ uiautomator dump {target_args} ({mode}) 失败: {output.strip()[:200]}")
+    return None, output, completed
+
+
+def _uiautomator_use_stdout(serial: str) -> bool:
+    state = _uiautomator_stdout_ok.get(serial)
+    return state is None or state[0] or time.time() - state[1] >= UIAUTOMATOR_STDOUT_REPROBE
+
+
+def dump_uiautomator_xml(serial: str, display: int = 0) -> str:
+    """dump 设备 UI 树（优先 --windows 拿全部 display，失败再只 dump 指定 display）。"""
+    with _uiautomator_dump_lock(serial):
+        for target_args in ("--windows", f"--display {display}"):
+            modes = [True, False] if _uiautomator_use_stdout(serial) else [False]
+            # stdout 方式正常跑完却没有 XML（不是超时/断开，也不是界面忙）
+            stdout_no_xml = False
+            for to_stdout in modes:
+                xml, output, completed = _uiautomator_dump_with_backoff(serial, target_args, to_stdout)
+                if xml:
+                    if to_stdout:
+                        _uiautomator_stdout_ok[serial] = (True, time.time())
+                    elif stdout_no_xml:
+                        # 同样的参数临时文件能拿到 XML 而 stdout 拿不到：该设备确实不支持 dump 到 stdout，
+                        # 之后直接用临时文件，过 UIAUTOMATOR_STDOUT_REPROBE 再试
+                        _uiautomator_stdout_ok[serial] = (False, time.time())
+                        hierarchy_log.info(f"ℹ️ {serial} 不支持 uiautomator dump 到 stdout，改用临时文件")
+                    return xml
+                if to_stdout:
+                    stdout_no_xml = completed and "<?xml" not in output and "idle state" not in output
+    raise Exception(f"Failed to dump hierarchy for display {display}")
+
+
+# --- UI 树缓存 ---
+# key = (serial, display, source)，source 为 uiautomator / accessibility。
+# - HIERARCHY_CACHE_TTL 内直接返回缓存，不重新 dump
+# - 过了 TTL（或被点击/滑动/返回作废）的条目不再直接返回，只在 dump 失败时兜底，超过 STALE_TTL 丢弃
+# - 总大小（XML 字符数 + 解析后快照的估算）超过 HIERARCHY_CACHE_MAX_BYTES 时按 LRU 淘汰
+# - 订阅了辅助服务的 UI 变化事件（见 AccessibilityEventSubscriber）时，界面变化会主动作废对应 display，
+#   TTL 放宽到 HIERARCHY_CACHE_EVENT_TTL：界面不动就不 dump
+HIERARCHY_CACHE_TTL = 2.0
+HIERARCHY_CACHE_EVENT_TTL = 60.0
+HIERARCHY_CACHE_STALE_TTL = 300.0
+HIERARCHY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# 每个快照节点的估算内存（属性 dict + 数组行）
+HIERARCHY_CACHE_NODE_BYTES = 400
+
+
+class HierarchyCacheEntry:
+    def __init__(self, result: Dict, size: int, invalidated: bool = False):
+        self.result = result
+        self.size = size
+        self.stored_at = time.time()
+        self.invalidated = invalidated
+
+
+class HierarchyCache:
+    def __init__(self, max_bytes: int = HIERARCHY_CACHE_MAX_BYTES, ttl: float = HIERARCHY_CACHE_TTL,
+                 stale_ttl: float = HIERARCHY_CACHE_STALE_TTL, event_ttl: float = HIERARCHY_CACHE_EVENT_TTL):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.event_ttl = event_ttl
+        self.entries: "OrderedDict[Tuple, HierarchyCacheEntry]" = OrderedDict()
+        self.bytes = 0
+        # serial -> 作废次数；dump 开始前记下，dump 期间被作废过的结果放进来就是已作废的
+        self.epochs: Dict[str, int] = {}
+        # serial -> 事件订阅有效期（到期前用 event_ttl）
+        self.event_driven: Dict[str, float] = {}
+        self.stats = {"hits": 0, "misses": 0, "stale_hits": 0, "stores": 0, "evictions": 0,
+                      "expirations": 0, "invalidations": 0}
+
+    @staticmethod
+    def _size(result: Dict) -> int:
+        snapshot = result.get("snapshot")
+        return len(result.get("xml") or "") + (len(snapshot) * HIERARCHY_CACHE_NODE_BYTES if snapshot else 0)
+
+    def _drop(self, key: Tuple):
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+
+    def get(self, key: Tuple, allow_stale: bool = False) -> Optional[Dict]:
+        """TTL 内且没被作废的结果；allow_stale=True 时 STALE_TTL 内的旧结果也返回（dump 失败兜底）。"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry.stored_at > self.stale_ttl:
+                self._drop(key)
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                if not allow_stale:
+                    self.stats["misses"] += 1
+                return None
+            ttl = self.event_ttl if self.event_driven.get(key[0], 0) > now else self.ttl
+            fresh = not entry.invalidated and now - entry.stored_at <= ttl
+            if not fresh and not allow_stale:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits" if fresh else "stale_hits"] += 1
+            return entry.result
+
+    def epoch(self, serial: str) -> int:
+        with self.lock:
+            return self.epochs.get(serial, 0)
+
+    def put(self, key: Tuple, result: Dict, epoch: Optional[int] = None):
+        """epoch 为 dump 开始前的 epoch(serial)；之后又被作废过则只作兜底用。"""
+        with self.lock:
+            entry = HierarchyCacheEntry(result, self._size(result),
+                                        invalidated=epoch is not None and epoch != self.epochs.get(key[0], 0))
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = entry
+            self.bytes += entry.size
+            self.stats["stores"] += 1
+            # 至少留下刚放进去的这一条
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                self._drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def invalidate(self, serial: str, display: Optional[int] = None):
+        """设备界面变了：该设备（display 非空时只该 display）的条目不再直接返回（仍可在 dump 失败时兜底）。"""
+        with self.lock:
+            self.epochs[serial] = self.epochs.get(serial, 0) + 1
+            for key, entry in self.entries.items():
+                if key[0] == serial and (display is None or key[1] == display) and not entry.invalidated:
+                    entry.invalidated = True
+                    self.stats["invalidations"] += 1
+
+    def set_event_driven(self, serial: str, until: float):
+        """until 之前该设备的界面变化都会通过 invalidate 通知到；0 表示取消。"""
+        with self.lock:
+            if until > 0:
+                self.event_driven[serial] = until
+            else:
+                self.event_driven.pop(serial, None)
+
+    def forget(self, serial: str):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == serial]:
+                self._drop(key)
+            self.epochs.pop(serial, None)
+            self.event_driven.pop(serial, None)
+
+    def snapshot(self) -> Dict:
+        now = time.time()
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                hit_rate=round(self.stats["hits"] / lookups, 3) if lookups else None,
+                bytes=self.bytes,
+                max_bytes=self.max_bytes,
+                ttl=self.ttl,
+                stale_ttl=self.stale_ttl,
+                event_ttl=self.event_ttl,
+                event_driven=sorted(k for k, until in self.event_driven.items() if until > now),
+                entries=[
+                    {"serial": k[0], "display": k[1], "source": k[2], "bytes": e.size,
+                     "age": round(now - e.stored_at, 3), "invalidated": e.invalidated}
+                    for k, e in self.entries.items()
+                ],
             )
-            step(f"Enabling service via secure settings: {component}")
-            _adb_run(["adb", "-s", target_serial, "shell", "settings", "put", "secure", "enabled_accessibility_services", new_services], timeout=6)
 
-        _adb_run(["adb", "-s", target_serial, "shell", "settings", "put", "secure", "accessibility_enabled", "1"], timeout=6)
 
-        # 4) Forward and probe running
-        _adb_run(["adb", "-s", target_serial, "forward", "tcp:8765", "tcp:8765"], timeout=6)
+hierarchy_cache = HierarchyCache()
 
-        # Poll up to 4s
-        import time
-        enabled_services_now = _adb_run(["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"], timeout=6).stdout.strip()
-        result["enabled"] = "com.carui.accessibility" in (enabled_services_now or "")
 
-        step(f"Enabled now? {result['enabled']}")
+def on_device_input(serial: str, display: int, kind: str) -> float:
+    """点击/滑动/返回之后：之前的截图、UI 树结果都不能再复用；安排预取。返回预取开始前的等待秒数。"""
+    single_flight.forget(serial)
+    hierarchy_cache.invalidate(serial)
+    return prefetcher.after_input(serial, str(display), kind)
 
-        running = False
-        for i in range(1, 9):
-            if check_accessibility_service(target_serial):
-                running = True
-                break
-            time.sleep(0.5)
-        result["running"] = running
-        step(f"Running? {running}")
 
-        if not result["enabled"]:
-            step("WARNING: enable may require root/WRITE_SECURE_SETTINGS; please enable manually in Settings")
-        if not result["running"]:
-            step("WARNING: service not responding on 8765; please open Accessibility settings and toggle service")
+@app.get("/api/hierarchy/cache")
+def get_hierarchy_cache_stats():
+    """UI 树缓存的命中率、占用和条目列表（用于调 TTL / 大小上限）。"""
+    return hierarchy_cache.snapshot()
 
-        return result
-    except Exception as e:
-        result["error"] = str(e)
-        return result
 
-def get_hierarchy_from_accessibility(serial: str, display: int = 0) -> Optional[str]:
-    """从辅助服务获取UI树并转换为XML格式"""
+def dump_hierarchy_displays(serial: str, display: int = 0) -> Dict[int, Dict]:
+    """dump 一次并拆成每个 display 的结果，全部放进缓存。
+
+    --windows 的输出包含所有 display，一次解析出全部；设备只支持 --display N 时只有请求的那个。
+    解析出错时返回原始 XML（只对请求的 display）。
+    """
+    epoch = hierarchy_cache.epoch(serial)
+    xml_content = dump_uiautomator_xml(serial, display)
+    hierarchy_log.debug(f"成功获取UI层级,XML长度: {len(xml_content)}")
+
+    # 处理多窗口多display XML格式：每个 display 各自做窗口坐标转换
+    results: Dict[int, Dict] = {}
     try:
-        import requests
-        import xml.etree.ElementTree as ET
-        
-        print(f"[Accessibility] 📡 从辅助服务获取UI树...")
-        
-        # 确保端口转发（某些设备/系统在状态检测后仍可能失效，兜底再 forward 一次）
-        subprocess.run(
-            ["adb", "-s", serial, "forward", "tcp:8765", "tcp:8765"],
-            capture_output=True,
-            timeout=3,
-            check=False,
-        )
+        ss_type = detect_ss_device(serial) if serial else None
+        t0 = time.time()
+        parsed = parse_uiautomator_displays(xml_content, serial, ss_type)
+        if parsed is None:
+            results[display] = {"xml": xml_content, "source": "uiautomator", "snapshot": None}
+        else:
+            for display_id, snapshot in parsed.items():
+                if display_id.isdigit():
+                    results[int(display_id)] = {"xml": snapshot.to_xml(), "source": "uiautomator",
+                                                "snapshot": snapshot}
+        hierarchy_log.debug(f"✅ 转换完成，display {sorted(results)}, {int((time.time() - t0) * 1000)}ms")
+    except Exception as parse_error:
+        hierarchy_log.error(f"❌ XML解析/转换出错: {parse_error}", exc_info=True)
+        # 如果解析失败，返回原始XML
+        results = {display: {"xml": xml_content, "source": "uiautomator", "snapshot": None}}
 
-        # 请求UI树
-        response = requests.get(f"http://localhost:8765/api/hierarchy?display={display}", timeout=5)
-        if response.status_code != 200:
-            print(f"[Accessibility] ❌ 请求失败: {response.status_code}")
-            return None
-        
-        data = response.json()
-        if not data.get("success"):
-            print(f"[Accessibility] ❌ 获取失败: {data.get('error')}")
-            return None
-        
-        nodes = data.get("nodes", [])
-        print(f"[Accessibility] ✅ 获取到 {len(nodes)} 个根节点")
-        
-        # --- 坐标归一化：将“全局坐标”转换为“当前 display 截图坐标系” ---
-        # 在多屏/分屏场景下，AccessibilityNodeInfo#getBoundsInScreen 可能返回带 display 偏移的坐标，
-        # 而 screencap -d <display> 的截图坐标原点是 (0,0)。
-        # 这里用该 display 的窗口 bounds 的最小 left/top 作为 display 的原点偏移，并对疑似“绝对坐标”的节点做减偏移。
-        origin_x = 0
-        origin_y = 0
-        try:
-            xs = []
-            ys = []
-            for rn in nodes:
-                wb = ((rn.get("window") or {}).get("bounds") or {})
-                if "left" in wb and "top" in wb:
-                    xs.append(int(wb.get("left", 0)))
-                    ys.append(int(wb.get("top", 0)))
-            if xs and ys:
-                origin_x = min(xs)
-                origin_y = min(ys)
-        except Exception:
-            origin_x = 0
-            origin_y = 0
+    for display_id, result in results.items():
+        hierarchy_cache.put((serial, display_id, "uiautomator"), result, epoch=epoch)
+    hierarchy_dump_displays[serial] = sorted(results)
+    return results
 
-        def normalize_bounds(b: Dict) -> Dict:
-            """按需将 bounds 从全局坐标转换为 display 内坐标。"""
-            if not b:
-                return b
-            try:
-                l = int(b.get("left", 0))
-                t = int(b.get("top", 0))
-                r = int(b.get("right", 0))
-                bt = int(b.get("bottom", 0))
-
-                # 如果 origin 很接近 0，说明已是 display 坐标系
-                if origin_x < 50 and origin_y < 50:
-                    return {"left": l, "top": t, "right": r, "bottom": bt}
-
-                margin = 200
-                # 只有当节点坐标看起来“落在 origin 偏移之后”，才做减偏移
-                if l >= origin_x - margin and t >= origin_y - margin and r > origin_x and bt > origin_y:
-                    nl = max(0, l - origin_x)
-                    nt = max(0, t - origin_y)
-                    nr = max(0, r - origin_x)
-                    nb = max(0, bt - origin_y)
-                    return {"left": nl, "top": nt, "right": nr, "bottom": nb}
-
-                # 否则保持原值（一般是 already-relative）
-                return {"left": l, "top": t, "right": r, "bottom": bt}
-            except Exception:
-                return b
 
-        # 转换为XML格式
-        hierarchy = ET.Element('hierarchy')
-        hierarchy.set('rotation', '0')
-        
-        def convert_node_to_xml(json_node, parent_elem):
-            """递归转换JSON节点到XML"""
-            node = ET.SubElement(parent_elem, 'node')
-            
-            # 基本属性
-            node.set('class', json_node.get('className', ''))
-            node.set('package', json_node.get('packageName', ''))
-            node.set('text', json_node.get('text', ''))
-            node.set('content-desc', json_node.get('contentDescription', ''))
-            node.set('resource-id', json_node.get('resourceId', ''))
-            
-            # 坐标
-            bounds = normalize_bounds(json_node.get('bounds', {}))
-            bounds_str = f"[{bounds.get('left',0)},{bounds.get('top',0)}][{bounds.get('right',0)},{bounds.get('bottom',0)}]"
-            node.set('bounds', bounds_str)
-            
-            # 状态属性
-            node.set('clickable', str(json_node.get('clickable', False)).lower())
-            node.set('long-clickable', str(json_node.get('longClickable', False)).lower())
-            node.set('enabled', str(json_node.get('enabled', True)).lower())
-            # Accessibility 专有：是否对用户可见
-            if 'visibleToUser' in json_node:
-                node.set('visible-to-user', str(json_node.get('visibleToUser', False)).lower())
-            node.set('focusable', str(json_node.get('focusable', False)).lower())
-            node.set('focused', str(json_node.get('focused', False)).lower())
-            node.set('selected', str(json_node.get('selected', False)).lower())
-            node.set('checkable', str(json_node.get('checkable', False)).lower())
-            node.set('checked', str(json_node.get('checked', False)).lower())
-            node.set('scrollable', str(json_node.get('scrollable', False)).lower())
-            
-            # 递归处理子节点
-            for child in json_node.get('children', []):
-                convert_node_to_xml(child, node)
-        
-        # 转换所有根节点
-        for root_node in nodes:
-            convert_node_to_xml(root_node, hierarchy)
-        
-        # 生成XML字符串
-        xml_str = ET.tostring(hierarchy, encoding='unicode')
-        xml_content = '<?xml version="1.0" encoding="UTF-8"?>' + xml_str
-        
-        print(f"[Accessibility] ✅ 转换完成，XML长度: {len(xml_content)}")
-        return xml_content
-        
-    except Exception as e:
-        print(f"[Accessibility] ❌ 获取UI树失败: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
+# serial -> 最近一次 dump 里出现的 display 列表（/api/hierarchy/all 判断缓存是否齐全）
+hierarchy_dump_displays: Dict[str, List[int]] = {}
 
-@app.get("/api/hierarchy")
-def get_hierarchy(display: int = 0, force_accessibility: bool = False):
-    global current_serial
-    global hierarchy_xml_cache
+
+@app.get("/api/hierarchy/all")
+def get_all_hierarchies(format: str = "xml", encoding: str = "json", refresh: bool = False):
+    """一次返回设备上每个 display 的 UI 树（一次 dump 拆出来的）。
+
+    缓存里最近一次 dump 的所有 display 都还新鲜时直接返回，否则重新 dump。
+    format / encoding 同 /api/hierarchy；每个 display 带 source 和 version。
+    """
     if not current_serial:
-         raise HTTPException(status_code=400, detail="Device not connected")
-    
-    print(f"[Hierarchy] 📋 开始获取Display {display}的UI树...")
-    print(f"[Hierarchy] 用户选择数据源: {'辅助服务' if force_accessibility else 'UIAutomator'}")
+        raise HTTPException(status_code=400, detail="Device not connected")
+    if format not in ("xml", "columnar"):
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    if encoding not in COLUMNAR_ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"Unsupported encoding: {encoding}")
+    serial = current_serial
+    results: Optional[Dict[int, Dict]] = None
+    known = hierarchy_dump_displays.get(serial)
+    if known and not refresh:
+        cached = {d: hierarchy_cache.get((serial, d, "uiautomator")) for d in known}
+        if all(r is not None for r in cached.values()):
+            results = cached
+    if results is None:
+        try:
+            results = single_flight.do(
+                (serial, "*", "hierarchy:all"),
+                lambda: dump_hierarchy_displays(serial),
+                fresh=SINGLE_FLIGHT_FRESH_SECONDS["hierarchy"],
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to dump hierarchy: {e}")
+
+    displays = {}
+    for display_id, result in sorted(results.items()):
+        current = hierarchy_versions.commit((serial, display_id, result["source"]), hierarchy_snapshot(result))
+        meta = {k: v for k, v in result.items() if k not in ("xml", "snapshot")}
+        meta["version"] = current.version
+        if format == "xml":
+            displays[str(display_id)] = dict(meta, xml=result["xml"])
+        else:
+            displays[str(display_id)] = dict(hierarchy_to_columnar(current.snapshot), **meta)
+    return encode_payload({"count": len(displays), "displays": displays}, encoding)
+
+
+def _fetch_hierarchy(display: int = 0, force_accessibility: bool = False):
+    serial = current_serial
+    preferred = "accessibility" if force_accessibility else "uiautomator"
+    cached = hierarchy_cache.get((serial, display, preferred))
+    if cached is not None:
+        hierarchy_log.debug(f"⚡ 命中缓存 display={display} source={preferred}")
+        return cached
+
+    hierarchy_log.debug(f"📋 开始获取Display {display}的UI树...")
+    hierarchy_log.debug(f"用户选择数据源: {'辅助服务' if force_accessibility else 'UIAutomator'}")
     
     # 根据用户选择使用对应的数据源
     if force_accessibility:
         # 用户选择使用辅助服务
-        print(f"[Hierarchy] 🔧 使用辅助服务模式")
-        target_serial = resolve_accessibility_target_serial(current_serial)
-        if target_serial != current_serial:
-            print(f"[Hierarchy] ♿ 辅助服务目标设备序列号修正: {current_serial} -> {target_serial}")
+        hierarchy_log.debug(f"🔧 使用辅助服务模式")
+        target_serial = resolve_accessibility_target_serial(serial)
+        if target_serial != serial:
+            hierarchy_log.info(f"♿ 辅助服务目标设备序列号修正: {serial} -> {target_serial}")
 
         if check_accessibility_service(target_serial):
+            accessibility_events.ensure(serial, target_serial)
+            epoch = hierarchy_cache.epoch(serial)
             xml_from_accessibility = get_hierarchy_from_accessibility(target_serial, display)
             if xml_from_accessibility:
-                print(f"[Hierarchy] ✅ 使用辅助服务数据源")
-                return {"xml": xml_from_accessibility, "source": "accessibility"}
+                hierarchy_log.debug(f"✅ 使用辅助服务数据源")
+                result = {"xml": xml_from_accessibility, "source": "accessibility"}
+                hierarchy_cache.put((serial, display, "accessibility"), result, epoch=epoch)
+                return result
             else:
-                print(f"[Hierarchy] ⚠️ 辅助服务获取失败，fallback到UIAutomator")
+                hierarchy_log.warning(f"⚠️ 辅助服务获取失败，fallback到UIAutomator")
         else:
-            print(f"[Hierarchy] ⚠️ 辅助服务不可用，fallback到UIAutomator")
+            hierarchy_log.warning(f"⚠️ 辅助服务不可用，fallback到UIAutomator")
     
     # 步骤1：优先使用UIAutomator
     # 步骤1：使用UIAutomator获取hierarchy
-    print(f"[Hierarchy] 🔍 使用UIAutomator获取...")
-    uiautomator_xml = None
-    original_xml_for_check = None  # 用于完整性检查的原始XML（转换前）
+    hierarchy_log.debug(f"🔍 使用UIAutomator获取...")
     try:
-        import xml.etree.ElementTree as ET
-        d = adb.device(serial=current_serial)
-        dump_path = f"/sdcard/uidump_all.xml"
-        
-        # Clear previous dump
-        d.shell(f"rm -f {dump_path}")
-        
-        # 获取所有display的完整hierarchy（使用--windows获取多窗口多display数据）
-        # 某些车机上 uiautomator dump 会偶发报：ERROR: could not get idle state.
-        # 这里做重试，并优先使用 --compressed 降低数据量。
-        print(f"[Hierarchy] 🔍 获取所有display的完整层级数据...")
-        dump_err = ""
-        for attempt in range(3):
-            try:
-                cmd = f"uiautomator dump --compressed --windows {dump_path}"
-                dump_err = d.shell(cmd)
-                print(f"[Hierarchy] uiautomator dump输出(attempt {attempt+1}/3): {dump_err}")
-                xml_content = d.shell(f"cat {dump_path}")
-                if xml_content and "<?xml" in xml_content:
-                    break
-            except Exception as _e:
-                dump_err = str(_e)
-            import time
-            time.sleep(0.3)
-
-        # 读取dump的内容（若上面已经读取并成功，会走到这里继续使用）
-        if 'xml_content' not in locals():
-            xml_content = d.shell(f"cat {dump_path}")
-        
-        if not xml_content or "<?xml" not in xml_content:
-            print(f"[Hierarchy] --windows方式失败,尝试指定display...")
-            # Fallback: 尝试指定display
-            d.shell(f"rm -f {dump_path}")
-            # 也做一次重试
-            for attempt in range(3):
-                cmd = f"uiautomator dump --compressed --display {display} {dump_path}"
-                err = d.shell(cmd)
-                print(f"[Hierarchy] uiautomator dump(display)输出(attempt {attempt+1}/3): {err}")
-                xml_content = d.shell(f"cat {dump_path}")
-                if xml_content and "<?xml" in xml_content:
-                    break
-                import time
-                time.sleep(0.3)
-            
-        if not xml_content or "<?xml" not in xml_content:
-            raise Exception(f"Failed to dump hierarchy for display {display}")
-
-        # 清理XML内容
-        start = xml_content.find("<?xml")
-        end = xml_content.rfind(">")
-        if start != -1 and end != -1:
-            xml_content = xml_content[start:end+1]
-        
-        print(f"[Hierarchy] 成功获取UI层级,XML长度: {len(xml_content)}")
-        
-        # 保存原始XML用于完整性检查（在坐标转换之前）
-        original_xml_for_check = xml_content
-        uiautomator_xml = xml_content
-        
-        # 处理多窗口多display XML格式：合并所有相关display的窗口
-        try:
-            root = ET.fromstring(xml_content)
-            
-            print(f"[Hierarchy] 📊 XML根标签: {root.tag}")
-            
-            # 辅助函数：解析bounds字符串
-            def parse_bounds(bounds_str):
-                if not bounds_str or bounds_str == '':
-                    return None
-                try:
-                    import re
-                    match = re.match(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]', bounds_str)
-                    if match:
-                        return {
-                            'x1': int(match.group(1)),
-                            'y1': int(match.group(2)),
-                            'x2': int(match.group(3)),
-                            'y2': int(match.group(4))
-                        }
-                except:
-                    pass
-                return None
-            
-            # 辅助函数：格式化bounds
-            def format_bounds(x1, y1, x2, y2):
-                return f"[{x1},{y1}][{x2},{y2}]"
-            
-            def bounds_area(b):
-                if not b:
-                    return 0
-                return max(0, b['x2'] - b['x1']) * max(0, b['y2'] - b['y1'])
-
-            def is_zero_bounds(b):
-                if not b:
-                    return True
-                return b['x1'] == b['x2'] or b['y1'] == b['y2']
-
-            def union_bounds(a, b):
-                if not a:
-                    return b
-                if not b:
-                    return a
-                return {
-                    'x1': min(a['x1'], b['x1']),
-                    'y1': min(a['y1'], b['y1']),
-                    'x2': max(a['x2'], b['x2']),
-                    'y2': max(a['y2'], b['y2']),
-                }
+        with _uiautomator_dump_lock(serial):
+            # 排队等 dump 锁期间，别的 display 的请求可能已经 dump 过了（一次 dump 覆盖全部 display）
+            cached = hierarchy_cache.get((serial, display, "uiautomator"))
+            if cached is not None:
+                hierarchy_log.debug(f"⚡ 等锁期间已有 dump，直接用缓存 display={display}")
+                return cached
+            results = dump_hierarchy_displays(serial, display)
+        result = results.get(display)
+        if result is None:
+            # dump 里没有这个 display
+            result = {"xml": _DisplayNodes(str(display)).finish(serial, None).to_xml(), "source": "uiautomator"}
+            hierarchy_cache.put((serial, display, "uiautomator"), result)
+        hierarchy_log.debug(f"✅ UIAutomator数据获取成功")
+        return result
 
-            # 递归应用 affine transform（scale + offset）
-            def transform_node_bounds(node, scale_x: float, scale_y: float, offset_x: float, offset_y: float):
-                bounds_str = node.get('bounds')
-                if bounds_str:
-                    b = parse_bounds(bounds_str)
-                    if b:
-                        nx1 = int(round(b['x1'] * scale_x + offset_x))
-                        ny1 = int(round(b['y1'] * scale_y + offset_y))
-                        nx2 = int(round(b['x2'] * scale_x + offset_x))
-                        ny2 = int(round(b['y2'] * scale_y + offset_y))
-                        node.set('bounds', format_bounds(nx1, ny1, nx2, ny2))
-
-                for child in node:
-                    if child.tag == 'node':
-                        transform_node_bounds(child, scale_x, scale_y, offset_x, offset_y)
-
-            # 对某些车型/窗口，uiautomator 会输出大量 [0,0][0,0] 的叶子节点，导致无法命中。
-            # 这里对“有意义”的节点（text/resource-id/clickable=true）在 bounds 为 0 时，继承最近的非 0 祖先 bounds。
-            def fix_zero_bounds_for_actionable_nodes(node, inherited_bounds=None):
-                b = parse_bounds(node.get('bounds', ''))
-                node_has_action = bool(node.get('text')) or bool(node.get('resource-id')) or node.get('clickable') == 'true'
-
-                # 如果当前节点 bounds 为 0，且它是可操作/可识别的节点，则继承祖先 bounds
-                if node_has_action and is_zero_bounds(b) and inherited_bounds:
-                    node.set('bounds', format_bounds(inherited_bounds['x1'], inherited_bounds['y1'], inherited_bounds['x2'], inherited_bounds['y2']))
-                    b = inherited_bounds
-
-                # 更新继承 bounds：只使用非 0 的 bounds 作为后续子节点的参考
-                next_inherited = inherited_bounds
-                if b and not is_zero_bounds(b):
-                    next_inherited = b
-
-                for child in node:
-                    if child.tag == 'node':
-                        fix_zero_bounds_for_actionable_nodes(child, next_inherited)
-            
-            # 检查是否是多窗口格式 (<displays>)
-            if root.tag == 'displays':
-                print(f"[Hierarchy] ✅ 检测到多窗口多display格式，开始合并所有相关display...")
-                
-                # 创建一个新的hierarchy根节点
-                merged_hierarchy = ET.Element('hierarchy')
-                merged_hierarchy.set('rotation', '0')
-                
-                window_count = 0
-                node_count = 0
-                
-                # 遍历所有display
-                for display_elem in root.findall('.//display'):
-                    display_id = display_elem.get('id', 'unknown')
-                    
-                    # **修复：只处理当前请求的display，避免坐标混乱**
-                    # 之前合并多个display导致坐标转换错误
-                    if display_id == str(display):
-                        print(f"[Hierarchy] 📱 处理Display {display_id} (仅当前请求的display)...")
-                        
-                        for window_elem in display_elem.findall('window'):
-                            window_count += 1
-                            window_title = window_elem.get('title', '')
-                            window_bounds = window_elem.get('bounds', '')
-                            window_type = window_elem.get('type', '')
-                            
-                            print(f"[Hierarchy]   窗口{window_count}: title='{window_title}', bounds={window_bounds}")
-                            
-                            # 解析窗口的bounds，获取偏移量
-                            window_bounds_parsed = parse_bounds(window_bounds)
-                            dst_bounds = window_bounds_parsed
-                            
-                            # 获取window下的hierarchy节点
-                            hierarchy_elem = window_elem.find('hierarchy')
-                            if hierarchy_elem is not None:
-                                # 打印hierarchy下有多少个node
-                                top_level_nodes = hierarchy_elem.findall('node')
-                                print(f"[Hierarchy]     hierarchy下有 {len(top_level_nodes)} 个顶层node")
-                                
-                                # 递归统计所有子节点数量
-                                def count_all_nodes(parent):
-                                    count = 0
-                                    for child in parent:
-                                        if child.tag == 'node':
-                                            count += 1
-                                            count += count_all_nodes(child)
-                                    return count
-                                
-                                total_nodes = count_all_nodes(hierarchy_elem)
-                                print(f"[Hierarchy]     包含总共 {total_nodes} 个节点（含子节点）")
-                                
-                                # 将hierarchy下的所有node添加到merged_hierarchy
-                                for node in top_level_nodes:
-                                    # 深拷贝节点（会包含所有子节点）
-                                    node_copy = ET.fromstring(ET.tostring(node))
-
-                                    # --- 关键修正：对 SS2/SS2MAX 等设备，window 内 hierarchy 的坐标系可能是“逻辑分辨率”
-                                    # 例如 src 为 [0,0][1906,1440]，但 window bounds 为 [20,1440][2860,1620]。
-                                    # 此时需要 scale + offset 的 affine transform，而不是简单 offset。
-                                    src_union = None
-                                    try:
-                                        # 用当前顶层节点自身 bounds 作为 src 坐标系（比 window 更可靠）
-                                        src_union = parse_bounds(node_copy.get('bounds', ''))
-                                        if not src_union or is_zero_bounds(src_union):
-                                            # fallback：合并所有顶层节点的非 0 bounds
-                                            for tn in top_level_nodes:
-                                                tb = parse_bounds(tn.get('bounds', ''))
-                                                if tb and not is_zero_bounds(tb):
-                                                    src_union = union_bounds(src_union, tb)
-                                    except Exception:
-                                        src_union = None
-
-                                    scale_x = 1.0
-                                    scale_y = 1.0
-                                    offset_x = 0.0
-                                    offset_y = 0.0
-
-                                    # **关键修复V2：更智能的坐标转换判断**
-                                    # 核心策略：
-                                    # 1. 优先检查单个节点的bounds，而不是合并后的src_union
-                                    # 2. 如果节点bounds在window范围内(±margin)，说明已是绝对坐标
-                                    # 3. 如果节点bounds远小于window起点，说明是相对坐标，需要转换
-                                    
-                                    # 获取设备类型，对SS2等设备做特殊处理
-                                    ss_type = detect_ss_device(current_serial) if current_serial else None
-                                    
-                                    # 全屏窗口判断（window起点在原点附近）
-                                    is_fullscreen_window = dst_bounds and dst_bounds['x1'] < 100 and dst_bounds['y1'] < 100
-                                    
-                                    if is_fullscreen_window:
-                                        # 全屏窗口，hierarchy坐标已经是绝对坐标，不需要转换
-                                        print(f"[Hierarchy]       ✅ 全屏窗口(window起点[{dst_bounds['x1']},{dst_bounds['y1']}]接近原点)，跳过转换")
-                                    elif dst_bounds and src_union and not is_zero_bounds(src_union):
-                                        src_start_x = src_union['x1']
-                                        src_start_y = src_union['y1']
-                                        dst_start_x = dst_bounds['x1']
-                                        dst_start_y = dst_bounds['y1']
-                                        
-                                        print(f"[Hierarchy]       📐 坐标分析:")
-                                        print(f"[Hierarchy]          Window: [{dst_bounds['x1']},{dst_bounds['y1']}]->[{dst_bounds['x2']},{dst_bounds['y2']}]")
-                                        print(f"[Hierarchy]          Node:   [{src_start_x},{src_start_y}]->[{src_union['x2']},{src_union['y2']}]")
-                                        print(f"[Hierarchy]          Device: {ss_type or 'Unknown'}")
-                                        
-                                        # 策略1: 检查节点是否在window范围内（考虑±200的margin）
-                                        margin = 200
-                                        node_in_window_range_x = (dst_bounds['x1'] - margin <= src_start_x <= dst_bounds['x2'] + margin)
-                                        node_in_window_range_y = (dst_bounds['y1'] - margin <= src_start_y <= dst_bounds['y2'] + margin)
-                                        
-                                        print(f"[Hierarchy]          策略1: 节点在window范围内? X={node_in_window_range_x}, Y={node_in_window_range_y}")
-                                        
-                                        # 策略2: 检查节点是否明显是相对坐标（起点接近0）
-                                        node_near_origin = (src_start_x < 50 and src_start_y < 50)
-                                        print(f"[Hierarchy]          策略2: 节点接近原点? {node_near_origin}")
-                                        
-                                        # 策略3: 检查节点与window的相对位置关系
-                                        # 如果节点坐标远小于window起点，说明是相对坐标
-                                        node_much_smaller = (src_start_x < dst_start_x - 100) and (src_start_y < dst_start_y - 100)
-                                        print(f"[Hierarchy]          策略3: 节点坐标远小于window? {node_much_smaller}")
-                                        
-                                        # 决策：如果节点在window范围内，或者节点坐标不是明显的相对坐标，则不转换
-                                        should_transform = False
-                                        reason = ""
-                                        
-                                        if node_in_window_range_x and node_in_window_range_y:
-                                            should_transform = False
-                                            reason = "节点坐标在window范围内，已是绝对坐标"
-                                        elif node_near_origin and not (node_in_window_range_x and node_in_window_range_y):
-                                            should_transform = True
-                                            reason = "节点坐标接近原点，是相对坐标"
-                                        elif node_much_smaller:
-                                            # 对于SS2设备，即使节点坐标小，也可能已经是绝对坐标
-                                            # 需要更仔细的判断
-                                            if ss_type == "SS2":
-                                                # SS2特殊处理：如果节点x坐标>1000，大概率是绝对坐标
-                                                if src_start_x > 1000:
-                                                    should_transform = False
-                                                    reason = "SS2设备，节点X>1000，判断为绝对坐标"
-                                                else:
-                                                    should_transform = True
-                                                    reason = "SS2设备，节点坐标远小于window，判断为相对坐标"
-                                            else:
-                                                should_transform = True
-                                                reason = "节点坐标远小于window起点，是相对坐标"
-                                        else:
-                                            should_transform = False
-                                            reason = "无明确特征，保持不转换（安全策略）"
-                                        
-                                        print(f"[Hierarchy]          🎯 决策: {'需要转换' if should_transform else '不转换'} - {reason}")
-                                        
-                                        if should_transform:
-                                            # 相对坐标，需要转换
-                                            src_w = max(1, src_union['x2'] - src_union['x1'])
-                                            src_h = max(1, src_union['y2'] - src_union['y1'])
-                                            dst_w = max(1, dst_bounds['x2'] - dst_bounds['x1'])
-                                            dst_h = max(1, dst_bounds['y2'] - dst_bounds['y1'])
-                                            scale_x = dst_w / src_w
-                                            scale_y = dst_h / src_h
-                                            offset_x = dst_bounds['x1'] - src_union['x1'] * scale_x
-                                            offset_y = dst_bounds['y1'] - src_union['y1'] * scale_y
-                                            print(f"[Hierarchy]          ✅ 应用转换: scale=({scale_x:.4f},{scale_y:.4f}), offset=({offset_x:.1f},{offset_y:.1f})")
-                                        else:
-                                            # 已经是绝对坐标，不转换
-                                            scale_x = 1.0
-                                            scale_y = 1.0
-                                            offset_x = 0.0
-                                            offset_y = 0.0
-                                            print(f"[Hierarchy]          ✅ 保持原坐标")
-
-                                    transform_node_bounds(node_copy, scale_x, scale_y, offset_x, offset_y)
-                                    fix_zero_bounds_for_actionable_nodes(node_copy, None)
-                                    
-                                    merged_hierarchy.append(node_copy)
-                                    node_count += 1
-                                    
-                                    # 打印节点信息和调试特定节点
-                                    node_bounds = node_copy.get('bounds', 'unknown')
-                                    node_class = node_copy.get('class', 'unknown')
-                                    node_text = node_copy.get('text', '')
-                                    child_count = count_all_nodes(node_copy)
-                                    print(f"[Hierarchy]     添加节点{node_count}: class={node_class}, bounds={node_bounds}, 子节点数={child_count}")
-                                    
-                                    # 调试：打印所有包含"关闭"文本的节点
-                                    if '关闭' in node_text or node_copy.get('content-desc', '') == '关闭':
-                                        print(f"[Hierarchy]     ⚠️ 发现'关闭'节点:")
-                                        print(f"[Hierarchy]        Window: {window_title}")
-                                        print(f"[Hierarchy]        转换前bounds: {node.get('bounds')}")
-                                        print(f"[Hierarchy]        转换后bounds: {node_bounds}")
-                                        print(f"[Hierarchy]        Scale: ({scale_x:.4f}, {scale_y:.4f})")
-                                        print(f"[Hierarchy]        Offset: ({offset_x:.2f}, {offset_y:.2f})")
-                                        print(f"[Hierarchy]        Text: '{node_text}'")
-                                        print(f"[Hierarchy]        Resource-ID: {node_copy.get('resource-id', '')}")
-                                        print(f"[Hierarchy]        Clickable: {node_copy.get('clickable', 'false')}")
-                
-                print(f"[Hierarchy] ✅ 合并完成：{window_count} 个窗口，{node_count} 个顶层节点")
-                
-                # 调试：在合并后的hierarchy中查找"关闭"节点
-                def find_nodes_with_text(element, text_pattern):
-                    results = []
-                    if element.tag == 'node':
-                        node_text = element.get('text', '')
-                        content_desc = element.get('content-desc', '')
-                        if text_pattern in node_text or text_pattern in content_desc:
-                            results.append({
-                                'text': node_text,
-                                'content-desc': content_desc,
-                                'bounds': element.get('bounds'),
-                                'class': element.get('class'),
-                                'resource-id': element.get('resource-id'),
-                                'clickable': element.get('clickable')
-                            })
-                    for child in element:
-                        results.extend(find_nodes_with_text(child, text_pattern))
-                    return results
-                
-                close_nodes = find_nodes_with_text(merged_hierarchy, '关闭')
-                if close_nodes:
-                    print(f"[Hierarchy] 📍 合并后找到 {len(close_nodes)} 个'关闭'节点:")
-                    for idx, node in enumerate(close_nodes):
-                        print(f"[Hierarchy]    [{idx}] {node['class']}")
-                        print(f"[Hierarchy]        Bounds: {node['bounds']}")
-                        print(f"[Hierarchy]        Text: '{node['text']}'")
-                        print(f"[Hierarchy]        Content-desc: '{node['content-desc']}'")
-                        print(f"[Hierarchy]        Resource-ID: {node['resource-id']}")
-                        print(f"[Hierarchy]        Clickable: {node['clickable']}")
-                
-                xml_content = ET.tostring(merged_hierarchy, encoding='unicode')
-                xml_content = '<?xml version="1.0" encoding="UTF-8"?>' + xml_content
-                print(f"[Hierarchy] 合并后XML长度: {len(xml_content)}")
-                
-                # 打印合并后的根节点信息用于调试
-                try:
-                    debug_root = ET.fromstring(xml_content)
-                    if len(debug_root) > 0:
-                        first_node = debug_root[0]
-                        print(f"[Hierarchy] 第一个顶层节点: class={first_node.get('class')}, bounds={first_node.get('bounds')}")
-                except:
-                    pass
-                    
-            elif root.tag == 'hierarchy':
-                print(f"[Hierarchy] ℹ️ 单hierarchy格式")
-                # 打印根节点信息
-                first_nodes = root.findall('node')
-                if first_nodes:
-                    print(f"[Hierarchy] 顶层节点数: {len(first_nodes)}")
-                    for i, node in enumerate(first_nodes[:3]):  # 打印前3个
-                        print(f"[Hierarchy]   节点{i}: class={node.get('class')}, bounds={node.get('bounds')}")
-            else:
-                print(f"[Hierarchy] ⚠️ 未知根标签: {root.tag}")
-                
-        except Exception as parse_error:
-            print(f"[Hierarchy] ❌ XML解析/合并出错: {parse_error}")
-            import traceback
-            traceback.print_exc()
-            # 如果解析失败，返回原始XML
-            pass
-        
-        # 成功获取到XML
-        uiautomator_xml = xml_content
-        print(f"[Hierarchy] ✅ UIAutomator数据获取成功")
-        # cache
-        hierarchy_xml_cache[display] = uiautomator_xml
-        return {"xml": uiautomator_xml, "source": "uiautomator"}
-        
     except Exception as e:
-        print(f"[Hierarchy] ❌ UIAutomator获取失败: {e}")
-        import traceback
-        traceback.print_exc()
+        hierarchy_log.error(f"❌ UIAutomator获取失败: {e}", exc_info=True)
         
         # UIAutomator失败：尽量返回缓存，避免前端完全不可用
-        cached = hierarchy_xml_cache.get(display)
+        cached = hierarchy_cache.get((serial, display, "uiautomator"), allow_stale=True)
         if cached:
-            print(f"[Hierarchy] 🧰 返回缓存的hierarchy(避免前端中断)，display={display}")
+            hierarchy_log.info(f"🧰 返回缓存的hierarchy(避免前端中断)，display={display}")
             return {
-                "xml": cached,
+                "xml": cached["xml"],
+                "snapshot": cached.get("snapshot"),
                 "source": "cache",
                 "reason": "uiautomator_failed",
                 "error": str(e),
@@ -1539,6 +4499,304 @@ def get_hierarchy(display: int = 0, force_accessibility: bool = False):
             "error": str(e),
         }
 
+# --- 预取 ---
+# 输入操作后等界面稳定（PREFETCH_SETTLE_SECONDS）再在后台截图 + dump，前端随后的请求直接命中：
+# 截图走同一个 single-flight key（还在跑就合并），跑完的帧在 PREFETCH_FRAME_TTL 内给 /api/screenshot 用；
+# UI 树放进 hierarchy_cache。之后低优先级地预热最近用过的其它 display（有新的输入就让路）。
+# 切换到一个新 display 时，截图请求到来的同时就开始 dump 它的 UI 树。
+PREFETCH_SETTLE_SECONDS = {"click": 0.3, "swipe": 0.45, "back": 0.4}
+PREFETCH_FRAME_TTL = 1.0
+PREFETCH_RECENT_DISPLAYS = 3
+
+
+class Prefetcher:
+    def __init__(self):
+        self.cond = threading.Condition()
+        # serial -> (开始时间, display, 是否截图)，同一设备只保留最新一次
+        self.pending: Dict[str, Tuple[float, str, bool]] = {}
+        # serial -> 最近用过的 display（新的在后）-> 是否用辅助服务取 UI 树
+        self.recent: Dict[str, "OrderedDict[str, bool]"] = {}
+        # (serial, display) -> (截图完成时间, single-flight generation, frame)
+        self.frames: Dict[Tuple[str, str], Tuple[float, int, Dict]] = {}
+        # 低优先级预热队列 (serial, display)，只在没有到期的输入预取时执行
+        self.warm_queue: List[Tuple[str, str]] = []
+        self.thread: Optional[threading.Thread] = None
+        self.stats = {"scheduled": 0, "runs": 0, "warm_runs": 0, "frame_hits": 0, "errors": 0}
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._loop, name="prefetcher", daemon=True)
+            self.thread.start()
+
+    def touch(self, serial: str, display: str, force_accessibility: Optional[bool] = None):
+        """记录 display 被使用；切到一个新 display 时马上预取它的 UI 树。"""
+        with self.cond:
+            recent = self.recent.setdefault(serial, OrderedDict())
+            switched = bool(recent) and next(reversed(recent)) != display
+            if force_accessibility is None:
+                force_accessibility = recent.get(display, False)
+            recent[display] = force_accessibility
+            recent.move_to_end(display)
+            while len(recent) > PREFETCH_RECENT_DISPLAYS + 1:
+                recent.popitem(last=False)
+            if switched and serial not in self.pending:
+                self.pending[serial] = (time.time(), display, False)
+                self.stats["scheduled"] += 1
+                self._ensure_thread()
+                self.cond.notify()
+
+    def after_input(self, serial: str, display: str, kind: str) -> float:
+        settle = PREFETCH_SETTLE_SECONDS.get(kind, 0.3)
+        with self.cond:
+            self.pending[serial] = (time.time() + settle, display, True)
+            self.stats["scheduled"] += 1
+            self.warm_queue = [w for w in self.warm_queue if w[0] != serial]
+            for key in [k for k in self.frames if k[0] == serial]:
+                del self.frames[key]
+            self._ensure_thread()
+            self.cond.notify()
+        return settle
+
+    def take_frame(self, serial: str, display: str) -> Optional[Dict]:
+        """预取到的、上次输入之后截的、还没过期的帧。"""
+        with self.cond:
+            hit = self.frames.get((serial, display))
+        if hit is None:
+            return None
+        captured_at, generation, frame = hit
+        if time.time() - captured_at > PREFETCH_FRAME_TTL or generation != single_flight.generation(serial):
+            return None
+        with self.cond:
+            self.stats["frame_hits"] += 1
+        return frame
+
+    def drop_frame(self, serial: str, display: str):
+        with self.cond:
+            self.frames.pop((serial, display), None)
+
+    def forget(self, serial: str):
+        with self.cond:
+            self.pending.pop(serial, None)
+            self.recent.pop(serial, None)
+            self.warm_queue = [w for w in self.warm_queue if w[0] != serial]
+            for key in [k for k in self.frames if k[0] == serial]:
+                del self.frames[key]
+
+    def _prefetch(self, serial: str, display: str, screenshot: bool):
+        generation = single_flight.generation(serial)
+        with screen_streamers_lock:
+            # 推流中的 display 一直在截图，不用再预取
+            streaming = (serial, display) in screen_streamers
+        if screenshot and not streaming:
+            frame = capture_frame_shared(serial, display, prefer_raw=True, fresh=0)
+            remember_frame(serial, display, frame)
+            with self.cond:
+                self.frames[(serial, display)] = (time.time(), generation, frame)
+        if serial != current_serial or not display.isdigit():
+            return
+        with self.cond:
+            force_accessibility = self.recent.get(serial, {}).get(display, False)
+        kind = "hierarchy:accessibility" if force_accessibility else "hierarchy"
+        single_flight.do((serial, display, kind), lambda: _fetch_hierarchy(int(display), force_accessibility),
+                         fresh=SINGLE_FLIGHT_FRESH_SECONDS["hierarchy"])
+
+    def _next_job(self) -> Tuple[str, str, bool, bool]:
+        """等下一个任务：到期的输入预取优先；都没有时挑一个最近用过的 display 低优先级预热。"""
+        with self.cond:
+            while True:
+                now = time.time()
+                due = [(t, s) for s, (t, _, _) in self.pending.items() if t <= now]
+                if due:
+                    serial = min(due)[1]
+                    _, display, screenshot = self.pending.pop(serial)
+                    return serial, display, screenshot, False
+                if self.pending:
+                    self.cond.wait(min(t for t, _, _ in self.pending.values()) - now)
+                    continue
+                warm = self.warm_queue.pop(0) if self.warm_queue else None
+                if warm is not None:
+                    return warm[0], warm[1], True, True
+                self.cond.wait()
+
+    def _loop(self):
+        while True:
+            serial, display, screenshot, warm = self._next_job()
+            try:
+                t0 = time.time()
+                self._prefetch(serial, display, screenshot)
+                with self.cond:
+                    self.stats["warm_runs" if warm else "runs"] += 1
+                    if not warm and screenshot:
+                        # 主 display 完成后排上最近用过的其它 display
+                        others = [d for d in reversed(self.recent.get(serial, {})) if d != display]
+                        self.warm_queue = [(serial, d) for d in others[:PREFETCH_RECENT_DISPLAYS]]
+                elapsed_ms = int((time.time() - t0) * 1000)
+                prefetch_log.debug(f"{'🌡️ 预热' if warm else '⚡ 预取'} {serial} display {display} {elapsed_ms}ms",
+                                   serial=serial, display=display, warm=warm, ms=elapsed_ms)
+            except Exception as e:
+                with self.cond:
+                    self.stats["errors"] += 1
+                prefetch_log.warning(f"⚠️ {serial} display {display} 预取失败: {e}")
+
+    def snapshot(self) -> Dict:
+        now = time.time()
+        with self.cond:
+            return dict(
+                self.stats,
+                pending={s: {"display": d, "in": round(max(0.0, t - now), 3), "screenshot": shot}
+                         for s, (t, d, shot) in self.pending.items()},
+                recent={s: list(r) for s, r in self.recent.items()},
+                frames={f"{s}:{d}": round(now - t, 3) for (s, d), (t, _, _) in self.frames.items()},
+            )
+
+
+prefetcher = Prefetcher()
+
+
+@app.get("/api/prefetch")
+def get_prefetch_stats():
+    """预取状态：排队中的任务、最近用过的 display、可用的预取帧及命中次数。"""
+    return prefetcher.snapshot()
+
+
+# --- 辅助服务 UI 变化事件 ---
+# 辅助服务把窗口内容/状态变化合并成每个 display 的版本号，/api/events 长轮询返回变了的 display。
+# 订阅期间：
+# - 只作废变了的 display 的 UI 树缓存和截图结果，其它 display 继续复用
+# - UI 树缓存的 TTL 放宽到 HIERARCHY_CACHE_EVENT_TTL，界面不动就不 dump、不截图
+# 连接断开/重连（可能漏了事件）时作废该设备全部缓存，并退回普通 TTL。
+ACCESSIBILITY_EVENTS_URL = "http://localhost:8765/api/events"
+ACCESSIBILITY_EVENTS_POLL_MS = 25000
+# 长轮询本身之外留给网络/adb forward 的余量
+ACCESSIBILITY_EVENTS_SLACK = 5.0
+ACCESSIBILITY_EVENTS_BACKOFF = (1.0, 30.0)
+
+
+class AccessibilityEventSubscriber:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # serial -> 订阅线程状态
+        self.subscriptions: Dict[str, Dict] = {}
+        self.stats = {"polls": 0, "changes": 0, "resyncs": 0, "errors": 0}
+
+    def ensure(self, serial: str, target_serial: Optional[str] = None):
+        """确保 serial 有一个订阅线程（target_serial 为辅助服务实际所在的设备）。"""
+        if requests is None or not serial:
+            return
+        with self.lock:
+            sub = self.subscriptions.get(serial)
+            if sub is not None and sub["thread"].is_alive():
+                return
+            sub = {"target": target_serial or serial, "version": None, "displays": {}, "live_until": 0.0,
+                   "last_change": None, "error": None, "stop": threading.Event()}
+            sub["thread"] = threading.Thread(target=self._loop, args=(serial, sub), daemon=True,
+                                             name=f"a11y-events-{serial}")
+            self.subscriptions[serial] = sub
+        sub["thread"].start()
+        accessibility_log.info(f"📡 订阅辅助服务 UI 变化事件: {serial}")
+
+    def forget(self, serial: str):
+        with self.lock:
+            sub = self.subscriptions.pop(serial, None)
+        if sub is not None:
+            sub["stop"].set()
+        hierarchy_cache.set_event_driven(serial, 0)
+
+    def apply(self, serial: str, sub: Dict, data: Dict):
+        """处理一次 /api/events 响应。第一次（或设备端版本回退 = 服务重启）时作废全部。"""
+        version = int(data.get("version") or 0)
+        changed = [int(d) for d in data.get("changed") or []]
+        resync = sub["version"] is None or version < sub["version"]
+        sub["version"] = version
+        sub["displays"] = {str(k): v for k, v in (data.get("displays") or {}).items()}
+        if resync:
+            self.stats["resyncs"] += 1
+            invalidate_display(serial, None)
+        else:
+            for display in changed:
+                invalidate_display(serial, display)
+        if changed:
+            self.stats["changes"] += 1
+            sub["last_change"] = time.time()
+        sub["live_until"] = time.time() + ACCESSIBILITY_EVENTS_POLL_MS / 1000.0 + ACCESSIBILITY_EVENTS_SLACK
+        hierarchy_cache.set_event_driven(serial, sub["live_until"])
+        return changed
+
+    def _loop(self, serial: str, sub: Dict):
+        backoff = ACCESSIBILITY_EVENTS_BACKOFF[0]
+        forwarded = False
+        while not sub["stop"].is_set() and serial == current_serial:
+            try:
+                if not forwarded:
+                    _adb_run(["adb", "-s", sub["target"], "forward", "tcp:8765", "tcp:8765"], timeout=3)
+                    forwarded = True
+                since = sub["version"] if sub["version"] is not None else 0
+                response = requests.get(ACCESSIBILITY_EVENTS_URL,
+                                        params={"since": since, "timeout": ACCESSIBILITY_EVENTS_POLL_MS},
+                                        timeout=ACCESSIBILITY_EVENTS_POLL_MS / 1000.0 + ACCESSIBILITY_EVENTS_SLACK)
+                if response.status_code != 200:
+                    # 旧版本 APK 没有 /api/events：不订阅，缓存按普通 TTL
+                    raise Exception(f"HTTP {response.status_code}")
+                self.stats["polls"] += 1
+                changed = self.apply(serial, sub, response.json())
+                if changed:
+                    accessibility_log.debug(f"🔔 {serial} display {changed} 界面变化", serial=serial,
+                                            displays=changed)
+                sub["error"] = None
+                backoff = ACCESSIBILITY_EVENTS_BACKOFF[0]
+            except Exception as e:
+                self.stats["errors"] += 1
+                # 可能漏了事件：下次连上后当作第一次，作废全部
+                sub["version"] = None
+                sub["live_until"] = 0.0
+                sub["error"] = str(e)
+                forwarded = False
+                hierarchy_cache.set_event_driven(serial, 0)
+                accessibility_log.warning(f"⚠️ {serial} UI 变化事件订阅失败，{backoff:.0f}s 后重试: {e}")
+                sub["stop"].wait(backoff)
+                backoff = min(backoff * 2, ACCESSIBILITY_EVENTS_BACKOFF[1])
+        hierarchy_cache.set_event_driven(serial, 0)
+        with self.lock:
+            if self.subscriptions.get(serial) is sub:
+                del self.subscriptions[serial]
+        accessibility_log.info(f"📴 停止订阅 UI 变化事件: {serial}")
+
+    def snapshot(self) -> Dict:
+        now = time.time()
+        with self.lock:
+            return dict(
+                self.stats,
+                available=requests is not None,
+                subscriptions={
+                    s: {"target": sub["target"], "version": sub["version"], "displays": sub["displays"],
+                        "live": sub["live_until"] > now, "error": sub["error"],
+                        "last_change_age": round(now - sub["last_change"], 3) if sub["last_change"] else None}
+                    for s, sub in self.subscriptions.items()
+                },
+            )
+
+
+accessibility_events = AccessibilityEventSubscriber()
+
+
+def invalidate_display(serial: str, display: Optional[int]):
+    """界面变化通知：作废该 display（None 为全部）的 UI 树缓存、截图复用和预取帧。"""
+    if display is None:
+        # generation 递增后旧的预取帧也不会再被 take_frame 返回
+        single_flight.forget(serial)
+        hierarchy_cache.invalidate(serial)
+        return
+    single_flight.forget_display(serial, str(display))
+    hierarchy_cache.invalidate(serial, display)
+    prefetcher.drop_frame(serial, str(display))
+
+
+@app.get("/api/accessibility/events")
+def get_accessibility_events():
+    """UI 变化事件订阅状态：每个设备的版本号、各 display 版本、是否在线及最近一次变化。"""
+    return accessibility_events.snapshot()
+
+
 class ClickRequest(BaseModel):
     x: int
     y: int
@@ -1550,13 +4808,14 @@ def click_screen(req: ClickRequest):
     if not current_serial:
          raise HTTPException(status_code=400, detail="Device not connected")
     try:
-        d = adb.device(serial=current_serial)
         # Add -d for input if supported (Android 10+)
         if req.display > 0:
-            d.shell(f"input -d {req.display} tap {req.x} {req.y}")
+            adb_pool.shell(current_serial, f"input -d {req.display} tap {req.x} {req.y}")
         else:
-            d.shell(f"input tap {req.x} {req.y}")
-        return {"status": "clicked", "x": req.x, "y": req.y, "display": req.display}
+            adb_pool.shell(current_serial, f"input tap {req.x} {req.y}")
+        settle = on_device_input(current_serial, req.display, "click")
+        return {"status": "clicked", "x": req.x, "y": req.y, "display": req.display,
+                "prefetch_ms": int(settle * 1000)}
     except Exception as e:
          raise HTTPException(status_code=500, detail=str(e))
 
@@ -1574,13 +4833,14 @@ def swipe_screen(req: SwipeRequest):
     if not current_serial:
          raise HTTPException(status_code=400, detail="Device not connected")
     try:
-        d = adb.device(serial=current_serial)
         duration_ms = int(req.duration * 1000)
         if req.display > 0:
-            d.shell(f"input -d {req.display} swipe {req.start_x} {req.start_y} {req.end_x} {req.end_y} {duration_ms}")
+            adb_pool.shell(current_serial, f"input -d {req.display} swipe {req.start_x} {req.start_y} {req.end_x} {req.end_y} {duration_ms}")
         else:
-            d.shell(f"input swipe {req.start_x} {req.start_y} {req.end_x} {req.end_y} {duration_ms}")
-        return {"status": "swiped", "start": [req.start_x, req.start_y], "end": [req.end_x, req.end_y], "display": req.display}
+            adb_pool.shell(current_serial, f"input swipe {req.start_x} {req.start_y} {req.end_x} {req.end_y} {duration_ms}")
+        settle = on_device_input(current_serial, req.display, "swipe")
+        return {"status": "swiped", "start": [req.start_x, req.start_y], "end": [req.end_x, req.end_y],
+                "display": req.display, "prefetch_ms": int(settle * 1000)}
     except Exception as e:
          raise HTTPException(status_code=500, detail=str(e))
 
@@ -1593,13 +4853,13 @@ def back_button(req: BackRequest):
     if not current_serial:
          raise HTTPException(status_code=400, detail="Device not connected")
     try:
-        d = adb.device(serial=current_serial)
         if req.display > 0:
             # keyevent 4 is BACK
-            d.shell(f"input -d {req.display} keyevent 4")
+            adb_pool.shell(current_serial, f"input -d {req.display} keyevent 4")
         else:
-            d.shell(f"input keyevent 4")
-        return {"status": "back", "display": req.display}
+            adb_pool.shell(current_serial, f"input keyevent 4")
+        settle = on_device_input(current_serial, req.display, "back")
+        return {"status": "back", "display": req.display, "prefetch_ms": int(settle * 1000)}
     except Exception as e:
          raise HTTPException(status_code=500, detail=str(e))
 
@@ -1615,24 +4875,21 @@ def enable_accessibility_service():
     # 统一使用 resolve_accessibility_target_serial，避免 SS4 上 serial 选择不一致
     target_serial = get_accessibility_target_serial_from_current()
     if target_serial != current_serial:
-        print(f"[Accessibility] 🔧 目标设备序列号修正: {current_serial} -> {target_serial}")
+        accessibility_log.info(f"🔧 目标设备序列号修正: {current_serial} -> {target_serial}")
     
     try:
-        print(f"[Accessibility] 🔧 启用辅助服务...")
-        print(f"[Accessibility] 📱 目标设备: {target_serial}")
+        accessibility_log.info(f"🔧 启用辅助服务...")
+        accessibility_log.debug(f"📱 目标设备: {target_serial}")
         
         # 获取当前启用的所有辅助服务
-        result = subprocess.run(
-            ["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"],
-            capture_output=True, text=True, timeout=3
-        )
+        result = _adb_run(["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"], timeout=3)
         
         current_services = result.stdout.strip()
-        print(f"[Accessibility] 当前服务: {current_services}")
+        accessibility_log.debug(f"当前服务: {current_services}")
         
         # 如果已经包含我们的服务，不需要重复添加
         if "com.carui.accessibility" in current_services:
-            print(f"[Accessibility] ℹ️ 辅助服务已启用")
+            accessibility_log.info(f"ℹ️ 辅助服务已启用")
             return {
                 "status": "success",
                 "message": "辅助服务已启用",
@@ -1646,27 +4903,18 @@ def enable_accessibility_service():
             new_services = "com.carui.accessibility/.CarUIAccessibilityService"
         
         # 更新设置（使用target_serial）
-        subprocess.run(
-            ["adb", "-s", target_serial, "shell", "settings", "put", "secure", 
-             "enabled_accessibility_services", new_services],
-            capture_output=True, text=True, timeout=3
-        )
+        _adb_run(["adb", "-s", target_serial, "shell", "settings", "put", "secure", 
+             "enabled_accessibility_services", new_services], timeout=3)
         
         # 确保辅助服务功能已启用
-        subprocess.run(
-            ["adb", "-s", target_serial, "shell", "settings", "put", "secure",
-             "accessibility_enabled", "1"],
-            capture_output=True, text=True, timeout=3
-        )
+        _adb_run(["adb", "-s", target_serial, "shell", "settings", "put", "secure",
+             "accessibility_enabled", "1"], timeout=3)
         
         # 设置端口转发（使用target_serial）
-        subprocess.run(
-            ["adb", "-s", target_serial, "forward", "tcp:8765", "tcp:8765"],
-            capture_output=True, text=True, timeout=3
-        )
+        _adb_run(["adb", "-s", target_serial, "forward", "tcp:8765", "tcp:8765"], timeout=3)
         
-        print(f"[Accessibility] ✅ 已启用辅助服务")
-        print(f"[Accessibility] 新服务列表: {new_services}")
+        accessibility_log.info(f"✅ 已启用辅助服务")
+        accessibility_log.debug(f"新服务列表: {new_services}")
         
         return {
             "status": "success",
@@ -1676,7 +4924,7 @@ def enable_accessibility_service():
         }
     
     except Exception as e:
-        print(f"[Accessibility] ❌ 启用失败: {e}")
+        accessibility_log.error(f"❌ 启用失败: {e}")
         raise HTTPException(status_code=500, detail=f"启用辅助服务失败: {str(e)}")
 
 
@@ -1708,20 +4956,17 @@ def disable_accessibility_service():
     # 统一使用 resolve_accessibility_target_serial，避免 SS4 上 serial 选择不一致
     target_serial = get_accessibility_target_serial_from_current()
     if target_serial != current_serial:
-        print(f"[Accessibility] 🛑 目标设备序列号修正: {current_serial} -> {target_serial}")
+        accessibility_log.info(f"🛑 目标设备序列号修正: {current_serial} -> {target_serial}")
     
     try:
-        print(f"[Accessibility] 🛑 禁用辅助服务...")
-        print(f"[Accessibility] 📱 目标设备: {target_serial}")
+        accessibility_log.info(f"🛑 禁用辅助服务...")
+        accessibility_log.debug(f"📱 目标设备: {target_serial}")
         
         # 获取当前启用的所有辅助服务
-        result = subprocess.run(
-            ["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"],
-            capture_output=True, text=True, timeout=3
-        )
+        result = _adb_run(["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"], timeout=3)
         
         current_services = result.stdout.strip()
-        print(f"[Accessibility] 当前服务: {current_services}")
+        accessibility_log.debug(f"当前服务: {current_services}")
         
         # 移除我们的辅助服务
         if "com.carui.accessibility" in current_services:
@@ -1732,14 +4977,11 @@ def disable_accessibility_service():
             new_services = ':'.join(services_list)
             
             # 更新设置（使用target_serial）
-            subprocess.run(
-                ["adb", "-s", target_serial, "shell", "settings", "put", "secure", 
-                 "enabled_accessibility_services", new_services],
-                capture_output=True, text=True, timeout=3
-            )
+            _adb_run(["adb", "-s", target_serial, "shell", "settings", "put", "secure", 
+                 "enabled_accessibility_services", new_services], timeout=3)
             
-            print(f"[Accessibility] ✅ 已禁用辅助服务")
-            print(f"[Accessibility] 新服务列表: {new_services}")
+            accessibility_log.info(f"✅ 已禁用辅助服务")
+            accessibility_log.debug(f"新服务列表: {new_services}")
             
             return {
                 "status": "success",
@@ -1748,16 +4990,42 @@ def disable_accessibility_service():
                 "current_services": new_services
             }
         else:
-            print(f"[Accessibility] ℹ️ 辅助服务未启用")
+            accessibility_log.info(f"ℹ️ 辅助服务未启用")
             return {
                 "status": "success",
                 "message": "辅助服务未启用，无需操作"
             }
     
     except Exception as e:
-        print(f"[Accessibility] ❌ 禁用失败: {e}")
+        accessibility_log.error(f"❌ 禁用失败: {e}")
         raise HTTPException(status_code=500, detail=f"禁用辅助服务失败: {str(e)}")
 
+@app.get("/api/accessibility/find")
+def find_accessibility_nodes(display: int = 0, text: Optional[str] = None, text_contains: Optional[str] = None,
+                             resource_id: Optional[str] = None, class_name: Optional[str] = None,
+                             window: Optional[str] = None, limit: int = ACCESSIBILITY_FIND_DEFAULT_LIMIT):
+    """由辅助服务在设备上查节点：一次小请求，不传整棵树、不转 XML。
+
+    resource_id / class_name 不带包名时按短名匹配（同 /api/query）；window 为窗口 id 或标题片段。
+    有 resource_id 或文本条件时设备端用系统的 findAccessibilityNodeInfosByViewId / ByText。
+    """
+    if not current_serial:
+        raise HTTPException(status_code=400, detail="Device not connected")
+    selector = {k: v for k, v in (("text", text), ("textContains", text_contains), ("viewId", resource_id),
+                                   ("className", class_name)) if v}
+    if not selector:
+        raise HTTPException(status_code=400, detail="text / text_contains / resource_id / class_name required")
+    target_serial = resolve_accessibility_target_serial(current_serial)
+    t0 = time.perf_counter()
+    try:
+        result = find_from_accessibility(target_serial, display, selector, window=window, limit=max(1, limit))
+    except Exception as e:
+        accessibility_log.warning(f"⚠️ 辅助服务查找失败: {e}")
+        raise HTTPException(status_code=503, detail=f"Accessibility find failed: {e}")
+    return dict(result, display=display, source="accessibility",
+                elapsed_ms=round((time.perf_counter() - t0) * 1000, 3))
+
+
 @app.get("/api/accessibility/status")
 def get_accessibility_status():
     """获取辅助服务状态"""
@@ -1773,11 +5041,11 @@ def get_accessibility_status():
     # 对外仍保留 target_serial 字段：表示本次探测认为更可能有效的 serial
     target_serial = probe_ok_serial or shell_serial or current_serial
     if target_serial != current_serial:
-        print(f"[Accessibility] 📊 目标设备序列号修正: {current_serial} -> {target_serial}")
+        accessibility_log.info(f"📊 目标设备序列号修正: {current_serial} -> {target_serial}")
     
     try:
-        print(f"[Accessibility] 📊 查询辅助服务状态...")
-        print(f"[Accessibility] 📱 目标设备: {target_serial}")
+        accessibility_log.info(f"📊 查询辅助服务状态...")
+        accessibility_log.debug(f"📱 目标设备: {target_serial}")
         
         enabled_services = ""
         is_enabled = False
@@ -1785,8 +5053,7 @@ def get_accessibility_status():
 
         # 检查是否启用（注意：部分车机/SS4 环境 settings 命令可能不可用）
         try:
-            result = subprocess.run(
-                [
+            result = _adb_run([
                     "adb",
                     "-s",
                     shell_serial,
@@ -1795,12 +5062,7 @@ def get_accessibility_status():
                     "get",
                     "secure",
                     "enabled_accessibility_services",
-                ],
-                capture_output=True,
-                text=True,
-                timeout=3,
-                check=False,
-            )
+                ], timeout=3)
             enabled_services = (result.stdout or "").strip()
             combined = (result.stdout or "") + (result.stderr or "")
             if result.returncode != 0 or "not found" in combined.lower():
@@ -1858,10 +5120,7 @@ def restart_server():
                 if target_serial != current_serial:
                     print(f"[RESTART] ♿ SS设备修正辅助服务目标序列号: {current_serial} -> {target_serial}")
 
-                result = subprocess.run(
-                    ["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"],
-                    capture_output=True, text=True, timeout=3
-                )
+                result = _adb_run(["adb", "-s", target_serial, "shell", "settings", "get", "secure", "enabled_accessibility_services"], timeout=3)
                 
                 current_services = result.stdout.strip()
                 
@@ -1871,11 +5130,8 @@ def restart_server():
                     services_list = [s for s in services_list if 'com.carui.accessibility' not in s]
                     new_services = ':'.join(services_list)
                     
-                    subprocess.run(
-                        ["adb", "-s", target_serial, "shell", "settings", "put", "secure", 
-                         "enabled_accessibility_services", new_services],
-                        capture_output=True, text=True, timeout=3
-                    )
+                    _adb_run(["adb", "-s", target_serial, "shell", "settings", "put", "secure", 
+                         "enabled_accessibility_services", new_services], timeout=3)
                     
                     print(f"[RESTART] ✅ 已禁用辅助服务，恢复原有服务")
                 else:
@@ -15,6 +15,9 @@ let selectedNode = null;
 let hoverNode = null; // New for hover
 let screenImage = new Image();
 let mapNodeToDom = new Map();
+// 增量刷新：当前树的版本号，以及它对应的 display / 数据源（换了就要完整刷新）
+let hierarchyVersion = null;
+let hierarchyVersionKey = null;
 
 // Accessibility status cache
 let accessibilityStatus = {
@@ -1123,43 +1126,42 @@ async function refreshSnapshot(forceShowLoading = true) {
     }
 }
 
-function refreshScreen() {
-    return new Promise((resolve) => {
-        const displayId = currentDisplay || "0";
-        const img = new Image();
-        img.src = `/api/screenshot?display=${displayId}&t=${new Date().getTime()}`;
-        img.onload = async () => {
-            try {
-                // 截图已恢复，隐藏“截屏已关闭”遮罩
-                const screenEmpty = document.getElementById('screenEmptyState');
-                if (screenEmpty) screenEmpty.classList.add('hidden');
-
-                // 开启异步解码，避免主线程卡顿，实现 scrcpy 般的流畅感
-                if (img.decode) await img.decode();
-                screenImage = img;
+// 上一次截图的 ETag（按 display 区分），画面没变时服务端返回 304，跳过解码和重绘
+let lastScreenEtag = { display: null, etag: null };
 
-                // Canvas内部尺寸直接使用设备分辨率，不需要2x缩放
-                // 这样hierarchy的bounds坐标就能直接对应到Canvas坐标
-                canvas.width = screenImage.naturalWidth;
-                canvas.height = screenImage.naturalHeight;
+async function refreshScreen() {
+    const displayId = currentDisplay || "0";
+    try {
+        const headers = {};
+        if (lastScreenEtag.display === displayId && lastScreenEtag.etag && screenImage.src) {
+            headers['If-None-Match'] = lastScreenEtag.etag;
+        }
+        // 预览只需要面板宽度的分辨率：服务端缩小后再传，canvas 仍按设备分辨率建坐标系
+        const panel = canvas.parentElement;
+        const panelWidth = panel ? panel.clientWidth : 0;
+        const maxWidth = panelWidth > 0 ? Math.ceil(panelWidth * (window.devicePixelRatio || 1)) : 0;
+        const sizeParam = maxWidth > 0 ? `&max_width=${maxWidth}` : '';
+        const res = await fetch(`/api/screenshot?display=${displayId}${sizeParam}`, { cache: 'no-store', headers });
+        if (res.status === 304) return;
+        if (!res.ok) {
+            console.warn("无法获取截图");
+            return;
+        }
+        const blob = await res.blob();
+        lastScreenEtag = { display: displayId, etag: res.headers.get('ETag') };
 
-                ctx.imageSmoothingEnabled = true;
-                ctx.imageSmoothingQuality = 'high';
-                drawScreen();
+        ctx.imageSmoothingEnabled = true;
+        ctx.imageSmoothingQuality = 'high';
+        // Canvas内部尺寸直接使用设备分辨率，这样hierarchy的bounds坐标就能直接对应到Canvas坐标
+        const frameWidth = parseInt(res.headers.get('X-Frame-Width')) || 0;
+        const frameHeight = parseInt(res.headers.get('X-Frame-Height')) || 0;
+        await applyScreenBlob(blob, frameWidth, frameHeight);
 
-                // After drawing screenshot, detect black/secure-protected content
-                await updateSecureWarningByScreenshot();
-                resolve();
-            } catch (err) {
-                console.warn("Decode failed", err);
-                resolve();
-            }
-        };
-        img.onerror = () => {
-            console.warn("无法获取截图");
-            resolve();
-        };
-    });
+        // After drawing screenshot, detect black/secure-protected content
+        await updateSecureWarningByScreenshot();
+    } catch (err) {
+        console.warn("Decode failed", err);
+    }
 }
 
 function toggleSidebar() {
@@ -1174,8 +1176,14 @@ let lastClickX = null;
 let lastClickY = null;
 let clickCrosshairTimeout = null;
 
+// 当前截图的设备分辨率。canvas 内部尺寸始终等于设备分辨率，
+// screenImage 本身可能是缩小的预览图或增量推流的离屏 canvas
+function screenImageSize() {
+    return { width: canvas.width, height: canvas.height };
+}
+
 function drawScreen() {
-    if (!screenImage.src) return;
+    if (!screenImage.src && !(screenImage instanceof HTMLCanvasElement)) return;
     ctx.clearRect(0, 0, canvas.width, canvas.height);
 
     // 渲染截图 (填满整个Canvas)
@@ -1354,19 +1362,36 @@ async function refreshHierarchy() {
     try {
         const displayId = currentDisplay || "0";
         const useAccessibility = document.getElementById('useAccessibilityService').checked;
-        const res = await fetch(`/api/hierarchy?display=${displayId}&force_accessibility=${useAccessibility}`);
+        const versionKey = `${displayId}:${useAccessibility}`;
+        // 手里有带 id 的树就只要增量（服务端做不了增量时会直接回完整快照）
+        const canDelta = rootNode && rootNode.byId && hierarchyVersionKey === versionKey && hierarchyVersion !== null;
+        const since = canDelta ? hierarchyVersion : 0;
+        const res = await fetch(`/api/hierarchy?display=${displayId}&force_accessibility=${useAccessibility}&format=columnar&since=${since}`);
         if (!res.ok) return;
         const data = await res.json();
-        const parser = new DOMParser();
-        const xmlDoc = parser.parseFromString(data.xml, "text/xml");
 
-        treeContainer.innerHTML = '';
-        rootNode = xmlDoc.documentElement;
-        mapNodeToDom.clear();
+        if (data.format === 'delta') {
+            if (!canDelta || data.base !== hierarchyVersion || !applyHierarchyDelta(data)) {
+                // 增量对不上当前树：丢掉版本号，重新要完整快照
+                hierarchyVersion = null;
+                return refreshHierarchy();
+            }
+        } else {
+            treeContainer.innerHTML = '';
+            if (data.format === 'columnar') {
+                rootNode = buildTreeFromColumnar(data);
+            } else {
+                const parser = new DOMParser();
+                rootNode = parser.parseFromString(data.xml, "text/xml").documentElement;
+            }
+            mapNodeToDom.clear();
 
-        const treeList = document.createElement('div');
-        traverseAndBuildTree(rootNode, treeList);
-        treeContainer.appendChild(treeList);
+            const treeList = document.createElement('div');
+            traverseAndBuildTree(rootNode, treeList);
+            treeContainer.appendChild(treeList);
+        }
+        hierarchyVersion = data.version ?? null;
+        hierarchyVersionKey = versionKey;
 
         // 显示数据源信息
         if (data.source) {
@@ -1413,7 +1438,159 @@ async function refreshHierarchy() {
     }
 }
 
+// format=columnar -> 轻量节点对象（和 XML DOM 节点一样提供 tagName / children / parentNode），
+// 属性和 bounds 在这里一次性建好，hover/点击命中时不再逐节点正则解析
+function buildTreeFromColumnar(data) {
+    const root = { tagName: 'hierarchy', attrs: { rotation: '0' }, children: [], parentNode: null, boundsObj: null };
+    root.querySelector = () => root.children[0] || null;
+    const strings = data.strings;
+    const stringColumns = [
+        ['class', data['class']],
+        ['package', data.package],
+        ['resource-id', data.resource_id],
+        ['text', data.text],
+        ['content-desc', data.content_desc],
+    ];
+    const flagBits = Object.entries(data.flag_bits || {});
+    const extras = data.extras || {};
+    const ids = data.ids || null;
+    if (ids) root.byId = new Map();
+    const nodes = new Array(data.count);
+    for (let i = 0; i < data.count; i++) {
+        const attrs = {};
+        if (data.index[i] >= 0) attrs['index'] = String(data.index[i]);
+        for (const [name, column] of stringColumns) {
+            if (column[i] >= 0) attrs[name] = strings[column[i]];
+        }
+        for (const [name, bit] of flagBits) {
+            attrs[name] = (data.flags[i] >> bit) & 1 ? 'true' : 'false';
+        }
+        let boundsObj = null;
+        const x1 = data.bounds[i * 4], y1 = data.bounds[i * 4 + 1];
+        const x2 = data.bounds[i * 4 + 2], y2 = data.bounds[i * 4 + 3];
+        if (x1 >= 0) {
+            attrs['bounds'] = `[${x1},${y1}][${x2},${y2}]`;
+            boundsObj = { x1, y1, x: x1, y: y1, x2, y2, w: x2 - x1, h: y2 - y1, area: (x2 - x1) * (y2 - y1) };
+        }
+        if (extras[i]) Object.assign(attrs, extras[i]);
+        const parent = data.parent[i] >= 0 ? nodes[data.parent[i]] : root;
+        const node = { tagName: 'node', attrs, children: [], parentNode: parent, boundsObj };
+        if (ids) {
+            node.id = ids[i];
+            root.byId.set(node.id, node);
+        }
+        parent.children.push(node);
+        nodes[i] = node;
+    }
+    return root;
+}
+
+// 把服务端的增量（removed / changed / added）打到当前树和树视图上，只重建受影响的节点。
+// 任何 id 对不上都返回 false，由调用方退回完整刷新。
+function applyHierarchyDelta(delta) {
+    const byId = rootNode.byId;
+    const dirtyParents = new Set();
+    const relabel = new Set();
+
+    for (const id of delta.removed) {
+        const node = byId.get(id);
+        if (!node) return false;
+        byId.delete(id);
+        const parent = node.parentNode;
+        const idx = parent.children.indexOf(node);
+        if (idx >= 0) parent.children.splice(idx, 1);
+        const dom = mapNodeToDom.get(node);
+        if (dom) {
+            dom.container.remove();
+            mapNodeToDom.delete(node);
+        }
+        if (selectedNode === node) {
+            selectedNode = null;
+            propsContainer.innerHTML = '<div class="empty-state">请点击元素查看属性</div>';
+        }
+        if (hoverNode === node) hoverNode = null;
+        dirtyParents.add(parent);
+    }
+
+    for (const change of delta.changed) {
+        const node = byId.get(change.id);
+        if (!node) return false;
+        Object.assign(node.attrs, change.set);
+        for (const key of change.unset) delete node.attrs[key];
+        if ('bounds' in change.set || change.unset.includes('bounds')) {
+            node.boundsObj = parseBounds(node.attrs['bounds']);
+        }
+        relabel.add(node);
+    }
+
+    // added 按前序给出，父节点总在子节点前面
+    const added = new Set();
+    for (const item of delta.added) {
+        const parent = item.parent === null ? rootNode : byId.get(item.parent);
+        if (!parent) return false;
+        const after = item.after === null ? null : byId.get(item.after);
+        if (item.after !== null && (!after || after.parentNode !== parent)) return false;
+        const node = {
+            tagName: 'node', attrs: item.attrs, children: [], parentNode: parent,
+            boundsObj: parseBounds(item.attrs['bounds']), id: item.id,
+        };
+        parent.children.splice(after ? parent.children.indexOf(after) + 1 : 0, 0, node);
+        byId.set(item.id, node);
+        added.add(node);
+        if (!added.has(parent)) dirtyParents.add(parent);
+    }
+
+    for (const parent of dirtyParents) {
+        const dom = mapNodeToDom.get(parent);
+        if (!dom) continue; // 父节点本身也被删了
+        const childContainer = dom.container.querySelector(':scope > .children-container');
+        if (!childContainer || parent.children.length === 0) {
+            // 叶子变成了父节点（或反过来）：整个节点重建，子树很小
+            rebuildNodeDom(parent);
+            continue;
+        }
+        parent.children.forEach((child, i) => {
+            if (!added.has(child)) return;
+            const tmp = document.createElement('div');
+            traverseAndBuildTree(child, tmp);
+            // 插到后面第一个已有 DOM 的兄弟前面
+            let next = null;
+            for (let j = i + 1; j < parent.children.length && !next; j++) {
+                const sibling = mapNodeToDom.get(parent.children[j]);
+                if (sibling && sibling.container.parentNode === childContainer) next = sibling.container;
+            }
+            childContainer.insertBefore(tmp.firstChild, next);
+        });
+    }
+
+    for (const node of relabel) {
+        const dom = mapNodeToDom.get(node);
+        if (dom) renderNodeLabel(node, dom.content, dom.textSpan);
+    }
+
+    if (selectedNode && relabel.has(selectedNode)) {
+        renderProperties(getAttributes(selectedNode));
+    }
+    drawScreen();
+    return true;
+}
+
+function rebuildNodeDom(node) {
+    const dom = mapNodeToDom.get(node);
+    if (!dom) return;
+    const tmp = document.createElement('div');
+    traverseAndBuildTree(node, tmp);
+    dom.container.replaceWith(tmp.firstChild);
+}
+
+// 节点 bounds：columnar 节点直接用预解析结果，XML 节点才解析字符串
+function nodeBounds(node) {
+    if (node.boundsObj !== undefined) return node.boundsObj;
+    return parseBounds(getAttributes(node)['bounds']);
+}
+
 function getAttributes(xmlNode) {
+    if (xmlNode.attrs) return xmlNode.attrs;
     if (!xmlNode.attributes) return {};
     const attrs = {};
     for (let i = 0; i < xmlNode.attributes.length; i++) {
@@ -1442,13 +1619,8 @@ function parseBounds(boundsStr) {
     return null;
 }
 
-function traverseAndBuildTree(xmlNode, parentElement) {
-    const container = document.createElement('div');
-    container.className = 'tree-node';
-
-    const content = document.createElement('div');
-    content.className = 'tree-content';
-
+// 树节点的显示文字（class #id "text"）+ 搜索高亮；增量刷新时属性变了会重新调用
+function renderNodeLabel(xmlNode, content, textSpan) {
     const attrs = getAttributes(xmlNode);
     let name = attrs['class'] || xmlNode.tagName;
     if (name.includes('.')) {
@@ -1466,6 +1638,42 @@ function traverseAndBuildTree(xmlNode, parentElement) {
         label += ` "${txt.length > 20 ? txt.substring(0, 20) + '...' : txt}"`;
     }
 
+    content.style.backgroundColor = '';
+    
+    // 应用搜索高亮 - 每个关键字独立配色
+    if (searchSettings.patterns && searchSettings.patterns.length > 0) {
+        let highlighted = label;
+        let matchedPattern = null;
+        
+        // 找到第一个匹配的pattern
+        for (const pattern of searchSettings.patterns) {
+            if (pattern && pattern.text && pattern.text.trim() !== '') {
+                if (textMatches(label, pattern.text, searchSettings.ignoreCase)) {
+                    matchedPattern = pattern;
+                    break;
+                }
+            }
+        }
+        
+        // 如果有匹配，应用该pattern的颜色和高亮
+        if (matchedPattern) {
+            highlighted = highlightTextWithColor(highlighted, matchedPattern.text, matchedPattern.foreColor, searchSettings.ignoreCase);
+            content.style.backgroundColor = matchedPattern.backColor;
+        }
+        
+        textSpan.innerHTML = highlighted;
+    } else {
+        textSpan.innerText = label;
+    }
+}
+
+function traverseAndBuildTree(xmlNode, parentElement) {
+    const container = document.createElement('div');
+    container.className = 'tree-node';
+
+    const content = document.createElement('div');
+    content.className = 'tree-content';
+
     // NOTE: merged hierarchy root is <hierarchy>, its children are <node>. Use children length, not node-only.
     const children = Array.from(xmlNode.children).filter(c => c.tagName === 'node');
 
@@ -1499,33 +1707,7 @@ function traverseAndBuildTree(xmlNode, parentElement) {
 
     const textSpan = document.createElement('span');
     textSpan.className = 'node-text';
-    
-    // 应用搜索高亮 - 每个关键字独立配色
-    if (searchSettings.patterns && searchSettings.patterns.length > 0) {
-        let highlighted = label;
-        let matchedPattern = null;
-        
-        // 找到第一个匹配的pattern
-        for (const pattern of searchSettings.patterns) {
-            if (pattern && pattern.text && pattern.text.trim() !== '') {
-                if (textMatches(label, pattern.text, searchSettings.ignoreCase)) {
-                    matchedPattern = pattern;
-                    break;
-                }
-            }
-        }
-        
-        // 如果有匹配，应用该pattern的颜色和高亮
-        if (matchedPattern) {
-            highlighted = highlightTextWithColor(highlighted, matchedPattern.text, matchedPattern.foreColor, searchSettings.ignoreCase);
-            content.style.backgroundColor = matchedPattern.backColor;
-        }
-        
-        textSpan.innerHTML = highlighted;
-    } else {
-        textSpan.innerText = label;
-    }
-    
+    renderNodeLabel(xmlNode, content, textSpan);
     content.appendChild(textSpan);
 
     content.onclick = (e) => {
@@ -1548,7 +1730,7 @@ function traverseAndBuildTree(xmlNode, parentElement) {
         }
     };
 
-    mapNodeToDom.set(xmlNode, { container, content, toggle });
+    mapNodeToDom.set(xmlNode, { container, content, toggle, textSpan });
 
     container.appendChild(content);
 
@@ -1741,9 +1923,7 @@ function highlightTextWithColor(text, pattern, foreColor, ignoreCase) {
 }
 
 function drawHighlight(xmlNode, strokeColor = '#ef4444', fillColor = 'rgba(239, 68, 68, 0.2)', scale = 1) {
-    const attrs = getAttributes(xmlNode);
-    if (!attrs['bounds']) return;
-    const b = parseBounds(attrs['bounds']);
+    const b = nodeBounds(xmlNode);
     if (!b) return;
 
     // Canvas内部尺寸 = 设备分辨率，bounds坐标直接对应Canvas坐标
@@ -1776,8 +1956,9 @@ function getCanvasCoords(e) {
 
     // 坐标映射：点击坐标直接映射到设备物理坐标
     // deviceCoord = clickCoord × (deviceResolution / displaySize)
-    const scaleX = screenImage.naturalWidth / rect.width;
-    const scaleY = screenImage.naturalHeight / rect.height;
+    const size = screenImageSize();
+    const scaleX = size.width / rect.width;
+    const scaleY = size.height / rect.height;
 
     const deviceX = clickX * scaleX;
     const deviceY = clickY * scaleY;
@@ -1898,7 +2079,7 @@ function handleClick(x, y, isRealControl) {
     if (rootNode) {
         const allHits = findAllNodesAt(rootNode, x, y);
         console.log(`[HandleClick] 点击坐标 (${x}, ${y}), 找到 ${allHits.length} 个匹配节点`);
-        console.log(`[HandleClick] 设备截图分辨率: ${screenImage.naturalWidth}x${screenImage.naturalHeight}`);
+        console.log(`[HandleClick] 设备截图分辨率: ${screenImageSize().width}x${screenImageSize().height}`);
         console.log(`[HandleClick] Canvas显示尺寸: ${canvas.getBoundingClientRect().width}x${canvas.getBoundingClientRect().height}`);
         
         // 打印所有匹配节点的信息
@@ -1931,10 +2112,20 @@ function handleClick(x, y, isRealControl) {
     }
 }
 
+// 输入接口返回服务端预取的等待时间（prefetch_ms），按它安排刷新；拿不到时沿用 100ms
+async function prefetchDelay(res) {
+    try {
+        const data = await res.json();
+        return Number.isFinite(data.prefetch_ms) ? data.prefetch_ms : 100;
+    } catch (e) {
+        return 100;
+    }
+}
+
 async function performRealSwipe(sx, sy, ex, ey, duration) {
     try {
         console.log(`Swiping from (${sx},${sy}) to (${ex},${ey}) in ${duration}s`);
-        await fetch('/api/swipe', {
+        const res = await fetch('/api/swipe', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -1946,8 +2137,8 @@ async function performRealSwipe(sx, sy, ex, ey, duration) {
                 display: parseInt(currentDisplay || 0)
             })
         });
-        // Fast refresh after interaction
-        setTimeout(refreshScreen, 100);
+        // 等到服务端预取开始（界面稳定后）再刷新，直接拿预取的截图
+        setTimeout(refreshScreen, await prefetchDelay(res));
     } catch (e) {
         console.error("Swipe Failed", e);
     }
@@ -1956,7 +2147,7 @@ async function performRealSwipe(sx, sy, ex, ey, duration) {
 async function performRealClick(x, y) {
     // Send click to backend
     try {
-        await fetch('/api/click', {
+        const res = await fetch('/api/click', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -1969,7 +2160,7 @@ async function performRealClick(x, y) {
         if (document.getElementById('autoRefresh').checked) {
             // Screen will auto refresh soon
         } else {
-            setTimeout(refreshScreen, 100); // Trigger a refresh after click
+            setTimeout(refreshScreen, await prefetchDelay(res)); // Trigger a refresh after click
         }
     } catch (e) {
         console.error("Click Failed", e);
@@ -1979,7 +2170,7 @@ async function performRealClick(x, y) {
 async function performRealBack() {
     try {
         console.log("Sending Back Keyevent");
-        await fetch('/api/back', {
+        const res = await fetch('/api/back', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -1987,7 +2178,7 @@ async function performRealBack() {
             })
         });
         // Fast refresh after back
-        setTimeout(refreshScreen, 100);
+        setTimeout(refreshScreen, await prefetchDelay(res));
     } catch (e) {
         console.error("Back Failed", e);
     }
@@ -1996,25 +2187,21 @@ async function performRealBack() {
 function pickBestNode(allHits) {
     if (!allHits || allHits.length === 0) return null;
 
-    // Sort by Area (Smallest First)
-    allHits.sort((a, b) => {
-        const aa = getAttributes(a);
-        const bb = getAttributes(b);
-        const ba = parseBounds(aa['bounds']);
-        const bb_bounds = parseBounds(bb['bounds']);
-
-        const areaA = ba ? ba.area : Number.MAX_VALUE;
-        const areaB = bb_bounds ? bb_bounds.area : Number.MAX_VALUE;
-
-        return areaA - areaB;
-    });
-    return allHits[0];
+    // 面积最小的（bounds 已预解析，线性扫一遍即可；面积相同取先命中的）
+    let best = null;
+    let bestArea = Infinity;
+    for (const node of allHits) {
+        const b = nodeBounds(node);
+        const area = b ? b.area : Number.MAX_VALUE;
+        if (best === null || area < bestArea) {
+            best = node;
+            bestArea = area;
+        }
+    }
+    return best;
 }
-
-function findAllNodesAt(node, x, y) {
-    let matches = [];
-    const attrs = getAttributes(node);
-    const b = parseBounds(attrs['bounds']);
+function findAllNodesAt(node, x, y, matches = []) {
+    const b = nodeBounds(node);
 
     let inside = false;
     if (b) {
@@ -2023,10 +2210,9 @@ function findAllNodesAt(node, x, y) {
         }
     }
 
-    const children = Array.from(node.children).filter(c => c.tagName === 'node');
+    const children = node.children;
     for (let i = children.length - 1; i >= 0; i--) {
-        const childMatches = findAllNodesAt(children[i], x, y);
-        matches = matches.concat(childMatches);
+        if (children[i].tagName === 'node') findAllNodesAt(children[i], x, y, matches);
     }
 
     if (inside && node.tagName === 'node') {
@@ -2036,23 +2222,153 @@ function findAllNodesAt(node, x, y) {
     return matches;
 }
 
+// Live stream: 服务端推帧（/api/stream/ws），替代逐帧 /api/screenshot 轮询
+let liveStream = null;          // { ws, display, opened, pending, decoding }
+let liveStreamUnsupported = false;  // WebSocket 握手失败（旧服务端/缺少依赖）时退回轮询
+
+function startLiveStream(displayId) {
+    stopLiveStream();
+    const proto = location.protocol === 'https:' ? 'wss' : 'ws';
+    const ws = new WebSocket(`${proto}://${location.host}/api/stream/ws?display=${displayId}&format=jpeg&quality=80&delta=true`);
+    ws.binaryType = 'blob';
+    const stream = { ws, display: displayId, opened: false, pending: null, decoding: false };
+
+    ws.onopen = () => { stream.opened = true; };
+    ws.onmessage = (ev) => {
+        if (typeof ev.data === 'string') {
+            console.warn('[LiveStream]', ev.data);
+            return;
+        }
+        // latest-frame-wins：解码期间到达的帧只保留最新一帧
+        stream.pending = ev.data;
+        if (!stream.decoding) drainLiveStreamFrames(stream);
+    };
+    ws.onclose = () => {
+        if (liveStream !== stream) return;
+        liveStream = null;
+        if (!stream.opened) {
+            console.warn('[LiveStream] WebSocket 不可用，退回轮询模式');
+            liveStreamUnsupported = true;
+        }
+    };
+    liveStream = stream;
+}
+
+function stopLiveStream() {
+    if (!liveStream) return;
+    const stream = liveStream;
+    liveStream = null;
+    try { stream.ws.close(); } catch (e) {}
+}
+
+async function drainLiveStreamFrames(stream) {
+    stream.decoding = true;
+    try {
+        while (stream.pending && liveStream === stream) {
+            const blob = stream.pending;
+            stream.pending = null;
+            await applyStreamPacket(stream, blob);
+        }
+    } finally {
+        stream.decoding = false;
+    }
+}
+
+// 增量包: uint32(header长度) + JSON header + 各矩形图片数据；delta 只含变化的 tile，画到离屏 canvas 上
+async function applyStreamPacket(stream, blob) {
+    const buf = await blob.arrayBuffer();
+    const headerLen = new DataView(buf).getUint32(0);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buf, 4, headerLen)));
+
+    let frameCanvas = stream.frameCanvas;
+    if (header.type === 'key' || !frameCanvas ||
+        frameCanvas.width !== header.width || frameCanvas.height !== header.height) {
+        if (header.type !== 'key') return; // 没有基准帧，等下一个关键帧
+        frameCanvas = document.createElement('canvas');
+        frameCanvas.width = header.width;
+        frameCanvas.height = header.height;
+        stream.frameCanvas = frameCanvas;
+    }
+
+    let offset = 4 + headerLen;
+    const parts = header.rects.map(([x, y, w, h, len]) => {
+        const part = new Blob([new Uint8Array(buf, offset, len)], { type: header.mime });
+        offset += len;
+        return createImageBitmap(part).then(bmp => ({ bmp, x, y, w, h }));
+    });
+    const tiles = await Promise.all(parts);
+    const fctx = frameCanvas.getContext('2d');
+    for (const t of tiles) {
+        fctx.drawImage(t.bmp, t.x, t.y, t.w, t.h);
+        t.bmp.close();
+    }
+    if (liveStream !== stream) return;
+
+    const screenEmpty = document.getElementById('screenEmptyState');
+    if (screenEmpty) screenEmpty.classList.add('hidden');
+    screenImage = frameCanvas;
+    if (canvas.width !== frameCanvas.width || canvas.height !== frameCanvas.height) {
+        canvas.width = frameCanvas.width;
+        canvas.height = frameCanvas.height;
+    }
+    drawScreen();
+}
+
+// frameWidth/frameHeight: 设备原始分辨率（图片可能是服务端缩小过的预览）
+async function applyScreenBlob(blob, frameWidth = 0, frameHeight = 0) {
+    const url = URL.createObjectURL(blob);
+    const img = new Image();
+    img.src = url;
+    try {
+        await img.decode();
+    } catch (e) {
+        URL.revokeObjectURL(url);
+        return;
+    }
+    const screenEmpty = document.getElementById('screenEmptyState');
+    if (screenEmpty) screenEmpty.classList.add('hidden');
+
+    const prev = screenImage;
+    screenImage = img;
+    if (prev && prev.src && prev.src.startsWith('blob:')) URL.revokeObjectURL(prev.src);
+
+    // 尺寸不变时不重设 canvas，避免每帧清空重排
+    const width = frameWidth || img.naturalWidth;
+    const height = frameHeight || img.naturalHeight;
+    if (canvas.width !== width || canvas.height !== height) {
+        canvas.width = width;
+        canvas.height = height;
+    }
+    drawScreen();
+}
+
 // Auto Refresh Logic
 let isAutoRefreshing = false;
 async function autoRefreshTick() {
     const cb = document.getElementById('autoRefresh');
-    if (cb && cb.checked && !isAutoRefreshing) {
-        isAutoRefreshing = true;
-        try {
-            await refreshScreen();
-        } catch (e) {
-            console.error("Auto refresh error:", e);
-        } finally {
-            isAutoRefreshing = false;
+    const turbo = !!(cb && cb.checked);
+    const displayId = currentDisplay || "0";
+
+    if (turbo && !liveStreamUnsupported) {
+        // "Turbo Mode": 服务端按截图速度推帧；切换 display 时重建连接
+        if (!liveStream || liveStream.display !== displayId) {
+            startLiveStream(displayId);
+        }
+    } else {
+        stopLiveStream();
+        if (turbo && !isAutoRefreshing) {
+            isAutoRefreshing = true;
+            try {
+                await refreshScreen();
+            } catch (e) {
+                console.error("Auto refresh error:", e);
+            } finally {
+                isAutoRefreshing = false;
+            }
         }
     }
-    // "Turbo Mode": No fixed delay. If checked, request next frame immediately.
-    // This allows the FPS to be limited only by the ADB/Network speed.
-    const delay = (cb && cb.checked) ? 0 : 500;
+    // 轮询兜底模式下不加延迟，FPS 只受 ADB/网络速度限制
+    const delay = (turbo && liveStreamUnsupported) ? 0 : 500;
     setTimeout(autoRefreshTick, delay);
 }
 
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""测试常驻 adb shell 会话的结束标记解析 / stdout 与 stderr 分离，以及连接池的重试规则"""
+
+import sys
+import os
+import socket
+import subprocess
+import types
+
+# 添加server目录到路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'server'))
+
+import main  # noqa: E402
+from main import AdbShellSession, AdbSessionClosed, AdbTransportPool  # noqa: E402
+
+
+def _local_session():
+    """把本机 sh 接到 socketpair 的一端，代替设备上的 exec:sh 服务。"""
+    ours, theirs = socket.socketpair()
+    proc = subprocess.Popen(['sh'], stdin=theirs, stdout=theirs, stderr=subprocess.DEVNULL)
+    theirs.close()
+    session = AdbShellSession.__new__(AdbShellSession)
+    session.serial = 'local'
+    session.conn = types.SimpleNamespace(conn=ours, close=ours.close)
+    session.buf = bytearray()
+    session.seq = 0
+    session.created_at = 0
+    return session, proc
+
+
+def test_session_run_separates_streams():
+    session, proc = _local_session()
+    try:
+        code, out, err = session.run("echo out; echo err >&2; exit 3")
+        assert (code, out, err) == (3, b'out\n', b'err')
+        # 输出没有结尾换行、包含标记前缀的文本，也不会被截错
+        code, out, err = session.run(f"printf 'a\\n{main._ADB_SESSION_MARK}x'")
+        assert (code, out, err) == (0, f'a\n{main._ADB_SESSION_MARK}x'.encode(), b'')
+    finally:
+        session.close()
+        proc.wait(timeout=5)
+
+
+def test_session_state_does_not_leak():
+    session, proc = _local_session()
+    try:
+        _, before, _ = session.run("pwd")
+        # cd / export / exit 都只作用于子 shell
+        session.run("cd /tmp; export CARUI_LEAK=1; exit 0")
+        _, after, _ = session.run("pwd; echo \"[$CARUI_LEAK]\"")
+        assert after == before + b'[]\n'
+    finally:
+        session.close()
+        proc.wait(timeout=5)
+
+
+def test_session_closed_before_send():
+    session, proc = _local_session()
+    proc.kill()
+    proc.wait(timeout=5)
+    try:
+        session.run("input tap 1 1")
+        assert False, 'expected AdbSessionClosed'
+    except AdbSessionClosed:
+        pass
+    finally:
+        session.close()
+
+
+class _FakeSession:
+    def __init__(self, error=None):
+        self.serial = 'dev'
+        self.error = error
+        self.calls = 0
+        self.closed = False
+
+    def run(self, cmd, timeout=10):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return 0, b'ok', b''
+
+    def close(self):
+        self.closed = True
+
+
+def _pool_with(sessions):
+    pool = AdbTransportPool()
+    queue = list(sessions)
+    pool._acquire = lambda serial, timeout: queue.pop(0)
+    return pool
+
+
+def test_pool_retries_only_closed_sessions():
+    # 旧会话在命令发出前已断开：换新会话重试
+    stale, fresh = _FakeSession(AdbSessionClosed('closed')), _FakeSession()
+    pool = _pool_with([(stale, True), (fresh, False)])
+    assert pool.shell('dev', 'input tap 1 1') == (0, b'ok', b'')
+    assert stale.closed and fresh.calls == 1
+
+    # 超时（socket.timeout 也是 OSError）或读到一半断开：命令可能已经执行，不能重试
+    for error in (socket.timeout('timed out'), EOFError('adb shell session closed'),
+                  ConnectionResetError('reset')):
+        busy, spare = _FakeSession(error), _FakeSession()
+        pool = _pool_with([(busy, True), (spare, False)])
+        try:
+            pool.shell('dev', 'input tap 1 1')
+            assert False, 'expected error'
+        except type(error):
+            pass
+        assert busy.calls == 1 and busy.closed and spare.calls == 0
+
+
+if __name__ == '__main__':
+    test_session_run_separates_streams()
+    test_session_state_does_not_leak()
+    test_session_closed_before_send()
+    test_pool_retries_only_closed_sessions()
+    print("✅ 全部通过")
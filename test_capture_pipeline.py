@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""测试截图链路：截图方式 autotuner 的打分 / raw screencap 解析 / ETag 与 tile 差分 / 请求合并"""
+
+import sys
+import os
+import io
+import struct
+import threading
+import time
+import types
+
+import numpy as np
+
+from PIL import Image
+
+# 添加server目录到路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'server'))
+
+import main  # noqa: E402
+
+
+def _png_bytes(width, height, color=(10, 20, 30)):
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def _raw_bytes(width, height, fmt=1, header_len=12, pixel=None):
+    header = struct.pack('<III', width, height, fmt) + b'\x00' * (header_len - 12)
+    pixel = pixel or b'\x01' * main.RAW_PIXEL_FORMATS[fmt][1]
+    return header + pixel * (width * height)
+
+
+def test_capture_strategy_scores_encode_time():
+    orig_run, orig_encode, orig_profile = main._run_capture_method, main.encode_frame, main.get_device_profile
+    main.get_device_profile = lambda serial, refresh=False: {'display_mapping': {}}
+    png = _png_bytes(16, 16)
+    raw = _raw_bytes(16, 16)
+
+    def run(serial, method):
+        if method['transport'] == 'framebuffer':
+            raise Exception('framebuffer unsupported')
+        if method['encoding'] == 'raw':
+            return dict(main.parse_raw_screencap(raw), encoding='raw', data=raw)
+        return {'encoding': 'png', 'data': memoryview(png)}
+
+    # 用假的时钟：raw 传输快但编码慢，总分应该输给 PNG 透传
+    clock = [0.0]
+
+    def fake_run(serial, method):
+        clock[0] += 0.010 if method['encoding'] == 'raw' else 0.030
+        return run(serial, method)
+
+    def fake_encode(frame, fmt='png', quality=80, scale=1.0):
+        clock[0] += 0.050 if frame['encoding'] == 'raw' else 0.0
+        return orig_encode(frame, fmt, quality, scale)
+
+    orig_time = main.time
+    main.time = types.SimpleNamespace(time=lambda: clock[0])
+    main._run_capture_method, main.encode_frame = fake_run, fake_encode
+    try:
+        state = main.probe_capture_strategy('dev', '0')
+    finally:
+        main.time = orig_time
+        main._run_capture_method, main.encode_frame, main.get_device_profile = orig_run, orig_encode, orig_profile
+        main.capture_tuners.pop(('dev', '0'), None)
+
+    assert state['method']['encoding'] == 'png'
+    assert abs(state['score_ms'] - (state['latency_ms'] + state['encode_ms'])) <= 0.2
+    raw_entry = [m for m in state['working'] if m['encoding'] == 'raw'][0]
+    assert raw_entry['latency_ms'] < state['latency_ms'] and raw_entry['score_ms'] > state['score_ms']
+    # 失败的方式只记录错误，不进入 working
+    assert not any(m['transport'] == 'framebuffer' for m in state['working'])
+
+
+def test_parse_raw_screencap():
+    # Android 12 之前 12 字节头，之后多 4 字节 dataspace
+    for header_len in (12, 16):
+        info = main.parse_raw_screencap(_raw_bytes(4, 3, fmt=5, header_len=header_len))
+        assert info == {'width': 4, 'height': 3, 'rawmode': 'BGRX', 'offset': header_len}
+    for bad in (b'\x00' * 8, _raw_bytes(4, 3)[:-1], _raw_bytes(4, 3, fmt=1)[:8] + struct.pack('<I', 99)):
+        try:
+            main.parse_raw_screencap(bad)
+            assert False, 'expected error'
+        except Exception as e:
+            assert 'raw screencap' in str(e) or 'pixel format' in str(e)
+
+
+def test_raw_frame_decodes_bgra():
+    # BGRA_8888：一个蓝色像素在内存里是 ff 00 00 ff
+    data = _raw_bytes(2, 1, fmt=5, header_len=16, pixel=b'\xff\x00\x00\xff')
+    frame = dict(main.parse_raw_screencap(data), encoding='raw', data=data)
+    image = main.frame_to_image(frame)
+    assert image.mode == 'RGB' and image.getpixel((1, 0)) == (0, 0, 255)
+    content, media_type = main.encode_frame(frame, 'jpeg')
+    assert media_type == 'image/jpeg' and content[:2] == b'\xff\xd8'
+
+
+def test_etag_matches():
+    assert main._etag_matches('"abc"', '"abc"')
+    assert main._etag_matches('W/"abc"', '"abc"')
+    assert main._etag_matches('"x", "abc"', '"abc"')
+    assert main._etag_matches('*', '"abc"')
+    assert not main._etag_matches('"x"', '"abc"')
+    assert not main._etag_matches(None, '"abc"')
+    assert not main._etag_matches('', '"abc"')
+
+
+def test_tile_diff_and_rects():
+    prev = np.zeros((150, 200), dtype=np.uint32)
+    cur = prev.copy()
+    cur[10, 10] = 1      # tile (0, 0)
+    cur[10, 70] = 1      # tile (0, 1)：和左边同一行连续，合并成一段
+    cur[140, 199] = 1    # tile (2, 3)：最后一列/行的 tile 不满 64 像素
+    mask = main.tile_diff(prev, cur, 64)
+    assert mask.shape == (3, 4)
+    assert [tuple(p) for p in np.argwhere(mask)] == [(0, 0), (0, 1), (2, 3)]
+    rects = main.tile_mask_to_rects(mask, 64, 200, 150)
+    # 右下角矩形裁到画面边界
+    assert sorted(rects) == [(0, 0, 128, 64), (192, 128, 8, 22)]
+
+    # 上下对齐的行段纵向合并
+    mask = np.array([[True, True, False], [True, True, False], [False, True, False]])
+    assert sorted(main.tile_mask_to_rects(mask, 10, 30, 30)) == [(0, 0, 20, 20), (10, 20, 10, 10)]
+
+    # (h, w, 3) 的 RGB 数组也按 tile 合并通道
+    rgb = np.zeros((64, 64, 3), dtype=np.uint8)
+    rgb2 = rgb.copy()
+    rgb2[63, 63, 2] = 5
+    assert main.tile_diff(rgb, rgb2, 32).tolist() == [[False, False], [False, True]]
+
+
+def _start_leader(flight, key, release):
+    """起一个 leader 调用，卡在 fn 里直到 release 被 set。"""
+    started = threading.Event()
+    results = []
+
+    def fn():
+        started.set()
+        release.wait(5)
+        return 'old'
+
+    t = threading.Thread(target=lambda: results.append(flight.do(key, fn)))
+    t.start()
+    assert started.wait(5)
+    return t, results
+
+
+def test_single_flight_shares_in_flight_call():
+    flight = main.SingleFlight()
+    release = threading.Event()
+    leader, results = _start_leader(flight, ('dev', '0', 'screenshot'), release)
+    follower = threading.Thread(target=lambda: results.append(
+        flight.do(('dev', '0', 'screenshot'), lambda: 'never called')))
+    follower.start()
+    while flight.stats['shared'] == 0:
+        time.sleep(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert results == ['old', 'old']
+    # 刚完成的结果在 fresh 窗口内直接复用
+    assert flight.do(('dev', '0', 'screenshot'), lambda: 'new', fresh=10) == 'old'
+    assert flight.stats == {'calls': 3, 'shared': 1, 'fresh': 1}
+
+
+def test_single_flight_forget_and_generation():
+    flight = main.SingleFlight()
+    key = ('dev', '0', 'screenshot')
+    release = threading.Event()
+    leader, results = _start_leader(flight, key, release)
+    assert flight.generation('dev') == 0
+    # 点击之后：正在跑的截图是点击前的画面，新请求不能再合并进去
+    flight.forget('dev')
+    assert flight.generation('dev') == 1
+    assert flight.do(key, lambda: 'new') == 'new'
+    release.set()
+    leader.join(5)
+    assert results == ['old']
+    # 旧 generation 的结果完成后也不进 recent，最新的仍是 forget 之后那次
+    assert flight.do(key, lambda: 'newer', fresh=10) == 'new'
+    # 其它设备不受影响
+    assert flight.generation('other') == 0
+
+
+def test_single_flight_forget_display():
+    flight = main.SingleFlight()
+    flight.do(('dev', '0', 'screenshot'), lambda: 'd0')
+    flight.do(('dev', '1', 'screenshot'), lambda: 'd1')
+    flight.forget_display('dev', '0')
+    assert flight.do(('dev', '0', 'screenshot'), lambda: 'd0-new', fresh=10) == 'd0-new'
+    assert flight.do(('dev', '1', 'screenshot'), lambda: 'd1-new', fresh=10) == 'd1'
+    assert flight.generation('dev') == 0
+
+
+if __name__ == '__main__':
+    test_capture_strategy_scores_encode_time()
+    test_parse_raw_screencap()
+    test_raw_frame_decodes_bgra()
+    test_etag_matches()
+    test_tile_diff_and_rects()
+    test_single_flight_shares_in_flight_call()
+    test_single_flight_forget_and_generation()
+    test_single_flight_forget_display()
+    print("✅ 全部通过")
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""测试 uiautomator --windows 输出的单遍转换（display 选择 / 窗口坐标转换 / 0 bounds 继承）及基于它的 UI 树索引"""
+
+import sys
+import os
+import xml.etree.ElementTree as ET
+
+# 添加server目录到路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'server'))
+
+import main  # noqa: E402
+from main import transform_uiautomator_xml, decide_window_transform  # noqa: E402
+
+SPLIT_SCREEN_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<displays>'
+    '<display id="0">'
+    # 全屏窗口：绝对坐标，不转换
+    '<window title="Launcher" bounds="[0,0][2860,1440]"><hierarchy>'
+    '<node class="FrameLayout" bounds="[0,0][2860,1440]">'
+    '<node class="TextView" text="Home" bounds="[10,10][200,60]"/>'
+    '</node>'
+    '</hierarchy></window>'
+    # 右侧分屏窗口：hierarchy 为相对坐标，需要 offset
+    '<window title="Media" bounds="[1906,80][2860,1440]"><hierarchy>'
+    '<node class="FrameLayout" bounds="[0,0][954,1360]">'
+    '<node class="TextView" text="听歌观影" bounds="[20,294][932,1428]"/>'
+    '<node class="ImageView" resource-id="id/close" clickable="true" bounds="[0,0][0,0]"/>'
+    '</node>'
+    '</hierarchy></window>'
+    '</display>'
+    '<display id="2">'
+    '<window title="Cluster" bounds="[0,0][1920,720]"><hierarchy>'
+    '<node class="View" text="cluster" bounds="[0,0][1920,720]"/>'
+    '</hierarchy></window>'
+    '</display>'
+    '</displays>'
+)
+
+
+def _nodes(xml):
+    root = ET.fromstring(xml)
+    assert root.tag == 'hierarchy'
+    return list(root.iter('node'))
+
+
+def test_selects_requested_display():
+    nodes = _nodes(transform_uiautomator_xml(SPLIT_SCREEN_XML, 2))
+    assert [n.get('text') for n in nodes] == ['cluster']
+
+
+def test_split_screen_offset_and_zero_bounds():
+    nodes = _nodes(transform_uiautomator_xml(SPLIT_SCREEN_XML, 0))
+    by_text = {n.get('text') or n.get('resource-id') or n.get('class'): n for n in nodes}
+    # 全屏窗口保持原坐标
+    assert by_text['Home'].get('bounds') == '[10,10][200,60]'
+    # 相对坐标 -> 平移到窗口位置
+    assert by_text['听歌观影'].get('bounds') == '[1926,374][2838,1508]'
+    # 可点击的 0 bounds 节点继承最近的非 0 祖先 bounds
+    assert by_text['id/close'].get('bounds') == '[1906,80][2860,1440]'
+
+
+def test_parse_all_displays_once():
+    parsed = main.parse_uiautomator_displays(SPLIT_SCREEN_XML)
+    assert sorted(parsed) == ['0', '2']
+    # 和单独解析每个 display 的结果一致
+    for display_id, snapshot in parsed.items():
+        assert snapshot.to_xml() == transform_uiautomator_xml(SPLIT_SCREEN_XML, int(display_id))
+    assert len(main.parse_uiautomator_windows(SPLIT_SCREEN_XML, 5)) == 0
+
+
+def test_single_hierarchy_passthrough():
+    xml = '<?xml version="1.0" encoding="UTF-8"?><hierarchy rotation="0"><node bounds="[0,0][1,1]"/></hierarchy>'
+    assert transform_uiautomator_xml(xml, 0) == xml
+
+
+def test_deep_tree_no_recursion_limit():
+    depth = sys.getrecursionlimit() * 2
+    xml = ('<displays><display id="0"><window bounds="[0,0][10,10]"><hierarchy>'
+           + '<node bounds="[0,0][5,5]">' * depth + '</node>' * depth
+           + '</hierarchy></window></display></displays>')
+    out = transform_uiautomator_xml(xml, 0)
+    assert out.count('<node') == depth
+
+
+def test_ss2_absolute_heuristic():
+    # SS2：节点 X>1000 即使远小于窗口起点也按绝对坐标处理
+    sx, sy, ox, oy, _ = decide_window_transform((2000, 1440, 2860, 1620), (1200, 100, 1800, 300), "SS2")
+    assert (sx, sy, ox, oy) == (1.0, 1.0, 0.0, 0.0)
+    sx, sy, ox, oy, _ = decide_window_transform((2000, 1440, 2860, 1620), (1200, 100, 1800, 300), None)
+    assert (sx, sy, ox, oy) != (1.0, 1.0, 0.0, 0.0)
+
+
+def test_numpy_and_python_engines_agree():
+    if main.np is None:
+        return
+    with_numpy = transform_uiautomator_xml(SPLIT_SCREEN_XML, 0)
+    saved = main.np
+    main.np = None
+    try:
+        without_numpy = transform_uiautomator_xml(SPLIT_SCREEN_XML, 0)
+    finally:
+        main.np = saved
+    assert with_numpy == without_numpy
+
+
+def test_window_transform_cache():
+    main.window_transform_cache.clear()
+    transform_uiautomator_xml(SPLIT_SCREEN_XML, 0, serial='test')
+    hits = main.window_transform_stats['hits']
+    transform_uiautomator_xml(SPLIT_SCREEN_XML, 0, serial='test')
+    # 同一布局第二次 dump 全部命中缓存
+    assert main.window_transform_stats['hits'] == hits + 2
+
+
+def test_columnar_format():
+    snapshot = main.parse_uiautomator_windows(SPLIT_SCREEN_XML, 0)
+    data = main.hierarchy_to_columnar(snapshot)
+    assert data['count'] == len(snapshot)
+    texts = [data['strings'][i] if i >= 0 else None for i in data['text']]
+    row = texts.index('听歌观影')
+    assert data['bounds'][row * 4:row * 4 + 4] == [1926, 374, 2838, 1508]
+    # 重复的 class 字符串只进字符串表一次
+    assert data['strings'].count('FrameLayout') == 1
+    close = [data['strings'][i] if i >= 0 else None for i in data['resource_id']].index('id/close')
+    assert data['flags'][close] & (1 << data['flag_bits']['clickable'])
+
+
+def test_hierarchy_delta():
+    store = main.HierarchyVersionStore(history=2)
+    key = ('test', 0, 'uiautomator')
+    v1 = store.commit(key, main.parse_uiautomator_windows(SPLIT_SCREEN_XML, 0))
+    # 内容没变沿用版本号
+    assert store.commit(key, main.parse_uiautomator_windows(SPLIT_SCREEN_XML, 0)).version == v1.version
+    v2 = store.commit(key, main.parse_uiautomator_windows(SPLIT_SCREEN_XML.replace('Home', 'Away'), 0))
+    delta = store.delta(key, v1.version, v2)
+    assert delta['added'] == [] and delta['removed'] == []
+    assert [c['set'] for c in delta['changed']] == [{'text': 'Away'}]
+    # 基础版本被淘汰 -> None（发完整快照）
+    store.commit(key, main.parse_uiautomator_windows(SPLIT_SCREEN_XML.replace('Home', 'Gone'), 0))
+    v4 = store.commit(key, main.parse_uiautomator_windows(SPLIT_SCREEN_XML, 0))
+    assert store.delta(key, v1.version, v4) is None
+
+
+def test_spatial_hit():
+    snapshot = main.parse_uiautomator_windows(SPLIT_SCREEN_XML, 0)
+    index = main.HierarchySpatialIndex(snapshot)
+    # 分屏窗口里的文本（已转换到绝对坐标）比窗口根节点小
+    best = index.best(2000, 400)
+    assert snapshot.attrs[best].get('text') == '听歌观影'
+    stack = index.ancestors(best)
+    assert stack[-1] == best and snapshot.parent[stack[0]] == -1
+    # 面积相同取前序靠后的（继承了窗口 bounds 的 close 按钮盖在窗口根节点上面）
+    assert snapshot.attrs[index.best(1910, 85)].get('resource-id') == 'id/close'
+    assert index.best(-1, -1) is None
+
+
+def test_current_version_follows_cache():
+    snapshot = main.parse_uiautomator_windows(SPLIT_SCREEN_XML, 0)
+    key = ('fresh-dev', 0, 'uiautomator')
+    fetched = []
+
+    def fetch(display, force_accessibility=False):
+        fetched.append(display)
+        main.hierarchy_cache.put(key, {'xml': '', 'snapshot': snapshot, 'source': 'uiautomator'})
+        return None, key, main.hierarchy_versions.commit(key, snapshot)
+
+    orig_serial, orig_fetch = main.current_serial, main.fetch_hierarchy_version
+    main.current_serial, main.fetch_hierarchy_version = 'fresh-dev', fetch
+    try:
+        _, first = main.current_hierarchy_version(0)
+        _, again = main.current_hierarchy_version(0)
+        assert again is first and fetched == [0]
+        # 点击之后缓存作废：/api/hit、/api/query 不能再用点击前的树
+        main.on_device_input('fresh-dev', 0, 'click')
+        main.current_hierarchy_version(0)
+        assert fetched == [0, 0]
+        # UI 变化事件只作废对应 display
+        main.invalidate_display('fresh-dev', 0)
+        main.current_hierarchy_version(0)
+        assert fetched == [0, 0, 0]
+    finally:
+        main.current_serial, main.fetch_hierarchy_version = orig_serial, orig_fetch
+        main.hierarchy_cache.forget('fresh-dev')
+        main.hierarchy_versions.forget('fresh-dev')
+        main.prefetcher.forget('fresh-dev')
+
+
+def test_selector_query():
+    snapshot = main.parse_uiautomator_windows(SPLIT_SCREEN_XML, 0)
+    index = main.HierarchyVersion(1, snapshot).query_index()
+
+    def texts(xpath):
+        return [index.attrs[i].get('text') or index.attrs[i].get('resource-id')
+                for i in index.find(main.parse_xpath_selector(xpath))]
+
+    assert texts("//TextView") == ['Home', '听歌观影']
+    assert texts("//*[contains(@text,'观影')]") == ['听歌观影']
+    # resource-id 不带包名时按短名匹配
+    assert texts("//FrameLayout/ImageView[@resource-id='close'][@clickable='true']") == ['id/close']
+    assert texts("/TextView") == []
+    try:
+        main.parse_xpath_selector("//TextView[last()]")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_hierarchy_cache():
+    cache = main.HierarchyCache(max_bytes=25, ttl=60, stale_ttl=120)
+    cache.put(('a', 0, 'uiautomator'), {'xml': 'x' * 10})
+    cache.put(('b', 0, 'uiautomator'), {'xml': 'y' * 10})
+    # 按设备隔离
+    assert cache.get(('a', 0, 'uiautomator'))['xml'] == 'x' * 10
+    assert cache.get(('a', 1, 'uiautomator')) is None
+    # 超出字节上限淘汰最久没用的（b）
+    cache.put(('a', 1, 'uiautomator'), {'xml': 'z' * 10})
+    assert cache.get(('b', 0, 'uiautomator')) is None
+    assert cache.stats['evictions'] == 1
+    # 输入操作后不再直接命中，但 dump 失败时还能兜底
+    cache.invalidate('a')
+    assert cache.get(('a', 0, 'uiautomator')) is None
+    assert cache.get(('a', 0, 'uiautomator'), allow_stale=True) is not None
+    stats = cache.snapshot()
+    assert stats['hits'] == 1 and stats['stale_hits'] == 1 and stats['bytes'] == 20
+
+
+def test_event_driven_cache():
+    cache = main.HierarchyCache(ttl=0, event_ttl=60)
+    cache.put(('a', 0, 'uiautomator'), {'xml': 'x'})
+    cache.put(('a', 2, 'uiautomator'), {'xml': 'y'})
+    assert cache.get(('a', 0, 'uiautomator')) is None
+    # 订阅了 UI 变化事件：没变的 display 一直命中，变了的只作废自己
+    cache.set_event_driven('a', main.time.time() + 60)
+    cache.invalidate('a', 2)
+    assert cache.get(('a', 0, 'uiautomator')) is not None
+    assert cache.get(('a', 2, 'uiautomator')) is None
+    # dump 期间收到变化：放进来的结果已作废
+    epoch = cache.epoch('a')
+    cache.invalidate('a', 0)
+    cache.put(('a', 0, 'uiautomator'), {'xml': 'z'}, epoch=epoch)
+    assert cache.get(('a', 0, 'uiautomator')) is None
+    cache.set_event_driven('a', 0)
+    cache.put(('a', 2, 'uiautomator'), {'xml': 'w'}, epoch=cache.epoch('a'))
+    assert cache.get(('a', 2, 'uiautomator')) is None
+
+
+def test_accessibility_tree_stream():
+    import io
+    import json
+    doc = {'version': 3, 'windows': [{'bounds': {'left': 0, 'top': 0}}],
+           'nodes': [{'text': 'a', 'children': [{'text': 'b', 'children': []}]}, {'text': 'c', 'children': []}],
+           'success': True, 'error': None}
+    items = list(main.iter_accessibility_tree(io.BytesIO(json.dumps(doc).encode())))
+    # 根节点逐个产出，其它顶层字段原样产出
+    assert [k for k, _ in items] == ['version', 'windows', 'node', 'node', 'success', 'error']
+    assert items[2][1]['children'][0]['text'] == 'b'
+    assert items[1][1] == doc['windows'] and items[4][1] is True
+
+
+def test_accessibility_tree_stream_ijson():
+    import io
+    import json
+    import pytest
+    ijson = pytest.importorskip('ijson')
+    doc = {'version': 7, 'windows': [{'id': 3, 'bounds': {'left': 0, 'top': 80}}],
+           'nodes': [{'text': 'a', 'bounds': {'left': 1}, 'children': [{'text': 'b', 'children': []}]},
+                     {'text': None, 'children': []}],
+           'stats': {'requests': 2}, 'success': True, 'error': None}
+    raw = json.dumps(doc).encode()
+    orig = main.ijson
+    try:
+        main.ijson = None
+        expected = list(main.iter_accessibility_tree(io.BytesIO(raw)))
+        # 边收边解析的分支和整体解析的结果一致
+        main.ijson = ijson
+        assert list(main.iter_accessibility_tree(io.BytesIO(raw))) == expected
+    finally:
+        main.ijson = orig
+
+
+def test_accessibility_node_attrs():
+    origin = main.accessibility_display_origin([{'left': 1906, 'top': 80}, {'left': 2000, 'top': 300}])
+    assert origin == (1906, 80)
+    attrs = main.accessibility_node_attrs(
+        {'className': 'ImageView', 'resourceId': 'p:id/close', 'clickable': True,
+         'bounds': {'left': 2000, 'top': 100, 'right': 2100, 'bottom': 200}}, origin)
+    # 全局坐标换算到 display 坐标系，属性名和 uiautomator 一致
+    assert attrs['bounds'] == '[94,20][194,120]'
+    assert attrs['class'] == 'ImageView' and attrs['clickable'] == 'true' and 'visible-to-user' not in attrs
+
+
+def test_uiautomator_stdout_fallback():
+    xml = '<?xml version="1.0"?><hierarchy rotation="0"><node/></hierarchy>'
+    assert main._extract_dump_xml(xml + 'UI hierchary dumped to: /dev/stdout') == xml
+    assert main._extract_dump_xml('ERROR: could not get idle state.') is None
+    assert main._extract_dump_xml('<?xml version="1.0"?><hierarchy rotation="0"><node') is None
+
+    calls = []
+
+    def dump_once(serial, target_args, to_stdout):
+        calls.append(to_stdout)
+        if to_stdout and behaviour['stdout'] == 'timeout':
+            raise Exception('timed out')
+        if to_stdout and behaviour['stdout'] == 'no-xml':
+            return None, 'UI hierchary dumped to: /dev/stdout'
+        return xml, xml
+
+    orig = main._uiautomator_dump_once
+    main._uiautomator_dump_once = dump_once
+    try:
+        # 超时不能说明不支持 stdout，下次还要先试 stdout
+        behaviour = {'stdout': 'timeout'}
+        assert main.dump_uiautomator_xml('dev') == xml
+        assert 'dev' not in main._uiautomator_stdout_ok
+        # 正常跑完却没有 XML、临时文件却能拿到：判定不支持，之后直接用临时文件
+        behaviour = {'stdout': 'no-xml'}
+        main.dump_uiautomator_xml('dev')
+        assert main._uiautomator_stdout_ok['dev'][0] is False
+        del calls[:]
+        main.dump_uiautomator_xml('dev')
+        assert calls == [False]
+        # 过了 UIAUTOMATOR_STDOUT_REPROBE 重新试 stdout
+        main._uiautomator_stdout_ok['dev'] = (False, 0.0)
+        behaviour = {'stdout': 'ok'}
+        del calls[:]
+        main.dump_uiautomator_xml('dev')
+        assert calls == [True] and main._uiautomator_stdout_ok['dev'][0] is True
+    finally:
+        main._uiautomator_dump_once = orig
+        main._uiautomator_stdout_ok.pop('dev', None)
+
+
+if __name__ == '__main__':
+    test_selects_requested_display()
+    test_split_screen_offset_and_zero_bounds()
+    test_parse_all_displays_once()
+    test_single_hierarchy_passthrough()
+    test_deep_tree_no_recursion_limit()
+    test_ss2_absolute_heuristic()
+    test_numpy_and_python_engines_agree()
+    test_window_transform_cache()
+    test_columnar_format()
+    test_hierarchy_delta()
+    test_spatial_hit()
+    test_current_version_follows_cache()
+    test_selector_query()
+    test_hierarchy_cache()
+    test_event_driven_cache()
+    test_accessibility_tree_stream()
+    test_accessibility_tree_stream_ijson()
+    test_accessibility_node_attrs()
+    test_uiautomator_stdout_fallback()
+    print("✅ 全部通过")